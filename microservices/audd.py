@@ -1,24 +1,322 @@
 from flask import Flask, request, jsonify
 import requests
 import os
+import json
+import glob
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import fingerprint
+import preprocess
+from cache import ResultCache, hash_file
+from http_client import ServiceClient, CircuitBreaker
+from spool import TrackSpool
+from singleflight import SingleFlight
+import metrics
 
 audd_app = Flask(__name__)
 
-db_url = "http://127.0.0.1:5000"  # set the port number that the database microservice runs on 
+registry = metrics.Registry()
+metrics.instrument(audd_app, registry, "audd")  # request latency by route, in flight and errors, served at /metrics
+STAGE_SECONDS = metrics.Histogram(registry, "audd_stage_seconds", "Time spent in each stage of an identification",
+                                  ("stage",))
+UPSTREAM_ERRORS = metrics.Counter(registry, "audd_upstream_errors_total",
+                                  "Calls to the audd API or database that failed or did not return 200", ("service",))
 
+db_url = os.environ.get("DB_URL", "http://127.0.0.1:5000")  # set the port number that the database microservice runs on 
+AUDD_URL = os.environ.get("AUDD_URL", "https://api.audd.io/")  # song recognition API, can be pointed at a local stub for testing
 
-load_dotenv()  # load the API key from the .env file 
 
-API = os.getenv('API_KEY')  # assign API key to correct variable 
+API = None  # the audd API key, read by api_key() the first time the audd API is needed
 
-if API is None:
-    API = os.environ.get("API_KEY")
 
-if API is None:
-    raise ValueError("No AUDD API key given")
+class MissingApiKey(Exception):
+    """ Raised when a song has to be sent to the audd API but no API key has been given """
 
-AUDIO_DIR = os.path.join(os.getcwd()) # get current working directory to add to filename when identifying track 
+
+def api_key():
+    """ Function returns the audd API key from the environment or the .env file, raises MissingApiKey if there is
+    none
+
+    read on first use rather than at import, so the service starts quickly and can still answer from the result
+    cache and the local fingerprint index without a key
+    """
+    global API
+    if API is None:
+        load_dotenv()  # load the API key from the .env file 
+        API = os.environ.get("API_KEY")
+    if API is None:
+        raise MissingApiKey("No AUDD API key given")
+    return API
+
+
+AUDIO_DIR = os.environ.get("AUDIO_DIR", os.getcwd())  # directory the filenames sent to /identify are looked up in
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+REFERENCES_PATH = os.path.join(BASE_DIR, "references.json")  # reference tracks that are fingerprinted for local matching
+
+CACHE_PATH = os.environ.get("IDENTIFY_CACHE_PATH", os.path.join(BASE_DIR, "identify_cache.db"))  # results cached by audio hash
+result_cache = ResultCache(
+    CACHE_PATH,
+    max_entries=int(os.environ.get("IDENTIFY_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("IDENTIFY_CACHE_TTL", 7 * 24 * 3600)),
+    negative_ttl=float(os.environ.get("IDENTIFY_CACHE_NEGATIVE_TTL", 3600)),
+)
+
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 30))  # seconds before a call to the audd API or database gives up
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))  # retries for connection errors and 5xx responses
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", 0.2))  # retries wait backoff * 2^n seconds
+
+# pooled keep-alive clients so each identification does not open new connections to the audd API and database
+audd_client = ServiceClient("audd", pool_size=int(os.environ.get("AUDD_POOL_SIZE", 10)),
+                            retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, timeout=UPSTREAM_TIMEOUT)
+db_client = ServiceClient("db", pool_size=int(os.environ.get("DB_POOL_SIZE", 10)),
+                          retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, timeout=UPSTREAM_TIMEOUT,
+                          breaker=CircuitBreaker(failure_threshold=int(os.environ.get("DB_BREAKER_FAILURES", 5)),
+                                                 reset_timeout=float(os.environ.get("DB_BREAKER_RESET", 30))))
+
+
+def send_tracks(tracks):
+    """ Function adds a batch of tracks from the spool to the database with one bulk request, returns True once the
+    database has answered for every track (added, exists or invalid)
+    """
+    try:
+        with STAGE_SECONDS.time("db_write"):
+            response = db_client.post(db_url + "/tracks/bulk", json=tracks)
+    except requests.RequestException:
+        UPSTREAM_ERRORS.inc("db")
+        raise
+    if response.status_code != 200:
+        UPSTREAM_ERRORS.inc("db")
+    return response.status_code == 200
+
+
+# identified tracks are queued on disk and added to the database in the background, so identify does not wait on
+# (or fail because of) the database
+SPOOL_PATH = os.environ.get("TRACK_SPOOL_PATH", os.path.join(BASE_DIR, "track_spool.db"))
+track_spool = TrackSpool(
+    SPOOL_PATH,
+    send_tracks,
+    batch_size=int(os.environ.get("SPOOL_BATCH_SIZE", 500)),
+    interval=float(os.environ.get("SPOOL_FLUSH_INTERVAL", 0.5)),
+    max_backoff=float(os.environ.get("SPOOL_MAX_BACKOFF", 30)),
+)
+
+# audio is cut down to what recognition needs before it is matched or uploaded: mono, resampled, silence trimmed
+# and capped at a maximum length
+CLIP_MAX_SECONDS = float(os.environ.get("CLIP_MAX_SECONDS", 12))
+CLIP_SAMPLE_RATE = int(os.environ.get("CLIP_SAMPLE_RATE", 16000))
+preprocess_stats = preprocess.PreprocessStats()
+AUDIO_MIMETYPES = {"audio/wav", "audio/wave", "audio/x-wav", "application/octet-stream"}  # raw WAV request bodies
+
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 8))  # how many files of a batch are identified at the same time
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", 1000))  # largest batch accepted by /identify_batch
+
+_index = None
+_index_lock = threading.Lock()
+
+# concurrent identifications of the same audio (by content hash) share one identification and one database write
+identify_flights = SingleFlight()
+
+
+def get_index():
+    """ Function returns the local fingerprint index, building it from the reference tracks on first use """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                with open(REFERENCES_PATH) as f:
+                    references = json.load(f)
+                _index = fingerprint.build_index(references, os.path.dirname(REFERENCES_PATH))  # listed beside it
+    return _index
+
+
+def make_track(key, artist, title, source):
+    """ Function builds the result dictionary for an identified track """
+    return {"key": key, "artist": artist, "title": title, "source": source, "found": artist != 'Unknown' and title != 'Unknown'}
+
+
+def parse_audd_result(body):
+    """ Function returns (artist, title) from an audd API response body, 'Unknown' for anything missing, or None if
+    the body reports an error (a bad token, an exceeded limit), which audd sends with status code 200
+    """
+    if body.get('status') != 'success':
+        return None  # not an answer about the song, so it must not be cached as "not recognised"
+    result = body.get('result') or {}  # audd returns a null result when it does not know the song
+    return result.get('artist', 'Unknown'), result.get('title', 'Unknown')
+
+
+def cached_track(key):
+    """ Function returns the cached track for a content hash, or None if it has not been identified before """
+    cached = result_cache.get(key)
+    if cached is None:
+        return None
+    return {"key": key, "artist": cached["artist"], "title": cached["title"], "source": "cache", "found": cached["found"]}
+
+
+def recognise_upstream(key, files):
+    """ Function sends audio to the audd API, returns the track or None if the audd API fails """
+    try:
+        with STAGE_SECONDS.time("upstream"):
+            response = audd_client.post(AUDD_URL, data={'api_token': api_key()}, files=files)  #get response from API 
+    except requests.RequestException:
+        UPSTREAM_ERRORS.inc("audd")
+        raise
+
+    if response.status_code != 200:
+        UPSTREAM_ERRORS.inc("audd")
+        return None
+
+    parsed = parse_audd_result(response.json())
+    if parsed is None:
+        UPSTREAM_ERRORS.inc("audd")
+        return None
+    return make_track(key, *parsed, "audd")
+
+
+def match_clip(key, clip):
+    """ Function matches pre-processed audio against the local fingerprint index, returns the track or None """
+    with STAGE_SECONDS.time("local_match"):
+        track, _ = get_index().match(*fingerprint.fingerprint(clip.samples, clip.rate))
+    if track is None:
+        return None
+    return make_track(key, track["artist"], track["title"], "local")
+
+
+def with_preprocess_stats(track, clip):
+    """ Function attaches the pre-processing stats of the clip to the track so they are reported in the response """
+    if track is not None and clip is not None:
+        track["preprocess"] = clip.stats
+    return track
+
+
+def identify_once(key, identify, queue=True):
+    """ Function runs identify() for the audio with content hash key, unless the same audio is already being
+    identified, in which case it waits for that and shares its track
+
+    with queue the request that did the identifying (the leader) also queues the track for the database before the
+    others are let go, so concurrent identical requests make one audd API call and one database write, and a request
+    arriving just after finds the track in the result cache. Raises sqlite3.Error if the track could not be queued
+    """
+    def identify_and_queue():
+        track = identify()
+        if queue and track is not None and track["source"] != "cache":
+            queue_track(track)  # the database is updated in the background by the spool's flusher
+        return track
+
+    track, shared = identify_flights.do(key, identify_and_queue)
+    if shared and track is not None:
+        track = {**track}  # a copy, the leader's track is in use on another thread
+    return track
+
+
+def identify_local(file_path, key=None):
+    """ Function tries to identify the song in a file without any network call, first from the result cache and then
+    from the local fingerprint index
+
+    returns (key, track, clip) where key is the content hash of the file, track is None if the audd API is needed
+    and clip is the pre-processed audio to send to it, or None if the file is not a WAV that can be decoded
+    """
+    if key is None:
+        with STAGE_SECONDS.time("file_read"):
+            key = hash_file(file_path)  # cache on the audio content so renamed copies of a file are still hits
+    track = cached_track(key)
+    if track is not None:
+        return key, track, None
+
+    try:
+        with STAGE_SECONDS.time("preprocess"):
+            clip = preprocess.preprocess_file(file_path, CLIP_SAMPLE_RATE, CLIP_MAX_SECONDS)
+    except ValueError:
+        return key, None, None  # not a WAV we can decode, the audd API will be sent the file as it is
+    preprocess_stats.record(clip.stats)
+    return key, with_preprocess_stats(match_clip(key, clip), clip), clip
+
+
+def identify_track(file_path, queue=True):
+    """ Function identifies the song in a file, only sending the file to the audd API if it is not in the result
+    cache or the local fingerprint index, and queues it for the database unless queue is False
+
+    returns {"key", "artist", "title", "source", "found"} or None if the audd API fails, raises
+    requests.RequestException if the audd API cannot be reached
+    """
+    def identify():
+        _, track, clip = identify_local(file_path, key)
+        if track is not None:
+            return track
+
+        if clip is not None:
+            return with_preprocess_stats(recognise_upstream(key, {'file': ('clip.wav', clip.payload, 'audio/wav')}), clip)
+
+        with open(file_path, 'rb') as file:
+            return recognise_upstream(key, {'file': file})
+
+    with STAGE_SECONDS.time("file_read"):
+        key = hash_file(file_path)
+    return identify_once(key, identify, queue)
+
+
+def identify_stream(stream):
+    """ Function identifies the song in a WAV streamed in the request body
+
+    the body is decoded a chunk at a time and only read as far as the pre-processing pipeline needs, so memory use
+    does not grow with the length of the upload. The pre-processed audio is what is hashed for the cache, matched
+    locally and sent to the audd API
+
+    returns the same as identify_track and queues the track for the database, raises ValueError if the body is not
+    a WAV that can be decoded
+    """
+    with STAGE_SECONDS.time("preprocess"):  # includes reading the body, which arrives as it is decoded
+        clip = preprocess.preprocess(stream, CLIP_SAMPLE_RATE, CLIP_MAX_SECONDS)
+    preprocess_stats.record(clip.stats)
+    key = hashlib.sha256(clip.payload).hexdigest()
+
+    def identify():
+        track = cached_track(key)
+        if track is not None:
+            return track
+
+        track = match_clip(key, clip)
+        if track is None:
+            track = recognise_upstream(key, {'file': ('clip.wav', clip.payload, 'audio/wav')})
+        return with_preprocess_stats(track, clip)
+
+    return identify_once(key, identify)
+
+
+def queue_track(track):
+    """ Function queues an identified track for the database and caches the result, the spool is on disk so the
+    track will reach the database even if it is down right now
+    """
+    with STAGE_SECONDS.time("queue"):
+        track_spool.put(track["key"], track["artist"], track["title"])
+        result_cache.put(track["key"], track["artist"], track["title"])
+
+
+@audd_app.before_request
+def start_spool():
+    track_spool.start()  # sends tracks left over from the last run as soon as the service is used
+
+
+def store_track(track):
+    """ Function builds the identify response for a track that has been identified and queued for the database,
+    track is None when the audd API failed to identify the song
+    """
+    if track is None:
+        return jsonify({"error": "Failed to identify track"}), 500  # return error if API fails to identify the track correctly 
+
+    artist, title, source = track["artist"], track["title"], track["source"]
+    if source == "cache":  # already identified and queued, so no call to the audd API or database is needed
+        if not track["found"]:
+            return jsonify({"artist": artist, "title": title, "source": source, "message": "Track not recognised"}), 200
+        return jsonify({"artist": artist, "title": title, "source": source, "message": "Track already identified"}), 200
+
+    response = {"artist": artist, "title": title, "source": source}
+    if "preprocess" in track:
+        response["preprocess"] = track["preprocess"]  # bytes saved and time spent in each pre-processing stage
+    return jsonify({**response, "message": "Track queued for database"}), 200
 
 
 @audd_app.route("/identify", methods=['POST'])
@@ -26,10 +324,24 @@ def identify():
     """ Function gets filename and send file of song snippet to audd API to get a song name and artist in return 
         
     expected JSON payload: { "filename": "good 4 u.wav"}
+    or a raw WAV request body with Content-Type audio/wav, which can be sent with chunked transfer encoding
 
-    expected output "Track added to database" 200 
+    expected output "Track queued for database" 200, the track is added to the database in the background
     
     """
+    if request.mimetype in AUDIO_MIMETYPES:
+        try:
+            track = identify_stream(request.stream)  # read the upload as it arrives instead of buffering it
+        except ValueError as e:
+            return jsonify({"error": f"Invalid audio: {str(e)}"}), 400  # body is not a WAV we can decode
+        except requests.RequestException as e:
+            return jsonify({"error": f"Request failed: {str(e)}"}), 500
+        except MissingApiKey as e:
+            return jsonify({"error": str(e)}), 500
+        except sqlite3.Error:
+            return jsonify({"error": "Track identified but could not be queued for the database"}), 500
+        return store_track(track)
+
     if not request.is_json:
         return jsonify({"error": "Request must be in JSON format"}), 400  # ensure that request input is a JSON format
 
@@ -45,34 +357,140 @@ def identify():
         return jsonify({"error": "File not found"}), 404   # output error if filepath does not exist 
     
     try:
-        with open(file_path, 'rb') as file:
-            files = {'file': file}
-            response = requests.post('https://api.audd.io/', data={'api_token': API}, files=files)  #get response from API 
-        
-        if response.status_code == 200:  # assign all data if API response code is 200 ok 
-            result = response.json()
-            artist = result.get('result', {}).get('artist', 'Unknown')
-            title = result.get('result', {}).get('title', 'Unknown')
-
-            
-            track_data = {"artist": artist, "title": title}
-            add_response = requests.post(db_url + "/add_track", json=track_data)  # add track identified to the database 
-
-            if add_response.status_code == 200:  # check if track was added to database correctly then return relevent html codes 
-                return jsonify({"artist": artist, "title": title, "message": "Track added to database"}), 200
-            else:
-                return jsonify({"artist": artist, "title": title, "warning": "Track identified but could not be added"}), 500
-        
-        return jsonify({"error": "Failed to identify track"}), 500  # return error if API fails to identify the track correctly 
-
+        track = identify_track(file_path)
     except requests.RequestException as e:
         return jsonify({"error": f"Request failed: {str(e)}"}), 500
+    except MissingApiKey as e:
+        return jsonify({"error": str(e)}), 500  # the song was not in the cache or local index, and needs the audd API
+    except sqlite3.Error:
+        return jsonify({"error": "Track identified but could not be queued for the database"}), 500
+    return store_track(track)
 
 
+def _identify_batch_item(filename):
+    """ Function identifies one file of a batch, returning its result instead of raising so one bad file does not
+    fail the whole batch
+    """
+    file_path = os.path.join(AUDIO_DIR, filename)
+    if not os.path.isfile(file_path):
+        return {"filename": filename, "status": "not_found", "error": "File not found"}
+    try:
+        track = identify_track(file_path, queue=False)  # the batch adds its tracks with one bulk request
+    except requests.RequestException as e:
+        return {"filename": filename, "status": "failed", "error": f"Request failed: {str(e)}"}
+    except MissingApiKey as e:
+        return {"filename": filename, "status": "failed", "error": str(e)}
+    except sqlite3.Error as e:
+        return {"filename": filename, "status": "failed", "error": f"Result cache error: {str(e)}"}
+    if track is None:
+        return {"filename": filename, "status": "failed", "error": "Failed to identify track"}
+    return {"filename": filename, "status": "identified", **track}
+
+
+@audd_app.route("/identify_batch", methods=['POST'])
+def identify_batch():
+    """ Function identifies many song snippets at once, sending them to the audd API concurrently and adding all of
+    the identified tracks to the database with a single bulk request, tracks are queued in the spool instead if the
+    database cannot be reached
+
+    expected JSON payload: {"filenames": ["good 4 u.wav", "Blinding Lights.wav"]} or {"glob": "_*.wav"}
+
+    expected output is 200 and a status for every file:
+    {"results": [{"filename": "good 4 u.wav", "status": "added", "artist": .., "title": .., "source": ..}], "summary": {"added": 1}}
+    where the status is "added", "exists", "cached", "queued", "db_error", "not_found" or "failed"
+    """
+    if not request.is_json:
+        return jsonify({"error": "Request must be in JSON format"}), 400  # ensure that request input is a JSON format
+
+    data = request.get_json()
+
+    if 'filenames' in data:
+        filenames = data['filenames']
+        if not isinstance(filenames, list) or not all(isinstance(name, str) for name in filenames):
+            return jsonify({"error": "'filenames' must be a list of strings"}), 400
+    elif 'glob' in data:
+        if not isinstance(data['glob'], str):
+            return jsonify({"error": "'glob' must be a string"}), 400
+        audio_dir = os.path.abspath(AUDIO_DIR)
+        matches = glob.glob(os.path.join(glob.escape(audio_dir), data['glob']))
+        filenames = sorted(os.path.relpath(path, audio_dir) for path in matches
+                           if os.path.isfile(path) and os.path.abspath(path).startswith(audio_dir + os.sep))  # stay inside AUDIO_DIR
+    else:
+        return jsonify({"error": "No filenames or glob provided"}), 400
+
+    if len(filenames) > BATCH_MAX_FILES:
+        return jsonify({"error": f"Batch is limited to {BATCH_MAX_FILES} files"}), 400
+
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        results = list(pool.map(_identify_batch_item, filenames))  # map keeps the results in the same order as the files
+
+    # everything that was not answered from the cache is added to the database in one bulk request
+    to_add = [r for r in results if r["status"] == "identified" and r["source"] != "cache"]
+    if to_add:
+        tracks = [{"artist": r["artist"], "title": r["title"]} for r in to_add]
+        try:
+            add_response = db_client.post(db_url + "/tracks/bulk", json=tracks)
+            statuses = [t["status"] for t in add_response.json()["results"]] if add_response.status_code == 200 else None
+        except (requests.RequestException, ValueError, KeyError):
+            statuses = None
+
+        for r, status in zip(to_add, statuses or ["queued"] * len(to_add)):
+            r["status"] = status  # "added" or "exists" from the database
+            if status == "queued":
+                try:
+                    queue_track(r)  # the database is down, the spool retries in the background
+                except sqlite3.Error:
+                    r["status"] = "db_error"
+            elif status in ("added", "exists") or not r["found"]:
+                try:
+                    result_cache.put(r["key"], r["artist"], r["title"])
+                except sqlite3.Error:
+                    pass  # the track is in the database, it will just be identified again next time
+
+    for r in results:
+        if r["status"] == "identified":
+            r["status"] = "cached"
+        r.pop("key", None)
+        r.pop("found", None)
+
+    summary = {}
+    for r in results:
+        summary[r["status"]] = summary.get(r["status"], 0) + 1
+    return jsonify({"results": results, "summary": summary}), 200
+
+
+# the counters kept for /stats are exposed at /metrics too, looked up when scraped like /stats does
+registry.add_callback(metrics.stats_gauges("audd", {
+    "cache": lambda: result_cache.stats(),
+    "http_audd": lambda: audd_client.stats(),
+    "http_db": lambda: db_client.stats(),
+    "preprocess": lambda: preprocess_stats.snapshot(),
+    "spool": lambda: track_spool.stats(),
+    "singleflight": lambda: identify_flights.stats(),
+}))
+
+
+@audd_app.route("/stats", methods=['GET'])
+def stats():
+    """ Function outputs the identification cache counters, the audd API and database connection counters, the
+    pre-processing totals, the write-behind spool and how many identifications were coalesced
+
+    Does not take any JSON payload input
+
+    expected output is 200 and {"cache": {"hits": .., "misses": .., ...}, "http": {"audd": {"retries": .., ...}, "db": {..}},
+    "preprocess": {"clips": .., "bytes_saved": .., "stages_ms": {"decode": .., ...}},
+    "spool": {"depth": .., "oldest_seconds": .., "last_batch_size": .., "last_lag_seconds": .., ...},
+    "singleflight": {"leaders": .., "coalesced": .., "in_flight": ..}}
+    """
+    return jsonify({
+        "cache": result_cache.stats(),
+        "http": {"audd": audd_client.stats(), "db": db_client.stats()},
+        "preprocess": preprocess_stats.snapshot(),
+        "spool": track_spool.stats(),
+        "singleflight": identify_flights.stats(),
+    }), 200
+
 
 if __name__ == "__main__":
-    with audd_app.app_context():
-        print("Microservice started")
-    
-    # Start the microservice
-    audd_app.run(debug=True, port=8080) # Runs on http://127.0.0.1:8080
+    import serve
+    serve.run(audd_app, "AUDD", port=8080, threads=16, on_exit=track_spool.stop)  # see serve.py, sends what is left in the spool on the way out
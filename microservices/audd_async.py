@@ -0,0 +1,158 @@
+""" Asynchronous (ASGI) serving mode of the audd microservice
+
+Serves the same /identify endpoint as audd.py, but waits on the audd API without holding a worker thread, so one
+process can keep hundreds of identifications in flight. Calls share one pooled aiohttp session. Identified tracks go
+through the same write-behind spool as audd.py, whose flusher thread adds them to the database. Hashing and
+fingerprinting still happen in audd.py, and run on a worker thread so they do not block the event loop.
+
+run with: uvicorn audd_async:audd_async_app --port 8080 (add --workers N for one event loop per CPU)
+"""
+import asyncio
+import os
+import sqlite3
+
+import aiohttp
+import quart
+from quart import Quart, request, jsonify
+
+import audd
+import metrics
+from singleflight import AsyncSingleFlight
+
+audd_async_app = Quart(__name__)
+
+# shares audd.py's registry, so /metrics also has the stage timings and counters of the code the two modes share
+metrics.instrument(audd_async_app, audd.registry, "audd_async", g=quart.g, request=quart.request, asynchronous=True)
+
+# concurrent identifications of the same audio (by content hash) share one audd API call and one database write
+identify_flights = AsyncSingleFlight()
+
+MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", 500))  # connections shared by all in-flight requests
+
+http_session = None
+
+
+def get_session():
+    """ Function returns the shared http session, creating it on first use so it is bound to the running event loop """
+    global http_session
+    if http_session is None:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(total=audd.UPSTREAM_TIMEOUT),
+        )
+    return http_session
+
+
+@audd_async_app.before_serving
+async def start_spool():
+    audd.track_spool.start()
+
+
+@audd_async_app.after_serving
+async def close_session():
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+    await asyncio.to_thread(audd.track_spool.stop)  # last attempt to send what is queued, the rest stays on disk
+
+
+async def post_audd(filename, file_data):
+    """ Function sends a file to the audd API, returns (status code, response body) """
+    form = aiohttp.FormData()
+    form.add_field('api_token', audd.api_key())
+    form.add_field('file', file_data, filename=filename)
+    try:
+        with audd.STAGE_SECONDS.time("upstream"):
+            async with get_session().post(audd.AUDD_URL, data=form) as response:
+                body = await response.json(content_type=None) if response.status == 200 else None
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        audd.UPSTREAM_ERRORS.inc("audd")
+        raise
+    if response.status != 200:
+        audd.UPSTREAM_ERRORS.inc("audd")
+    return response.status, body
+
+
+def _read_file(file_path):
+    with open(file_path, 'rb') as file:
+        return file.read()
+
+
+@audd_async_app.route("/identify", methods=['POST'])
+async def identify():
+    """ Function gets filename and send file of song snippet to audd API to get a song name and artist in return
+
+    expected JSON payload: { "filename": "good 4 u.wav"}
+
+    expected output "Track queued for database" 200, the track is added to the database in the background
+    """
+    if not request.is_json:
+        return jsonify({"error": "Request must be in JSON format"}), 400  # ensure that request input is a JSON format
+
+    data = await request.get_json()
+
+    if 'filename' not in data:
+        return jsonify({"error": "No filename provided"}), 400  # return error if data input format not right/no file name
+
+    filename = data['filename']
+    file_path = os.path.join(audd.AUDIO_DIR, filename)  # get file path by adding current working directory to front of it
+
+    if not os.path.exists(file_path):
+        return jsonify({"error": "File not found"}), 404   # output error if filepath does not exist
+
+    async def identify_and_queue():
+        _, track, clip = await asyncio.to_thread(audd.identify_local, file_path, key)  # cache, pre-processing and fingerprinting are blocking
+        if track is None:
+            if clip is not None:
+                status, body = await post_audd("clip.wav", clip.payload)
+            else:
+                status, body = await post_audd(os.path.basename(filename), await asyncio.to_thread(_read_file, file_path))
+            if status != 200:
+                return None
+            parsed = audd.parse_audd_result(body)
+            if parsed is None:
+                audd.UPSTREAM_ERRORS.inc("audd")
+                return None
+            track = audd.with_preprocess_stats(audd.make_track(key, *parsed, "audd"), clip)
+        if track["source"] != "cache":
+            await asyncio.to_thread(audd.queue_track, track)  # queued before other requests for the same audio are let go
+        return track
+
+    try:
+        with audd.STAGE_SECONDS.time("file_read"):
+            key = await asyncio.to_thread(audd.hash_file, file_path)
+        track, _ = await identify_flights.do(key, identify_and_queue)
+        if track is None:
+            return jsonify({"error": "Failed to identify track"}), 500  # return error if API fails to identify the track correctly
+
+        artist, title, source = track["artist"], track["title"], track["source"]
+        if source == "cache":  # already identified and queued, so no call to the audd API or database is needed
+            if not track["found"]:
+                return jsonify({"artist": artist, "title": title, "source": source, "message": "Track not recognised"}), 200
+            return jsonify({"artist": artist, "title": title, "source": source, "message": "Track already identified"}), 200
+
+        response = {"artist": artist, "title": title, "source": source}
+        if "preprocess" in track:
+            response["preprocess"] = track["preprocess"]
+        return jsonify({**response, "message": "Track queued for database"}), 200
+
+    except audd.MissingApiKey as e:
+        return jsonify({"error": str(e)}), 500
+    except sqlite3.Error:
+        return jsonify({"error": "Track identified but could not be queued for the database"}), 500
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return jsonify({"error": f"Request failed: {str(e)}"}), 500
+
+
+@audd_async_app.route("/stats", methods=['GET'])
+async def stats():
+    """ Function outputs the identification cache counters, pre-processing totals, spool and coalesced
+    identifications, like /stats in audd.py
+    """
+    return jsonify({
+        "cache": await asyncio.to_thread(audd.result_cache.stats),
+        "preprocess": audd.preprocess_stats.snapshot(),
+        "spool": await asyncio.to_thread(audd.track_spool.stats),
+        "singleflight": identify_flights.stats(),
+    }), 200
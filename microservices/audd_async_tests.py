@@ -0,0 +1,133 @@
+import pytest
+import asyncio
+import os
+from unittest.mock import patch, AsyncMock
+import audd
+from audd_async import audd_async_app
+from audd import AUDIO_DIR
+from cache import ResultCache
+from spool import TrackSpool
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Quart test client setup."""
+    audd_async_app.config["TESTING"] = True
+    monkeypatch.setattr(audd, "result_cache", ResultCache(str(tmp_path / "cache.db")))  # fresh cache for every test
+    monkeypatch.setattr(audd, "track_spool", TrackSpool(str(tmp_path / "spool.db"), audd.send_tracks, interval=3600))
+    return audd_async_app.test_client()
+
+
+def post(client, json):
+    """Send a request to the async app from a synchronous test."""
+    async def send():
+        response = await client.post("/identify", json=json)
+        return response.status_code, await response.get_json()
+    return asyncio.run(send())
+
+
+# ================================================ HAPPY PATH =========================================================================
+
+@patch("audd_async.post_audd", new_callable=AsyncMock,
+       return_value=(200, {"status": "success", "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}}))
+def test_identify_success(mock_audd, client):
+    """Test successful song identification and track addition.
+
+    This test fakes the audd API call of the async service and checks the track is identified and queued for the
+    database.
+
+    asserts code 200, 'Track queued for database' and that the identified track is waiting in the spool
+    """
+    filename = "test_song.wav"
+    file_path = os.path.join(AUDIO_DIR, filename)
+    with open(file_path, "wb") as f:
+        f.write(os.urandom(10))
+
+    status, body = post(client, {"filename": filename})
+
+    os.remove(file_path)
+
+    assert status == 200
+    assert body["title"] == "good 4 u"
+    assert body["message"] == "Track queued for database"
+    assert audd.track_spool.stats()["depth"] == 1
+
+
+@patch("audd_async.post_audd", new_callable=AsyncMock)
+def test_identify_concurrent_identical(mock_audd, client):
+    """Test identical snippets identified at the same moment share one upstream call.
+
+    This test sends 8 requests for the same file at once to the async service with a faked audd API that takes 0.2
+    seconds to answer.
+
+    asserts every request gets the track, the audd API was called once and the track was queued once
+    """
+    async def slow_audd(filename, file_data):
+        await asyncio.sleep(0.2)
+        return 200, {"status": "success", "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}}
+
+    mock_audd.side_effect = slow_audd
+    filename = "test_song.wav"
+    file_path = os.path.join(AUDIO_DIR, filename)
+    with open(file_path, "wb") as f:
+        f.write(os.urandom(10))
+
+    async def send_all():
+        responses = await asyncio.gather(*(client.post("/identify", json={"filename": filename}) for _ in range(8)))
+        return [(response.status_code, await response.get_json()) for response in responses]
+
+    results = asyncio.run(send_all())
+    os.remove(file_path)
+
+    assert all(status == 200 and body["title"] == "good 4 u" for status, body in results)
+    assert mock_audd.await_count == 1
+    assert audd.track_spool.stats()["enqueued"] == 1
+
+
+def test_metrics(client):
+    """Test the Prometheus metrics endpoint of the async service.
+
+    This test sends a request for a missing file and checks /metrics reports it under the async service's prefix.
+
+    asserts code 200 and the request histogram for the 404
+    """
+    post(client, {"filename": "missing.wav"})
+
+    async def scrape():
+        response = await client.get("/metrics")
+        return response.status_code, await response.get_data(as_text=True)
+    status, text = asyncio.run(scrape())
+
+    assert status == 200
+    assert 'audd_async_request_seconds_count{route="/identify",method="POST",status="404"}' in text
+
+
+# ================================================ UNHAPPY PATHS =========================================================================
+
+def test_identify_file_not_found(client):
+    """Test identifying a non-existent file.
+
+    asserts response code to 404 as file not found and output to 'File not found'
+    """
+    status, body = post(client, {"filename": "not a track.wav"})
+    assert status == 404
+    assert body["error"] == "File not found"
+
+
+@patch("audd_async.post_audd", new_callable=AsyncMock, return_value=(500, None))
+def test_identify_api_failure(mock_audd, client):
+    """Test handling failure in external API.
+
+    asserts code to 500 and message to 'Failed to identify track'
+    """
+    filename = "test_song.wav"
+    file_path = os.path.join(AUDIO_DIR, filename)
+    with open(file_path, "wb") as f:
+        f.write(os.urandom(10))
+
+    status, body = post(client, {"filename": filename})
+
+    os.remove(file_path)
+
+    assert status == 500
+    assert body["error"] == "Failed to identify track"
@@ -0,0 +1,43 @@
+""" Local stand-in for the audd API and the database microservice, used for load testing
+
+Every recognition request waits STUB_LATENCY seconds (default 0.1), give or take up to STUB_JITTER seconds
+(default 0), to imitate the round trip to api.audd.io and then returns the same song. The database routes accept
+every track without storing anything.
+
+run with: uvicorn audd_stub:stub_app --port 9000
+then start the audd service with AUDD_URL=http://127.0.0.1:9000/ and DB_URL=http://127.0.0.1:9000
+"""
+import asyncio
+import os
+import random
+
+from quart import Quart, request, jsonify
+
+stub_app = Quart(__name__)
+
+STUB_LATENCY = float(os.environ.get("STUB_LATENCY", 0.1))  # seconds each fake recognition takes
+STUB_JITTER = float(os.environ.get("STUB_JITTER", 0))  # the latency varies by up to this many seconds either way
+
+
+@stub_app.route("/", methods=['POST'])
+async def recognise():
+    """ Fake audd API, expects a multipart upload with a 'file' field like api.audd.io """
+    files = await request.files
+    if 'file' not in files:
+        return jsonify({"status": "error", "error": {"error_message": "No file"}}), 400
+    await asyncio.sleep(max(0, STUB_LATENCY + random.uniform(-STUB_JITTER, STUB_JITTER)))
+    return jsonify({"status": "success", "result": {"artist": "Stub Artist", "title": "Stub Song"}}), 200
+
+
+@stub_app.route("/add_track", methods=['POST'])
+async def add_track():
+    """ Fake database route, accepts any track """
+    track = await request.get_json()
+    return jsonify({"message": "Track added!", "track": track}), 200
+
+
+@stub_app.route("/tracks/bulk", methods=['POST'])
+async def add_tracks_bulk():
+    """ Fake database route, accepts any list of tracks """
+    tracks = await request.get_json()
+    return jsonify({"results": [{**track, "status": "added"} for track in tracks], "added": len(tracks)}), 200
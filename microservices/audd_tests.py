@@ -1,27 +1,41 @@
 import pytest
 import os
+import threading
+import time
 import requests
+import sqlite3
 from unittest.mock import patch, MagicMock
+import numpy as np
+import audio
+import audd
 from audd import audd_app, AUDIO_DIR
+from cache import ResultCache
+from spool import TrackSpool
 
 @pytest.fixture
-def client():
+def client(tmp_path, monkeypatch):
     """Flask test client setup."""
     audd_app.config["TESTING"] = True
+    monkeypatch.setattr(audd, "result_cache", ResultCache(str(tmp_path / "cache.db")))  # fresh cache for every test
+    spool = TrackSpool(str(tmp_path / "spool.db"), audd.send_tracks, interval=3600)  # only flushed when a test asks
+    monkeypatch.setattr(spool, "start", lambda: None)  # the flusher's first flush would race the test's own
+    monkeypatch.setattr(audd, "track_spool", spool)
     client = audd_app.test_client()
     yield client  # Run tests
+    spool.stop(flush=False)
 
 
 # ================================================ HAPPY PATH =========================================================================
 
-@patch("requests.post")
+@patch("requests.Session.post")
 def test_identify_success(mock_post, client):
     """Test successful song identification and track addition.
 
     This test uses magic mock to fake the response from the audd API to test the the identify function works and 
-    successfully adds the track to the database after identifying it. 
+    successfully queues the track for the database after identifying it, then that flushing the spool adds it. 
 
-    It then asserts the response code and the output of the function with 200 and 'Track added to database' 
+    It then asserts the response code and the output of the function with 200 and 'Track queued for database',
+    and that the flush sent the track to the database's bulk endpoint 
     
     """
     
@@ -35,9 +49,9 @@ def test_identify_success(mock_post, client):
     mock_audd_response = MagicMock()
     mock_audd_response.status_code = 200
     mock_audd_response.json.return_value = {
-        "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}
+        "status": "success", "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}
     }
-    mock_post.side_effect = lambda url, data=None, files=None, json=None: (
+    mock_post.side_effect = lambda url, data=None, files=None, json=None, **kwargs: (
         mock_audd_response if "audd.io" in url else MagicMock(status_code=200)
     )
 
@@ -50,7 +64,280 @@ def test_identify_success(mock_post, client):
     assert response.status_code == 200
     assert response.json["artist"] == "Olivia Rodrigo"
     assert response.json["title"] == "good 4 u"
-    assert response.json["message"] == "Track added to database"
+    assert response.json["message"] == "Track queued for database"
+
+    assert audd.track_spool.flush() == 1
+    db_call = mock_post.call_args_list[-1]
+    assert db_call.args[0].endswith("/tracks/bulk")
+    assert db_call.kwargs["json"] == [{"artist": "Olivia Rodrigo", "title": "good 4 u"}]
+
+
+@patch("requests.Session.post")
+def test_identify_local_match(mock_post, client):
+    """Test identifying a snippet that is in the local fingerprint index.
+
+    This test uses a bundled snippet of a reference track so that it is matched locally, and checks that the audd API
+    is never called and only the database request is made.
+
+    asserts code 200, the identified track and that the source is 'local'
+    """
+    mock_post.return_value = MagicMock(status_code=200)
+
+    response = client.post("/identify", json={"filename": "_Blinding Lights.wav"})
+
+    assert response.status_code == 200
+    assert response.json["title"] == "Blinding Lights"
+    assert response.json["source"] == "local"
+    assert all("audd.io" not in call.args[0] for call in mock_post.call_args_list)
+
+
+def test_index_built_from_references_dir(monkeypatch, tmp_path):
+    """Test building the local fingerprint index when the audio directory is somewhere else.
+
+    This test points AUDIO_DIR, where the filenames sent to /identify are looked up, at an empty directory and checks
+    that the reference tracks are still read from beside references.json.
+
+    asserts every listed reference track is in the index
+    """
+    monkeypatch.setattr(audd, "AUDIO_DIR", str(tmp_path))
+    monkeypatch.setattr(audd, "_index", None)
+    assert len(audd.get_index()) == 4
+
+
+@patch("requests.Session.post")
+def test_identify_cached(mock_post, client):
+    """Test identifying the same snippet twice.
+
+    This test identifies a snippet once with a faked audd API response, then identifies a copy of it saved under a
+    different name, which should be answered from the result cache without any outbound request.
+
+    asserts the second response comes from the cache, says 'Track already identified' rather than that it was added
+    to the database, which the spool may not have done yet, and that no further requests were made
+    """
+    filename = "test_song.wav"
+    copy_name = "test_song_copy.wav"
+    data = os.urandom(10)
+    for name in (filename, copy_name):
+        with open(os.path.join(AUDIO_DIR, name), "wb") as f:
+            f.write(data)
+
+    mock_audd_response = MagicMock(status_code=200)
+    mock_audd_response.json.return_value = {"status": "success",
+                                            "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}}
+    mock_post.side_effect = lambda url, data=None, files=None, json=None, **kwargs: (
+        mock_audd_response if "audd.io" in url else MagicMock(status_code=200)
+    )
+
+    first = client.post("/identify", json={"filename": filename})
+    calls = mock_post.call_count
+    second = client.post("/identify", json={"filename": copy_name})
+
+    os.remove(os.path.join(AUDIO_DIR, filename))
+    os.remove(os.path.join(AUDIO_DIR, copy_name))
+
+    assert first.json["source"] == "audd"
+    assert second.status_code == 200
+    assert second.json["source"] == "cache"
+    assert second.json["title"] == "good 4 u"
+    assert second.json["message"] == "Track already identified"
+    assert mock_post.call_count == calls
+    assert client.get("/stats").json["cache"]["hits"] == 1
+
+
+@patch("requests.Session.post")
+def test_identify_batch(mock_post, client):
+    """Test identifying a batch of snippets.
+
+    This test identifies two files and one missing file in a batch, faking the audd API and the database's bulk
+    insert, and checks every file gets its own status and that all tracks go to the database in one request.
+
+    asserts code 200, each file's status and a single bulk database request
+    """
+    filenames = ["test_song_1.wav", "test_song_2.wav"]
+    for name in filenames:
+        with open(os.path.join(AUDIO_DIR, name), "wb") as f:
+            f.write(os.urandom(10))
+
+    mock_audd_response = MagicMock(status_code=200)
+    mock_audd_response.json.return_value = {"status": "success",
+                                            "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}}
+    mock_bulk_response = MagicMock(status_code=200)
+    mock_bulk_response.json.return_value = {"results": [{"status": "added"}, {"status": "exists"}]}
+    mock_post.side_effect = lambda url, data=None, files=None, json=None, **kwargs: (
+        mock_audd_response if "audd.io" in url else mock_bulk_response
+    )
+
+    response = client.post("/identify_batch", json={"filenames": filenames + ["not a track.wav"]})
+
+    for name in filenames:
+        os.remove(os.path.join(AUDIO_DIR, name))
+
+    assert response.status_code == 200
+    assert [r["status"] for r in response.json["results"]] == ["added", "exists", "not_found"]
+    assert response.json["summary"] == {"added": 1, "exists": 1, "not_found": 1}
+    db_calls = [call for call in mock_post.call_args_list if "audd.io" not in call.args[0]]
+    assert len(db_calls) == 1
+    assert db_calls[0].args[0].endswith("/tracks/bulk")
+
+
+@patch("requests.Session.post")
+def test_identify_batch_concurrent(mock_post, client):
+    """Test that a batch is sent to the audd API concurrently.
+
+    This test fakes an audd API that takes 0.2 seconds per request and identifies 8 files, which would take at
+    least 1.6 seconds if they were sent one after another.
+
+    asserts the batch finishes in well under the sequential time
+    """
+    filenames = [f"test_song_{i}.wav" for i in range(8)]
+    for name in filenames:
+        with open(os.path.join(AUDIO_DIR, name), "wb") as f:
+            f.write(os.urandom(10))
+
+    def slow_post(url, data=None, files=None, json=None, **kwargs):
+        if "audd.io" in url:
+            time.sleep(0.2)
+            response = MagicMock(status_code=200)
+            response.json.return_value = {"status": "success",
+                                          "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}}
+            return response
+        response = MagicMock(status_code=200)
+        response.json.return_value = {"results": [{"status": "added"} for _ in json]}
+        return response
+
+    mock_post.side_effect = slow_post
+
+    start = time.perf_counter()
+    response = client.post("/identify_batch", json={"glob": "test_song_*.wav"})
+    elapsed = time.perf_counter() - start
+
+    for name in filenames:
+        os.remove(os.path.join(AUDIO_DIR, name))
+
+    assert response.status_code == 200
+    assert response.json["summary"] == {"added": 8}
+    assert elapsed < 1.0
+
+
+@patch("requests.Session.post")
+def test_identify_concurrent_identical(mock_post, client):
+    """Test identical snippets identified at the same moment share one upstream call.
+
+    This test fires 8 requests for the same file at once against a faked audd API that takes 0.3 seconds to answer,
+    so they all arrive while the first is still being identified.
+
+    asserts every request gets the track, exactly one call was made to the audd API, the track was queued for the
+    database once, and the coalesced requests are counted in /stats
+    """
+    filename = "test_song.wav"
+    with open(os.path.join(AUDIO_DIR, filename), "wb") as f:
+        f.write(os.urandom(10))
+
+    audd_calls = []
+
+    def slow_audd(url, data=None, files=None, json=None, **kwargs):
+        if "audd.io" in url:
+            audd_calls.append(url)
+            time.sleep(0.3)
+        response = MagicMock(status_code=200)
+        response.json.return_value = {"status": "success",
+                                      "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}}
+        return response
+
+    mock_post.side_effect = slow_audd
+    barrier = threading.Barrier(8)
+    responses = []
+
+    def send():
+        barrier.wait()  # release every request at the same moment
+        responses.append(audd_app.test_client().post("/identify", json={"filename": filename}))
+
+    threads = [threading.Thread(target=send) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    os.remove(os.path.join(AUDIO_DIR, filename))
+
+    assert [r.status_code for r in responses] == [200] * 8
+    assert all(r.json["title"] == "good 4 u" for r in responses)
+    assert len(audd_calls) == 1
+    stats = client.get("/stats").json
+    assert stats["spool"]["enqueued"] == 1
+    assert stats["singleflight"]["coalesced"] >= 1
+
+
+@patch("requests.Session.post")
+def test_identify_upload(mock_post, client):
+    """Test identifying a WAV sent in the request body.
+
+    This test uploads a bundled snippet as a raw audio/wav body instead of giving a filename, and checks it is decoded
+    and matched locally.
+
+    asserts code 200 and the identified track
+    """
+    mock_post.return_value = MagicMock(status_code=200)
+
+    with open(os.path.join(AUDIO_DIR, "_Blinding Lights.wav"), "rb") as f:
+        response = client.post("/identify", data=f.read(), content_type="audio/wav")
+
+    assert response.status_code == 200
+    assert response.json["title"] == "Blinding Lights"
+    assert response.json["source"] == "local"
+
+
+@patch("requests.Session.post")
+def test_identify_upload_trimmed(mock_post, client):
+    """Test a streamed upload is trimmed before it is sent to the audd API.
+
+    This test uploads a snippet that is not in the local index and checks that what is sent upstream is the
+    resampled clip, no longer than the streaming window.
+
+    asserts code 200 and the size of the uploaded file
+    """
+    mock_audd_response = MagicMock(status_code=200)
+    mock_audd_response.json.return_value = {"status": "success",
+                                            "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}}
+    mock_post.side_effect = lambda url, data=None, files=None, json=None, **kwargs: (
+        mock_audd_response if "audd.io" in url else MagicMock(status_code=200)
+    )
+
+    with open(os.path.join(AUDIO_DIR, "_good 4 u.wav"), "rb") as f:
+        original = f.read()
+    response = client.post("/identify", data=original, content_type="audio/wav")
+
+    uploaded = next(call.kwargs["files"]["file"][1] for call in mock_post.call_args_list if "audd.io" in call.args[0])
+    assert response.status_code == 200
+    assert len(uploaded) < len(original) / 2  # 48 kHz resampled to 16 kHz
+    assert len(uploaded) <= audd.CLIP_SAMPLE_RATE * audd.CLIP_MAX_SECONDS * 2 + 44
+    assert response.json["preprocess"]["bytes_saved"] == len(original) - len(uploaded)
+
+
+@patch("requests.Session.post")
+def test_metrics(mock_post, client):
+    """Test the Prometheus metrics endpoint.
+
+    This test identifies a snippet with a mocked audd API and checks that /metrics reports the request by route,
+    the time spent in each stage of the identification and the counters that /stats reports.
+
+    asserts code 200, the request histogram, the file read and upstream stage histograms and the spool depth gauge
+    """
+    mock_post.return_value = MagicMock(status_code=200, json=MagicMock(return_value={
+        "status": "success", "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}}))
+    filename = "test_metrics.wav"
+    with open(os.path.join(AUDIO_DIR, filename), "wb") as f:
+        f.write(os.urandom(10))
+    before = audd.STAGE_SECONDS.count("upstream")
+    client.post("/identify", json={"filename": filename})
+    os.remove(os.path.join(AUDIO_DIR, filename))
+
+    response = client.get("/metrics")
+    text = response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert 'audd_request_seconds_count{route="/identify",method="POST",status="200"}' in text
+    assert 'audd_stage_seconds_count{stage="file_read"}' in text
+    assert audd.STAGE_SECONDS.count("upstream") == before + 1
+    assert "audd_spool_depth 1" in text
 
 
 # ================================================ UNHAPPY PATHS =========================================================================
@@ -83,7 +370,7 @@ def test_identify_file_not_found(client):
     assert response.json["error"] == "File not found"
 
 
-@patch("requests.post")
+@patch("requests.Session.post")
 def test_identify_api_failure(mock_post, client):
     """Test handling failure in external API.
     
@@ -109,3 +396,142 @@ def test_identify_api_failure(mock_post, client):
     assert response.status_code == 500
     assert response.json["error"] == "Failed to identify track"
 
+
+@patch("requests.Session.post")
+def test_identify_api_error_body(mock_post, client):
+    """Test an error the audd API reports with status code 200.
+
+    audd answers a bad token or an exceeded limit with 200 and {"status": "error"}. This test checks that is treated
+    as a failed identification, not as a song that was not recognised, so nothing is cached or queued.
+
+    asserts code 500, 'Failed to identify track', an upstream error counted and nothing in the cache or the spool
+    """
+    filename = "test_song.wav"
+    file_path = os.path.join(AUDIO_DIR, filename)
+    with open(file_path, "wb") as f:
+        f.write(os.urandom(10))
+    mock_post.return_value = MagicMock(status_code=200, json=MagicMock(return_value={
+        "status": "error", "error": {"error_code": 901, "error_message": "Recognition limit reached"}}))
+    errors = audd.UPSTREAM_ERRORS.value("audd")
+
+    response = client.post("/identify", json={"filename": filename})
+    os.remove(file_path)
+
+    assert response.status_code == 500
+    assert response.json["error"] == "Failed to identify track"
+    assert audd.UPSTREAM_ERRORS.value("audd") == errors + 1
+    stats = client.get("/stats").json
+    assert (stats["cache"]["entries"], stats["spool"]["depth"]) == (0, 0)
+
+
+@patch("requests.Session.post")
+def test_identify_database_down(mock_post, client):
+    """Test identifying while the database service is down.
+
+    This test fakes a working audd API and a database that refuses connections, and checks the identification still
+    succeeds with the track left in the spool until the database is back.
+
+    asserts code 200 and 'Track queued for database', the spool depth in /stats, and the track sent after recovery
+    """
+    filename = "test_song.wav"
+    file_path = os.path.join(AUDIO_DIR, filename)
+    with open(file_path, "wb") as f:
+        f.write(os.urandom(10))
+
+    mock_audd_response = MagicMock(status_code=200)
+    mock_audd_response.json.return_value = {"status": "success",
+                                            "result": {"artist": "Olivia Rodrigo", "title": "good 4 u"}}
+
+    def database_down(url, data=None, files=None, json=None, **kwargs):
+        if "audd.io" in url:
+            return mock_audd_response
+        raise requests.ConnectionError("Connection refused")
+
+    mock_post.side_effect = database_down
+    response = client.post("/identify", json={"filename": filename})
+    os.remove(file_path)
+
+    assert response.status_code == 200
+    assert response.json["message"] == "Track queued for database"
+    assert audd.track_spool.flush() == 0
+    spool_stats = client.get("/stats").json["spool"]
+    assert spool_stats["depth"] == 1
+    assert spool_stats["flush_failures"] == 1
+
+    mock_post.side_effect = lambda url, **kwargs: MagicMock(status_code=200)  # the database is back
+    assert audd.track_spool.flush() == 1
+    assert client.get("/stats").json["spool"]["depth"] == 0
+
+
+@patch("requests.Session.post")
+def test_identify_missing_api_key(mock_post, client, monkeypatch):
+    """Test identifying a song that needs the audd API when no API key has been given.
+
+    This test removes the API key, which is only looked for once the audd API is needed, and checks that a song
+    that is not in the cache or the local index gets an error without any call to the audd API.
+
+    asserts code 500, the missing key error and that nothing was sent
+    """
+    monkeypatch.setattr(audd, "API", None)
+    monkeypatch.setattr(audd, "load_dotenv", lambda: None)
+    monkeypatch.delenv("API_KEY", raising=False)
+    filename = "test_no_key.wav"
+    with open(os.path.join(AUDIO_DIR, filename), "wb") as f:
+        f.write(os.urandom(10))
+
+    response = client.post("/identify", json={"filename": filename})
+    os.remove(os.path.join(AUDIO_DIR, filename))
+
+    assert response.status_code == 500
+    assert response.json["error"] == "No AUDD API key given"
+    assert not mock_post.called
+
+
+def test_identify_batch_cache_error(client, monkeypatch):
+    """Test a batch when the result cache cannot be read.
+
+    This test makes every cache lookup fail as a locked SQLite file would, and checks the batch still answers with
+    a status for every file instead of failing as a whole.
+
+    asserts code 200 and a 'failed' status with the cache error for the file
+    """
+    def locked(key):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(audd.result_cache, "get", locked)
+
+    response = client.post("/identify_batch", json={"filenames": ["_Blinding Lights.wav"]})
+
+    assert response.status_code == 200
+    assert response.json["results"][0]["status"] == "failed"
+    assert "database is locked" in response.json["results"][0]["error"]
+
+
+def test_identify_batch_no_files(client):
+    """Test a batch request without filenames or a glob.
+
+    asserts code 400 and message 'No filenames or glob provided'
+    """
+    response = client.post("/identify_batch", json={})
+    assert response.status_code == 400
+    assert response.json["error"] == "No filenames or glob provided"
+
+
+def test_identify_upload_invalid(client):
+    """Test uploading a body that is not a WAV file.
+
+    asserts code 400 and an 'Invalid audio' error
+    """
+    response = client.post("/identify", data=os.urandom(100), content_type="audio/wav")
+    assert response.status_code == 400
+    assert response.json["error"].startswith("Invalid audio")
+
+
+def test_identify_upload_zero_rate(client):
+    """Test uploading a WAV whose header gives a sample rate of 0.
+
+    asserts code 400 and an 'Invalid audio' error naming the sample rate, rather than a crash
+    """
+    body = audio.encode_wav(np.zeros(1000, dtype=np.float32), 0)
+    response = client.post("/identify", data=body, content_type="audio/wav")
+    assert response.status_code == 400
+    assert "sample rate" in response.json["error"]
@@ -0,0 +1,193 @@
+import struct
+import time
+
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+CHUNK_FRAMES = 8192  # frames decoded at a time when reading a stream
+MIN_RATE = 4000  # sample rates a WAV header may give, anything outside is a broken or hostile file
+MAX_RATE = 384000
+
+
+def _read_exactly(stream, size):
+    """ Function reads size bytes from a stream that may return short reads, raises ValueError if it ends early """
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ValueError("Unexpected end of audio stream")
+        data += chunk
+    return data
+
+
+def _skip(stream, size):
+    """ Function discards size bytes from a stream without holding them all in memory """
+    while size > 0:
+        chunk = stream.read(min(size, 1 << 16))
+        if not chunk:
+            raise ValueError("Unexpected end of audio stream")
+        size -= len(chunk)
+
+
+def read_header(stream):
+    """ Function reads a WAV header from the start of a stream, leaving the stream at the first sample
+
+    returns {"format", "channels", "rate", "bits", "block_align", "data_size"}, data_size is None when the header does
+    not give a usable length (streamed WAVs often leave it as 0 or 0xFFFFFFFF), raises ValueError if the stream is
+    not a WAV that can be decoded
+    """
+    riff = _read_exactly(stream, 12)
+    if riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise ValueError("Not a WAV file")
+
+    fmt = None
+    while True:
+        chunk_id, size = struct.unpack('<4sI', _read_exactly(stream, 8))
+        if chunk_id == b'fmt ':
+            body = _read_exactly(stream, size + size % 2)  # chunks are padded to an even length
+            if size < 16:
+                raise ValueError("Invalid WAV format chunk")
+            format_tag, channels, rate, _, block_align, bits = struct.unpack('<HHIIHH', body[:16])
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and size >= 40:
+                format_tag = struct.unpack('<H', body[24:26])[0]  # the real format is the start of the sub format GUID
+            fmt = {"format": format_tag, "channels": channels, "rate": rate, "bits": bits, "block_align": block_align}
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError("WAV data before format chunk")
+            fmt["data_size"] = size if 0 < size < 0xFFFFFFFF else None
+            break
+        else:
+            _skip(stream, size + size % 2)  # LIST, fact, bext and other metadata chunks are not needed
+
+    if fmt["format"] == WAVE_FORMAT_PCM and fmt["bits"] not in (8, 16, 24, 32):
+        raise ValueError(f"Unsupported PCM sample size: {fmt['bits']} bits")
+    if fmt["format"] == WAVE_FORMAT_IEEE_FLOAT and fmt["bits"] not in (32, 64):
+        raise ValueError(f"Unsupported float sample size: {fmt['bits']} bits")
+    if fmt["format"] not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+        raise ValueError(f"Unsupported WAV encoding: {fmt['format']:#x}")
+    if fmt["channels"] < 1 or fmt["block_align"] != fmt["channels"] * fmt["bits"] // 8:
+        raise ValueError("Invalid WAV channel layout")
+    if not MIN_RATE <= fmt["rate"] <= MAX_RATE:  # a tiny rate would be upsampled into millions of samples per chunk
+        raise ValueError(f"Unsupported sample rate: {fmt['rate']} Hz")
+    return fmt
+
+
+def decode_frames(data, fmt):
+    """ Function converts raw sample bytes into mono float32 samples in the range -1..1 """
+    bits = fmt["bits"]
+    if fmt["format"] == WAVE_FORMAT_IEEE_FLOAT:
+        samples = np.frombuffer(data, dtype='<f4' if bits == 32 else '<f8').astype(np.float32)
+    elif bits == 8:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) / 128  # 8 bit WAV is unsigned
+    elif bits == 16:
+        samples = np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768
+    elif bits == 24:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        ints = (raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) | (raw[:, 2].astype(np.int32) << 16))
+        samples = ((ints << 8) >> 8).astype(np.float32) / 8388608  # shift up and back down to sign extend
+    else:
+        samples = np.frombuffer(data, dtype='<i4').astype(np.float32) / 2147483648
+
+    channels = fmt["channels"]
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)  # downmix to mono
+    return samples
+
+
+class StreamResampler:
+    """ Resamples audio that arrives in chunks, carrying state between chunks so the output has no seams
+
+    whole number ratios (48 kHz to 16 kHz) average each block of input samples, which also filters out the
+    frequencies that would alias, other ratios use linear interpolation
+    """
+
+    def __init__(self, rate, target_rate):
+        self.step = rate / target_rate
+        self.factor = int(self.step) if self.step == int(self.step) else None
+        self._pending = np.zeros(0, dtype=np.float32)  # input not yet turned into output
+        self._position = 0.0  # position of the next output sample, relative to the start of _pending
+
+    def process(self, samples, max_output=None):
+        """ Function takes the next chunk of input samples and returns the output samples that are now complete, at
+        most max_output of them when it is given, the rest of the chunk is then dropped
+        """
+        samples = np.concatenate([self._pending, samples])
+        if self.factor == 1:
+            self._pending = samples[:0]
+            return samples
+        if self.factor is not None:
+            usable = len(samples) - len(samples) % self.factor
+            self._pending = samples[usable:]
+            return samples[:usable].reshape(-1, self.factor).mean(axis=1)
+
+        end = len(samples) - 1  # each output needs the input after it
+        if max_output is not None:
+            end = min(end, self._position + max_output * self.step)
+        positions = np.arange(self._position, end, self.step)[:max_output]
+        out = np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+        next_position = positions[-1] + self.step if len(positions) else self._position
+        keep = min(int(next_position), len(samples))  # the next output may be past the end of this chunk
+        self._pending = samples[keep:]
+        self._position = next_position - keep
+        return out
+
+
+def read_stream(stream, target_rate=None, max_seconds=None, chunk_frames=CHUNK_FRAMES, timings=None):
+    """ Function decodes a WAV from a stream a chunk at a time, downmixing to mono and resampling to target_rate
+    (the file's own rate when None)
+
+    reading stops once max_seconds of audio has been decoded, so memory use depends on max_seconds and not on how
+    long the uploaded file is. When a timings dict is given the seconds spent decoding and resampling are added to
+    its "decode" and "resample" entries. Returns (mono float32 samples, sample rate)
+    """
+    start = time.perf_counter()
+    fmt = read_header(stream)
+    target_rate = target_rate or fmt["rate"]
+    resampler = StreamResampler(fmt["rate"], target_rate)
+    limit = int(target_rate * max_seconds) if max_seconds else None
+    chunks = []
+    filled = 0
+    remaining = fmt["data_size"]
+    leftover = b''  # partial frame carried over when the stream returns a read that splits a frame
+    resample_time = 0.0
+
+    while (limit is None or filled < limit) and (remaining is None or remaining > 0):
+        size = chunk_frames * fmt["block_align"]
+        if remaining is not None:
+            size = min(size, remaining)
+        data = stream.read(size)
+        if not data:
+            break  # streamed WAVs without a length end when the body ends
+        if remaining is not None:
+            remaining -= len(data)
+
+        data = leftover + data
+        usable = len(data) - len(data) % fmt["block_align"]
+        leftover = data[usable:]
+        decoded = decode_frames(data[:usable], fmt)
+        resample_start = time.perf_counter()
+        samples = resampler.process(decoded, None if limit is None else limit - filled)
+        resample_time += time.perf_counter() - resample_start
+        if limit is not None:
+            samples = samples[:limit - filled]
+        chunks.append(samples)
+        filled += len(samples)
+
+    if filled == 0:
+        raise ValueError("WAV file has no audio")
+    if timings is not None:
+        decode_time = time.perf_counter() - start - resample_time  # reading and decoding is everything but resampling
+        timings["decode"] = timings.get("decode", 0.0) + decode_time
+        timings["resample"] = timings.get("resample", 0.0) + resample_time
+    return np.concatenate(chunks), target_rate
+
+
+def encode_wav(samples, rate):
+    """ Function encodes mono float samples as a 16 bit PCM WAV file, returns the bytes """
+    pcm = np.round(np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes()
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(pcm), b'WAVE', b'fmt ', 16, WAVE_FORMAT_PCM,
+                         1, rate, rate * 2, 2, 16, b'data', len(pcm))
+    return header + pcm
@@ -0,0 +1,153 @@
+import pytest
+import io
+import os
+import struct
+import numpy as np
+import audio
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def make_wav(samples, rate=48000, channels=1, bits=16, data_size=None):
+    """Build WAV bytes from integer samples, data_size overrides the length written in the header."""
+    dtype = {8: np.uint8, 16: '<i2', 32: '<i4'}[bits]
+    data = np.asarray(samples).astype(dtype).tobytes()
+    block_align = channels * bits // 8
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(data), b'WAVE', b'fmt ', 16, 1, channels, rate,
+                         rate * block_align, block_align, bits, b'data', len(data) if data_size is None else data_size)
+    return header + data
+
+
+class EndlessWav(io.RawIOBase):
+    """Stream of a WAV header followed by silence that never ends, counting the bytes read from it."""
+
+    def __init__(self):
+        self.header = make_wav([], data_size=0xFFFFFFFF)
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        header = self.header[self.bytes_read:self.bytes_read + size]
+        buffer[:len(header)] = header
+        buffer[len(header):size] = bytes(size - len(header))
+        self.bytes_read += size
+        return size
+
+
+# ============================================= HAPPY PATHS ======================================================================
+
+def test_read_header():
+    """Test reading the header of a bundled snippet
+    
+    asserts the format, channels, rate and sample size
+    """
+    with open(os.path.join(BASE_DIR, "_good 4 u.wav"), "rb") as f:
+        fmt = audio.read_header(f)
+    assert (fmt["format"], fmt["channels"], fmt["rate"], fmt["bits"]) == (audio.WAVE_FORMAT_PCM, 1, 48000, 16)
+
+
+def test_read_extensible_header():
+    """Test reading a WAVE_FORMAT_EXTENSIBLE header
+    
+    ensures the Davos snippet, which the wave module cannot open, is read as plain PCM 
+
+    asserts the format is PCM
+    """
+    with open(os.path.join(BASE_DIR, "_Davos.wav"), "rb") as f:
+        assert audio.read_header(f)["format"] == audio.WAVE_FORMAT_PCM
+
+
+def test_downmix_and_resample():
+    """Test stereo 48 kHz audio is turned into mono 16 kHz audio
+    
+    asserts one output sample for every three input frames, holding the average of the two channels
+    """
+    stereo = np.tile([1000, 3000], 4800)  # 4800 frames of left 1000, right 3000
+    samples, rate = audio.read_stream(io.BytesIO(make_wav(stereo, channels=2)), 16000, 10)
+    assert len(samples) == 1600
+    assert np.allclose(samples, 2000 / 32768)
+
+
+def test_chunked_resample_matches_whole():
+    """Test resampling in small chunks gives the same audio as resampling in one go
+    
+    asserts the outputs match for a ratio that is not a whole number
+    """
+    with open(os.path.join(BASE_DIR, "_good 4 u.wav"), "rb") as f:
+        chunked, _ = audio.read_stream(f, 11025, 60, chunk_frames=777)
+    with open(os.path.join(BASE_DIR, "_good 4 u.wav"), "rb") as f:
+        whole, _ = audio.read_stream(f, 11025, 60, chunk_frames=10 ** 7)
+    assert len(chunked) == len(whole)
+    assert np.allclose(chunked, whole, atol=1e-6)
+
+
+def test_stream_reads_bounded():
+    """Test a stream is only read up to the maximum duration
+    
+    ensures an upload that never ends is cut off once max_seconds of audio has been read 
+
+    asserts 2 seconds of audio is returned and only about 2 seconds of input was read
+    """
+    stream = EndlessWav()
+    samples, _ = audio.read_stream(stream, 16000, 2)
+    assert len(samples) == 32000
+    assert stream.bytes_read < 48000 * 2 * 2 + audio.CHUNK_FRAMES * 2 + 100
+
+
+def test_encode_round_trip():
+    """Test encoding samples as a WAV and reading them back
+    
+    asserts the decoded samples match the originals
+    """
+    samples = np.linspace(-0.5, 0.5, 1000).astype(np.float32)
+    decoded, rate = audio.read_stream(io.BytesIO(audio.encode_wav(samples, 16000)))
+    assert rate == 16000
+    assert np.allclose(decoded, samples, atol=2 / 32768)
+
+
+# ============================================= UNHAPPY PATHS ===================================================================
+
+def test_not_a_wav():
+    """Test reading something that is not a WAV
+    
+    asserts ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        audio.read_stream(io.BytesIO(os.urandom(100)), 16000, 10)
+
+
+def test_truncated_header():
+    """Test reading a WAV that ends in the middle of its header
+    
+    asserts ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        audio.read_stream(io.BytesIO(make_wav([0] * 10)[:30]), 16000, 10)
+
+
+@pytest.mark.parametrize("rate", [0, 1, 50, 1_000_000])
+def test_unsupported_rate(rate):
+    """Test reading a WAV whose header gives a sample rate no real recording has
+    
+    ensures that a zero or tiny rate, which would divide by zero or be upsampled into hundreds of millions of
+    samples, is rejected before any audio is decoded 
+
+    asserts ValueError naming the sample rate
+    """
+    with pytest.raises(ValueError, match="sample rate"):
+        audio.read_stream(io.BytesIO(make_wav([0] * 1000, rate=rate)), 16000, 10)
+
+
+def test_resampler_output_capped():
+    """Test the resampler makes no more output than it is asked for
+    
+    ensures that upsampling a chunk stops at max_output samples, so the output of one chunk is bounded by what the
+    clip still needs rather than by the ratio of the rates 
+
+    asserts 100 samples from a chunk that would upsample to 32768
+    """
+    resampler = audio.StreamResampler(4000, 16000 * 1.1)
+    assert len(resampler.process(np.zeros(8192, dtype=np.float32), max_output=100)) == 100
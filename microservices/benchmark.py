@@ -0,0 +1,262 @@
+""" End to end benchmark of both microservices under a production WSGI server
+
+Starts the local audd API stub (audd_stub.py), the db service and the audd service, both under gunicorn as serve.py
+runs them, with a scratch database, cache and spool, then sends a fixed mix of requests with a set number in flight:
+
+identify - the bundled WAV files, which after the first request are answered from the cache or the local
+           fingerprint index, and a share of freshly generated noise clips that miss both and go to the stub
+list     - a page of /tracks starting from a random id
+add      - a new track
+remove   - one of the tracks the database was seeded with
+
+The mix is drawn from a seeded random generator, so two runs with the same options send the same requests. Reports
+throughput, p50/p95/p99 latency and the error rate for each kind of request and overall, and writes them to JSON
+with the commit they were measured on. Pass an earlier JSON file to --compare to see what changed.
+
+usage: python benchmark.py [--requests 2000] [--concurrency 32] [--workers 2] [--threads 8] [--latency 0.1]
+                           [--json results.json] [--compare baseline.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import aiohttp
+import numpy as np
+
+from loadtest import free_port, start_server, stop_server, percentile
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+OPERATIONS = ("identify", "list", "add", "remove")
+NOISE_SECONDS = 2  # length of the generated clips that the local index cannot match
+NOISE_RATE = 16000
+
+
+def serve(module, prefix, args):
+    """ Function returns the command that runs a service the way it is run in production (serve.py), with gunicorn's
+    threaded workers
+    """
+    return ["env", f"{prefix}_PORT={{port}}", f"{prefix}_WORKERS={args.workers}", f"{prefix}_THREADS={args.threads}",
+            sys.executable, os.path.join(BASE_DIR, module)]
+
+
+def write_noise(path, rng):
+    """ Function writes a WAV of random noise, which does not match any reference track """
+    samples = rng.integers(-8000, 8000, NOISE_SECONDS * NOISE_RATE, dtype=np.int16)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(NOISE_RATE)
+        f.writeframes(samples.tobytes())
+
+
+def plan_requests(args, bundled, audio_dir):
+    """ Function draws the requests of the run from a seeded generator, returns a list of (operation, payload) and
+    writes the noise clips the identify requests will use
+    """
+    rng = random.Random(args.seed)
+    noise_rng = np.random.default_rng(args.seed)
+    weights = [args.identify, args.list, args.add, args.remove]
+    plan = []
+    removed = 0
+    for i in range(args.requests):
+        operation = rng.choices(OPERATIONS, weights)[0]
+        if operation == "identify":
+            if rng.random() < args.unique:
+                filename = f"noise_{i}.wav"
+                write_noise(os.path.join(audio_dir, filename), noise_rng)
+            else:
+                filename = rng.choice(bundled)
+            plan.append((operation, {"filename": filename}))
+        elif operation == "list":
+            plan.append((operation, {"after_id": rng.randrange(args.tracks), "limit": 100}))
+        elif operation == "add":
+            plan.append((operation, {"title": f"bench song {i}", "artist": f"bench artist {rng.randrange(100)}"}))
+        else:
+            plan.append((operation, {"title": f"seed song {removed}", "artist": "seed artist"}))
+            removed += 1  # every remove is of a different seeded track, so none of them should 404
+    return plan
+
+
+async def seed_database(db_port, count):
+    """ Function adds count tracks to the database with one NDJSON import """
+    body = "".join(json.dumps({"title": f"seed song {i}", "artist": "seed artist"}) + "\n" for i in range(count))
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"http://127.0.0.1:{db_port}/tracks/bulk", data=body.encode(),
+                                headers={"Content-Type": "application/x-ndjson"}) as response:
+            report = await response.json()
+            if response.status != 200 or report["added"] != count:
+                raise RuntimeError(f"seeding the database failed: {response.status} {report}")
+
+
+async def drive(plan, audd_port, db_port, concurrency):
+    """ Function sends the planned requests with at most concurrency in flight, returns the elapsed seconds and a
+    list of (operation, seconds, ok) for every request
+    """
+    audd_base = f"http://127.0.0.1:{audd_port}"
+    db_base = f"http://127.0.0.1:{db_port}"
+    samples = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(session, operation, payload):
+        if operation == "identify":
+            return await session.post(audd_base + "/identify", json=payload)
+        if operation == "list":
+            return await session.get(db_base + "/tracks", params=payload)
+        if operation == "add":
+            return await session.post(db_base + "/add_track", json=payload)
+        return await session.post(db_base + "/remove_track", json=payload)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async def one(operation, payload):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with await send(session, operation, payload) as response:
+                        await response.read()
+                        ok = response.status < 400
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    ok = False
+                samples.append((operation, time.perf_counter() - start, ok))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(operation, payload) for operation, payload in plan))
+        elapsed = time.perf_counter() - start
+    return elapsed, samples
+
+
+def summarise(samples, elapsed):
+    """ Function returns the throughput, latency percentiles and error rate of a list of (operation, seconds, ok) """
+    latencies = [seconds for _, seconds, _ in samples]
+    errors = sum(not ok for _, _, ok in samples)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4),
+        "rps": round(len(samples) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def git_commit():
+    """ Function returns the commit being benchmarked and whether the working tree has changes, None outside git """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, check=True)
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BASE_DIR,
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.stdout.strip(), bool(status.stdout.strip())
+
+
+def run(args):
+    """ Function starts the stub and both services, runs the warm up and the measured requests, returns the results """
+    with tempfile.TemporaryDirectory() as work_dir:
+        bundled = sorted(name for name in os.listdir(BASE_DIR) if name.endswith(".wav"))
+        for name in bundled:
+            shutil.copy(os.path.join(BASE_DIR, name), work_dir)  # the audd service reads files from its cwd
+        plan = plan_requests(args, bundled, work_dir)
+        removes = sum(operation == "remove" for operation, _ in plan)
+        args.tracks = max(args.tracks, removes)
+
+        stub_port, db_port, audd_port = free_port(), free_port(), free_port()
+        env = dict(os.environ,
+                   PYTHONPATH=BASE_DIR,
+                   API_KEY=os.environ.get("API_KEY", "benchmark"),
+                   STUB_LATENCY=str(args.latency),
+                   STUB_JITTER=str(args.jitter),
+                   DB_PATH=os.path.join(work_dir, "shamzam.db"),
+                   AUDD_URL=f"http://127.0.0.1:{stub_port}/",
+                   DB_URL=f"http://127.0.0.1:{db_port}",
+                   IDENTIFY_CACHE_PATH=os.path.join(work_dir, "cache.db"),
+                   TRACK_SPOOL_PATH=os.path.join(work_dir, "spool.db"))
+        servers = []
+        try:
+            servers.append(start_server([sys.executable, "-m", "uvicorn", "audd_stub:stub_app", "--log-level",
+                                         "warning", "--port"], stub_port, BASE_DIR, env, "/"))
+            servers.append(start_server(serve("db.py", "DB", args), db_port, work_dir, env, "/tracks?limit=1"))
+            servers.append(start_server(serve("audd.py", "AUDD", args), audd_port, work_dir, env, "/stats"))
+
+            asyncio.run(seed_database(db_port, args.tracks))
+            warm_up = [("identify", {"filename": name}) for name in bundled] + [("list", {"limit": 100})] * args.concurrency
+            asyncio.run(drive(warm_up, audd_port, db_port, args.concurrency))  # connections, threads and the index
+
+            elapsed, samples = asyncio.run(drive(plan, audd_port, db_port, args.concurrency))
+        finally:
+            for server in reversed(servers):
+                stop_server(server)
+
+    results = {"all": summarise(samples, elapsed)}
+    for operation in OPERATIONS:
+        done = [sample for sample in samples if sample[0] == operation]
+        if done:
+            results[operation] = summarise(done, elapsed)
+    return results
+
+
+def compare(results, baseline):
+    """ Function prints how throughput, p95 latency and error rate changed from an earlier run """
+    print(f"\ncompared with {baseline.get('commit') or 'baseline'}")
+    print(f"{'':<10} {'rps':>16} {'p95 ms':>16} {'error rate':>18}")
+    for name, r in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+
+        def change(key):
+            if not before[key]:
+                return f"{r[key]}"
+            return f"{r[key]} ({(r[key] - before[key]) / before[key]:+.0%})"
+        print(f"{name:<10} {change('rps'):>16} {change('p95_ms'):>16} {r['error_rate']:>8} (was {before['error_rate']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark both services under gunicorn with a local audd API stub")
+    parser.add_argument("--requests", type=int, default=2000, help="measured requests")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests kept in flight")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes per service")
+    parser.add_argument("--threads", type=int, default=8, help="threads per gunicorn worker")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds the stub audd API takes per request")
+    parser.add_argument("--jitter", type=float, default=0.02, help="seconds the stub latency varies by either way")
+    parser.add_argument("--tracks", type=int, default=10000, help="tracks in the database before the run")
+    parser.add_argument("--identify", type=float, default=0.4, help="weight of identify requests in the mix")
+    parser.add_argument("--list", type=float, default=0.3, help="weight of /tracks requests in the mix")
+    parser.add_argument("--add", type=float, default=0.2, help="weight of /add_track requests in the mix")
+    parser.add_argument("--remove", type=float, default=0.1, help="weight of /remove_track requests in the mix")
+    parser.add_argument("--unique", type=float, default=0.5, help="fraction of identifies sent a new noise clip")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the request mix")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="an earlier --json file to compare the results with")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print(f"{'':<10} {'requests':>9} {'errors':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['requests']:>9} {r['errors']:>7} {r['rps']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    if args.json:
+        commit, dirty = git_commit()
+        with open(args.json, "w") as f:
+            json.dump({"commit": commit, "dirty": dirty, "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                       "python": platform.python_version(), "cpus": os.cpu_count(), "options": vars(args),
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+def hash_file(file_path, chunk_size=1 << 16):
+    """ Function returns the sha256 hex digest of a file's contents, read in chunks so large files are not loaded whole """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """ Persistent cache of identification results keyed by a hash of the audio content
+
+    entries are stored in a SQLite file so they survive restarts, the least recently used entries are evicted once
+    there are more than max_entries, and entries expire after ttl seconds. Results for songs that could not be
+    recognised ("Unknown") are cached too, but with the shorter negative_ttl so they are retried sooner
+
+    each thread keeps its own connection, opened on first use. A hit only records when the entry was used if that
+    was more than access_resolution seconds ago, so repeated hits on the same audio are reads and do not queue for
+    the write lock. Writers wait up to busy_timeout seconds for it. The cache is only trimmed back to max_entries
+    every evict_every puts (by default a hundredth of max_entries), so it can briefly hold that many more
+    """
+
+    def __init__(self, path, max_entries=10000, ttl=7 * 24 * 3600, negative_ttl=3600, access_resolution=60,
+                 busy_timeout=5.0, evict_every=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.evict_every = evict_every or max(max_entries // 100, 1)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.access_resolution = access_resolution
+        self.busy_timeout = busy_timeout
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._puts = 0  # puts since the cache was last trimmed
+        self._counts = {"hits": 0, "negative_hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+        with conn:
+            conn.execute("PRAGMA journal_mode = WAL")  # lookups read while another thread or worker writes
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    artist TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    found INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        conn.close()  # serve.py imports the cache before forking its workers, which must not share a connection
+
+    def _connection(self):
+        """ Function returns this thread's connection, opening it on first use and again in a forked process """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            conn.execute("PRAGMA synchronous = NORMAL")  # safe with WAL, commits do not wait for the disk
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def get(self, key):
+        """ Function returns the cached result for a content hash as {"artist", "title", "found"}, or None on a miss """
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute("SELECT artist, title, found, created, accessed FROM results WHERE key = ?",
+                               (key,)).fetchone()
+            if row is None:
+                self._count("misses")
+                return None
+
+            artist, title, found, created, accessed = row
+            if now - created > (self.ttl if found else self.negative_ttl):
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))  # drop the stale entry so it is refreshed
+                self._count("expired")
+                self._count("misses")
+                return None
+
+            if now - accessed > self.access_resolution:  # close enough for evicting the least recently used
+                conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+        self._count("hits" if found else "negative_hits")
+        return {"artist": artist, "title": title, "found": bool(found)}
+
+    def put(self, key, artist, title):
+        """ Function stores a result, results with an 'Unknown' artist or title are stored as negative results """
+        now = time.time()
+        found = artist != 'Unknown' and title != 'Unknown'
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, artist, title, found, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, artist, title, int(found), now, now))
+        with self._lock:
+            self._puts += 1
+            if self._puts < self.evict_every:
+                return
+            self._puts = 0
+        self._evict()
+
+    def _evict(self):
+        """ Function removes the least recently used entries past max_entries """
+        with self._connection() as conn:
+            excess = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_entries
+            if excess <= 0:
+                return
+            evicted = conn.execute("""
+                DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)
+            """, (excess,)).rowcount  # read from the old end of the index, only as far as there are entries to drop
+        self._count("evictions", evicted)
+
+    def clear(self):
+        """ Function removes every cached result """
+        with self._connection() as conn:
+            conn.execute("DELETE FROM results")
+
+    def stats(self):
+        """ Function returns the hit/miss counters and the current number of entries """
+        with self._connection() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        with self._lock:
+            counts = dict(self._counts)
+        lookups = counts["hits"] + counts["negative_hits"] + counts["misses"]
+        counts["entries"] = entries
+        counts["hit_rate"] = round((counts["hits"] + counts["negative_hits"]) / lookups, 4) if lookups else 0.0
+        return counts
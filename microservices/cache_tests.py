@@ -0,0 +1,135 @@
+import pytest
+import sqlite3
+import time
+from cache import ResultCache, hash_file
+
+
+@pytest.fixture
+def cache(tmp_path):
+    """Result cache backed by a temporary SQLite file."""
+    return ResultCache(str(tmp_path / "cache.db"), max_entries=2, ttl=60, negative_ttl=1, access_resolution=0)
+
+
+# ============================================= HAPPY PATHS ======================================================================
+
+def test_hash_file(tmp_path):
+    """Test hashing audio content
+    
+    ensures two files with the same content but different names have the same key 
+
+    asserts the hashes are equal
+    """
+    (tmp_path / "a.wav").write_bytes(b"same audio")
+    (tmp_path / "b.wav").write_bytes(b"same audio")
+    assert hash_file(str(tmp_path / "a.wav")) == hash_file(str(tmp_path / "b.wav"))
+
+
+def test_put_and_get(cache):
+    """Test storing and reading a result
+    
+    ensures a stored result is returned and counted as a hit 
+
+    asserts the result and the hit counter
+    """
+    cache.put("abc", "Olivia Rodrigo", "good 4 u")
+    assert cache.get("abc") == {"artist": "Olivia Rodrigo", "title": "good 4 u", "found": True}
+    assert cache.stats()["hits"] == 1
+
+
+def test_persistent(cache):
+    """Test the cache survives a restart
+    
+    ensures a new cache object on the same file still has the stored results 
+
+    asserts the result is returned by the new cache
+    """
+    cache.put("abc", "Olivia Rodrigo", "good 4 u")
+    reopened = ResultCache(cache.path)
+    assert reopened.get("abc")["title"] == "good 4 u"
+
+
+def test_negative_result(cache):
+    """Test caching a song that could not be recognised
+    
+    ensures 'Unknown' results are cached as negative results 
+
+    asserts found is False and it is counted as a negative hit
+    """
+    cache.put("abc", "Unknown", "Unknown")
+    assert cache.get("abc")["found"] is False
+    assert cache.stats()["negative_hits"] == 1
+
+
+def test_lru_eviction(cache):
+    """Test evicting the least recently used result
+    
+    ensures that once the cache is full the entry that was used longest ago is removed 
+
+    asserts the recently read entry is kept and the other old entry is evicted
+    """
+    cache.put("a", "Artist", "A")
+    cache.put("b", "Artist", "B")
+    time.sleep(0.01)
+    cache.get("a")  # a is now more recently used than b
+    cache.put("c", "Artist", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_eviction_batched(tmp_path):
+    """Test the cache is trimmed every evict_every puts rather than on every put
+    
+    ensures that a put does not look for entries to evict until evict_every puts have been made, and then trims the
+    cache back to max_entries 
+
+    asserts the cache holds more than max_entries between trims and exactly max_entries after one
+    """
+    cache = ResultCache(str(tmp_path / "cache.db"), max_entries=2, evict_every=3)
+    for i in range(5):
+        cache.put(f"key{i}", "Artist", f"Song {i}")
+    assert cache.stats()["entries"] == 4  # trimmed to 2 by the third put, two more since
+    cache.put("key5", "Artist", "Song 5")
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"]) == (2, 4)  # 1 at the third put, 3 at the sixth
+
+
+def test_hit_without_write(tmp_path):
+    """Test a hit soon after the entry was last used does not write to the cache
+    
+    ensures that repeated hits on the same audio only read, so busy audio does not queue for the write lock 
+
+    asserts the entry's access time is unchanged by a hit within access_resolution
+    """
+    cache = ResultCache(str(tmp_path / "cache.db"), access_resolution=60)
+    cache.put("abc", "Olivia Rodrigo", "good 4 u")
+    with sqlite3.connect(cache.path) as conn:
+        before = conn.execute("SELECT accessed FROM results WHERE key = 'abc'").fetchone()[0]
+    assert cache.get("abc")["title"] == "good 4 u"
+    with sqlite3.connect(cache.path) as conn:
+        assert conn.execute("SELECT accessed FROM results WHERE key = 'abc'").fetchone()[0] == before
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+# ============================================= UNHAPPY PATHS ===================================================================
+
+def test_miss(cache):
+    """Test reading a result that is not cached
+    
+    asserts None is returned and it is counted as a miss
+    """
+    assert cache.get("missing") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_negative_ttl_expiry(cache):
+    """Test negative results expire sooner
+    
+    ensures that an 'Unknown' result is dropped after the negative ttl so the song is retried 
+
+    asserts the negative result is a miss once expired
+    """
+    cache.put("abc", "Unknown", "Unknown")
+    time.sleep(1.1)
+    assert cache.get("abc") is None
+    assert cache.stats()["expired"] == 1
@@ -1,41 +1,656 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g, stream_with_context
+from urllib.parse import urlencode
+from contextlib import contextmanager
 import sqlite3
+import json
+import csv
+import io
+import time
+import threading
+import queue
+import unicodedata
+import re
+import functools
+from collections import Counter
 import os
+import metrics
 
 app = Flask(__name__)
 
+registry = metrics.Registry()
+metrics.instrument(app, registry, "db")  # request latency by route, in flight and errors, served at /metrics
+QUERY_SECONDS = metrics.Histogram(registry, "db_query_seconds", "Time spent running each kind of query", ("query",))
+
 # Set the database file path
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-DB_PATH = os.path.join(BASE_DIR, "shamzam.db")
+DB_PATH = os.environ.get("DB_PATH", os.path.join(BASE_DIR, "shamzam.db"))  # benchmarks point this at a scratch database
+
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))  # how long a writer waits for the lock before failing
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 16))  # idle connections kept open between requests
+PAGE_SIZE = 100  # tracks returned by /tracks when no limit is given
+MAX_PAGE_SIZE = 1000  # largest limit /tracks accepts
+STREAM_BATCH = 500  # rows fetched from the cursor at a time when streaming tracks out
+IMPORT_BATCH = int(os.environ.get("DB_IMPORT_BATCH", 10000))  # rows inserted per transaction by NDJSON and CSV imports
+SEARCH_LIMIT = 10  # results returned by /search when no limit is given
+MAX_SEARCH_LIMIT = 100  # largest limit /search accepts
+RANK_CANDIDATES = 200  # most tracks containing every word of a search that are ranked, the first of them by id
+FUZZY_TRIGRAMS = 6  # rarest trigrams of the query used to find candidates when no track contains every word
+FUZZY_TRIGRAM_TRACKS = 5000  # most tracks counted or read for each trigram, any more and it is too common to help
+FUZZY_CANDIDATES = 200  # candidate tracks re-ranked by similarity in a fuzzy search
+MIN_SIMILARITY = 0.3  # fuzzy results less similar to the query than this are dropped
+DEDUP_SIMILARITY = float(os.environ.get("DB_DEDUP_SIMILARITY", 0.8))  # how similar a track must be to count as a duplicate
+
+# pragmas applied to every connection: WAL lets readers run while a write is in progress, and synchronous=NORMAL
+# is safe with WAL while only syncing at checkpoints instead of on every commit
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size = -16000",  # 16 MB page cache per connection
+    "PRAGMA temp_store = MEMORY",
+]
+
+# SQL is kept in constants so every request runs the exact same text and sqlite3 reuses the prepared statement
+# from the connection's statement cache instead of compiling it again
+# /tracks pages through the table by id (keyset pagination) instead of OFFSET, so every page is an index seek no
+# matter how deep it is. The prefix filters are ranges on the normalised key columns so they use the key indexes
+SELECT_TRACKS = "SELECT id, title, artist FROM tracks WHERE id > ?"
+TITLE_PREFIX = " AND title_key >= ? AND title_key < ?"
+ARTIST_PREFIX = " AND artist_key >= ? AND artist_key < ?"
+ORDER_TRACKS = " ORDER BY id LIMIT ?"
+# with a prefix filter, the unary + stops SQLite walking the whole table in id order to avoid a sort, it seeks the
+# key index instead and keeps only the first LIMIT matches in its sorter
+ORDER_FILTERED_TRACKS = " ORDER BY +id LIMIT ?"
+SELECT_REVISION = "SELECT value FROM tracks_revision"
+# duplicates are found through the unique index on the normalised keys, so adding and removing are one statement each
+INSERT_TRACK = """
+    INSERT INTO tracks (title, artist, title_key, artist_key, search_text) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (title_key, artist_key) DO NOTHING
+    RETURNING id
+"""
+# executemany cannot run a statement that returns rows, imports count what was added from the cursor's rowcount
+IMPORT_TRACK = """
+    INSERT INTO tracks (title, artist, title_key, artist_key, search_text) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (title_key, artist_key) DO NOTHING
+"""
+# imports switch off the per row triggers of tracks and bring the search index and revision up to date once a batch
+START_IMPORT = "UPDATE tracks_import SET active = 1"
+END_IMPORT = "UPDATE tracks_import SET active = 0"
+LAST_TRACK_ID = "SELECT max(id) FROM tracks"  # AUTOINCREMENT, so a batch's tracks all have greater ids. Wrapping max()
+# in anything else (coalesce) stops SQLite reading it from the end of the table and it scans every row instead
+INDEX_TRACKS_AFTER = "INSERT INTO tracks_search (rowid, search_text) SELECT id, search_text FROM tracks WHERE id > ?"
+BUMP_REVISION = "UPDATE tracks_revision SET value = value + 1"
+# tracks_search is an FTS5 trigram index over search_text, kept in step with tracks by triggers. Searches read rowids
+# from it in rowid order, which stops after the first few matches: ordering by its bm25 rank would score every
+# matching track, most of the table for a common word
+MATCHING_TRACKS = "SELECT rowid FROM tracks_search WHERE tracks_search MATCH ? LIMIT ?"
+# how many tracks contain a trigram, up to a limit. tracks_search_vocab has the exact number but counts it by reading
+# every entry of the trigram, which for the commonest is most of the table
+TRIGRAM_TRACKS = "SELECT count(*) FROM (SELECT rowid FROM tracks_search WHERE tracks_search MATCH ? LIMIT ?)"
+CANDIDATE_TRACKS = "SELECT id, title, artist, search_text FROM tracks WHERE id IN (SELECT value FROM json_each(?))"
+EXPORT_TRACKS = "SELECT id, title, artist FROM tracks ORDER BY id"
+DELETE_TRACK = "DELETE FROM tracks WHERE title_key = ? AND artist_key = ? RETURNING id"
+
+_migrated_paths = set()  # database files whose schema is known to be up to date
+_schema_lock = threading.Lock()
+
+
+def normalise_key(value):
+    """ Function returns the form of a title or artist used to spot duplicates: case folded with runs of whitespace
+    collapsed, so "Good 4 U " and "good 4 u" are the same track
+    """
+    return " ".join(value.split()).casefold()
+
+
+_ASCII_SEPARATORS = re.compile(r"[^a-z0-9]+")
+
+
+def search_text(title, artist):
+    """ Function returns the text a track is indexed under for search: title and artist case folded, with accents and
+    punctuation removed, so "Don't Look Back In Anger" and "Dont Look Back in Anger" index the same
+    """
+    text = f"{title} {artist}".casefold()
+    if text.isascii():  # most tracks, done with two regular expressions instead of a character at a time in Python
+        return _ASCII_SEPARATORS.sub(" ", text.replace("'", "")).strip()
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c) and c not in "'\u2019")  # don't -> dont
+    return " ".join("".join(c if c.isalnum() else " " for c in text).split())
+
+
+def trigrams(text):
+    """ Function returns the set of 3 character substrings of text, what the trigram index is built from """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def similarity(a, b):
+    """ Function returns how alike two search texts are, from 0 to 1, as the overlap of their trigrams (Jaccard) """
+    a, b = trigrams(a), trigrams(b)
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+@functools.lru_cache(maxsize=65536)
+def word_trigrams(word):
+    """ Function returns the trigrams of a word padded with spaces, so short words have some and the start and end
+    of a word count towards a match
+    """
+    return frozenset(trigrams(f"  {word} "))
+
+
+def word_similarity(query, text):
+    """ Function returns how well a search matches a track's search text, from 0 to 1
+
+    each word of the search is scored by the trigram similarity of the word of the track most like it and the scores
+    are averaged, so a search naming only the title or only the artist, with a typo, still scores well. similarity()
+    compares whole texts instead, which is what finding duplicates needs
+    """
+    words = set(text.split())
+    query_words = query.split()
+    if not words or not query_words:
+        return 0.0
+    total = 0.0
+    for query_word in query_words:
+        a = word_trigrams(query_word)
+        total += max(len(a & b) / len(a | b) for b in map(word_trigrams, words))
+    return total / len(query_words)
+
+
+def track_row(title, artist):
+    """ Function returns the values INSERT_TRACK and IMPORT_TRACK take for a track """
+    return title, artist, normalise_key(title), normalise_key(artist), search_text(title, artist)
+
+
+def prefix_range(prefix):
+    """ Function returns the (low, high) bounds of the normalised keys that start with prefix, so a prefix match can
+    be a range on an index instead of a LIKE that scans the table
+    """
+    low = normalise_key(prefix)
+    return low, low[:-1] + chr(ord(low[-1]) + 1)  # the first string after every string starting with low
+
+
+def _add_track_keys(conn):
+    """ Migration 1: add normalised key columns, fill them in, drop duplicate tracks and index the keys """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(tracks)")}
+    if "title_key" not in columns:
+        conn.execute("ALTER TABLE tracks ADD COLUMN title_key TEXT")
+        conn.execute("ALTER TABLE tracks ADD COLUMN artist_key TEXT")
+    rows = conn.execute("SELECT id, title, artist FROM tracks").fetchall()
+    conn.executemany("UPDATE tracks SET title_key = ?, artist_key = ? WHERE id = ?",
+                     [(normalise_key(title), normalise_key(artist), track_id) for track_id, title, artist in rows])
+    conn.execute("""
+        DELETE FROM tracks WHERE id NOT IN (SELECT MIN(id) FROM tracks GROUP BY title_key, artist_key)
+    """)  # keep the first copy of any tracks that only differed by case or spacing
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tracks_key ON tracks (title_key, artist_key)")
+
+
+def _add_listing_support(conn):
+    """ Migration 2: index the artist key for prefix filters and keep a revision number that changes with the table
+
+    the revision is bumped by triggers on every insert, update and delete, so /tracks can build an ETag from it
+    without reading the tracks
+    """
+    conn.execute("CREATE INDEX IF NOT EXISTS tracks_artist_key ON tracks (artist_key)")
+    conn.execute("CREATE TABLE IF NOT EXISTS tracks_revision (value INTEGER NOT NULL)")
+    conn.execute("INSERT INTO tracks_revision (value) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM tracks_revision)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS tracks_revision_{event.lower()} AFTER {event} ON tracks
+            BEGIN
+                UPDATE tracks_revision SET value = value + 1;
+            END
+        """)
+
+
+def _add_search_index(conn):
+    """ Migration 3: add the search_text column and an FTS5 trigram index over it, with triggers keeping it in sync
+
+    the index is an external content table, it stores the trigrams but reads search_text back from tracks, and the
+    vocab table exposes how many tracks contain each trigram
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(tracks)")}
+    if "search_text" not in columns:
+        conn.execute("ALTER TABLE tracks ADD COLUMN search_text TEXT")
+    rows = conn.execute("SELECT id, title, artist FROM tracks").fetchall()
+    conn.executemany("UPDATE tracks SET search_text = ? WHERE id = ?",
+                     [(search_text(title, artist), track_id) for track_id, title, artist in rows])
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS tracks_search
+        USING fts5(search_text, content='tracks', content_rowid='id', tokenize='trigram')
+    """)
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tracks_search_vocab USING fts5vocab(tracks_search, 'row')")
+    conn.execute("INSERT INTO tracks_search (tracks_search) VALUES ('rebuild')")  # index the existing tracks
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS tracks_search_insert AFTER INSERT ON tracks BEGIN
+            INSERT INTO tracks_search (rowid, search_text) VALUES (new.id, new.search_text);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS tracks_search_delete AFTER DELETE ON tracks BEGIN
+            INSERT INTO tracks_search (tracks_search, rowid, search_text) VALUES ('delete', old.id, old.search_text);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS tracks_search_update AFTER UPDATE OF search_text ON tracks BEGIN
+            INSERT INTO tracks_search (tracks_search, rowid, search_text) VALUES ('delete', old.id, old.search_text);
+            INSERT INTO tracks_search (rowid, search_text) VALUES (new.id, new.search_text);
+        END
+    """)
+
+
+def _add_import_switch(conn):
+    """ Migration 4: let imports switch off the insert triggers that bump the revision and index each new track
+
+    an import sets tracks_import.active inside its write transaction and clears it before committing, so no other
+    connection ever sees it set, and does the work of the triggers once for the whole batch
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS tracks_import (active INTEGER NOT NULL)")
+    conn.execute("INSERT INTO tracks_import (active) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM tracks_import)")
+    conn.execute("DROP TRIGGER IF EXISTS tracks_revision_insert")
+    conn.execute("DROP TRIGGER IF EXISTS tracks_search_insert")
+    conn.execute("""
+        CREATE TRIGGER tracks_revision_insert AFTER INSERT ON tracks
+        WHEN NOT (SELECT active FROM tracks_import) BEGIN
+            UPDATE tracks_revision SET value = value + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER tracks_search_insert AFTER INSERT ON tracks
+        WHEN NOT (SELECT active FROM tracks_import) BEGIN
+            INSERT INTO tracks_search (rowid, search_text) VALUES (new.id, new.search_text);
+        END
+    """)
+
+
+# schema migrations in order, PRAGMA user_version records how many have been applied to a database file
+MIGRATIONS = [_add_track_keys, _add_listing_support, _add_search_index, _add_import_switch]
+
 
 # Function to initialize the database
 def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    try:
+        conn.execute("""
             CREATE TABLE IF NOT EXISTS tracks (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 title TEXT NOT NULL,
                 artist TEXT NOT NULL
             )
         """)
-        conn.commit()
+        with write_transaction(conn):  # hold the write lock so two processes starting together do not both migrate
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+    finally:
+        conn.close()
+
+
+def connect(path):
+    """ Function opens a new connection with the tuned pragmas, in autocommit mode so transactions are explicit """
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None, cached_statements=128,
+                           check_same_thread=False)  # connections move between worker threads through the pool
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """ Pool of open database connections shared by the worker threads
+
+    a request takes an idle connection (or opens one if there are none) and gives it back when it finishes, so the
+    cost of opening a connection and setting its pragmas is only paid when the pool grows. Up to size idle
+    connections are kept, any more are closed when they are returned
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = queue.LifoQueue()  # most recently used first, its pages are most likely still cached
+
+    def acquire(self, path):
+        """ Function returns an open connection to the database at path """
+        while True:
+            try:
+                conn_path, conn = self._idle.get_nowait()
+            except queue.Empty:
+                return connect(path)
+            if conn_path == path:
+                return conn
+            conn.close()  # the database file has been changed since this connection was opened
+
+    def release(self, conn, path):
+        """ Function gives a connection back to the pool """
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")  # never hand out a connection in the middle of a transaction
+        if self._idle.qsize() < self.size:
+            self._idle.put((path, conn))
+        else:
+            conn.close()
+
+    def stats(self):
+        """ Function returns how many connections are idle in the pool """
+        return {"idle": self._idle.qsize(), "size": self.size}
+
+    def close(self):
+        """ Function closes every idle connection """
+        while True:
+            try:
+                _, conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+
+pool = ConnectionPool(POOL_SIZE)
+registry.add_callback(metrics.stats_gauges("db", {"pool": pool.stats}))
+
+
+def get_db():
+    """ Function returns the database connection for the current request, taking it from the pool on first use
+
+    the schema is created the first time any request connects, so the service does not need init_db to have run
+    """
+    if DB_PATH not in _migrated_paths:
+        with _schema_lock:
+            if DB_PATH not in _migrated_paths:
+                init_db()
+                _migrated_paths.add(DB_PATH)
+
+    if "db" not in g:
+        g.db = pool.acquire(DB_PATH)
+        g.db_path = DB_PATH
+    return g.db
+
+
+@app.teardown_appcontext
+def release_db(exception):
+    """ Function returns the request's connection to the pool once the request has finished """
+    conn = g.pop("db", None)
+    if conn is not None:
+        pool.release(conn, g.pop("db_path"))
+
+
+@contextmanager
+def write_transaction(conn):
+    """ Function runs a block in a transaction that takes the write lock up front (BEGIN IMMEDIATE)
+
+    taking the lock at the start means two requests that both read then write cannot deadlock each other, the second
+    one waits for up to the busy timeout instead
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _listing_query(args):
+    """ Function builds the /tracks query and its parameters from the query string, without the LIMIT
+
+    raises ValueError if after_id is not a whole number
+    """
+    sql = SELECT_TRACKS
+    params = [int(args.get("after_id", 0))]
+    for name, clause in (("title", TITLE_PREFIX), ("artist", ARTIST_PREFIX)):
+        prefix = args.get(name, "")
+        if normalise_key(prefix):
+            sql += clause
+            params.extend(prefix_range(prefix))
+    return sql + (ORDER_FILTERED_TRACKS if len(params) > 1 else ORDER_TRACKS), params
+
+
+def search_tracks(conn, text, limit):
+    """ Function finds the tracks that best match a search, returns (results, fuzzy)
+
+    the first RANK_CANDIDATES tracks containing every word of the search are found through the trigram index. If
+    none do (usually a typo) it falls back to a fuzzy search: the tracks containing the rarest trigrams of the search
+    are counted and the FUZZY_CANDIDATES sharing the most become the candidates instead. Either way the candidates
+    are ranked by word_similarity, ties going to the shorter track. Each result is
+    {"id", "title", "artist", "score"}, score being the similarity from 0 to 1
+    """
+    text = search_text(text, "")
+    words = [word for word in text.split() if len(word) >= 3]  # the trigram index cannot match shorter words
+    if words:
+        query = " AND ".join('"' + word + '"' for word in words)
+        candidates = [row[0] for row in conn.execute(MATCHING_TRACKS, (query, RANK_CANDIDATES))]
+        if candidates:
+            return rank_tracks(conn, text, candidates, 0.0)[:limit], False
+
+    counts = {}
+    for gram in trigrams(text):
+        count = conn.execute(TRIGRAM_TRACKS, ('"' + gram + '"', FUZZY_TRIGRAM_TRACKS)).fetchone()[0]
+        if count:
+            counts[gram] = count
+    rare = sorted(counts, key=lambda gram: (counts[gram], gram))[:FUZZY_TRIGRAMS]  # common ones match most tracks
+    if counts and min(counts.values()) < FUZZY_TRIGRAM_TRACKS:
+        rare = [gram for gram in rare if counts[gram] < FUZZY_TRIGRAM_TRACKS]  # the common ones only when all are
+    if not rare:
+        return [], True
+    shared = Counter()
+    for gram in rare:
+        shared.update(row[0] for row in conn.execute(MATCHING_TRACKS, ('"' + gram + '"', FUZZY_TRIGRAM_TRACKS)))
+    candidates = [track_id for track_id, _ in shared.most_common(FUZZY_CANDIDATES)]
+    return rank_tracks(conn, text, candidates, MIN_SIMILARITY)[:limit], True
+
+
+def rank_tracks(conn, text, candidates, min_score):
+    """ Function returns the candidate tracks at least min_score similar to the search text, best match first """
+    scored = []
+    for row in conn.execute(CANDIDATE_TRACKS, (json.dumps(candidates),)):
+        score = word_similarity(text, row[3])
+        if score >= min_score:
+            scored.append((-score, len(row[3]), row[0], row[1], row[2]))
+    scored.sort()
+    return [{"id": track_id, "title": title, "artist": artist, "score": round(-score, 3)}
+            for score, _, track_id, title, artist in scored]
+
+
+def _ndjson_rows(rows):
+    return "".join(json.dumps({"id": row[0], "title": row[1], "artist": row[2]}) + "\n" for row in rows)
+
+
+def _csv_rows(rows):
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+    return out.getvalue()
+
+
+def _stream_tracks(sql, params, format_rows=_ndjson_rows, header=None):
+    """ Function yields the tracks matching a query formatted by format_rows, fetching STREAM_BATCH rows at a time,
+    after the header if one is given
+
+    the generator takes its own connection from the pool because it keeps running after the request has returned
+    its response and the request's connection has been given back
+    """
+    path = DB_PATH
+    conn = pool.acquire(path)
+    try:
+        if header is not None:
+            yield header
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(STREAM_BATCH)
+            if not rows:
+                break
+            yield format_rows(rows)
+        cursor.close()
+    finally:
+        pool.release(conn, path)
+
+
+class _RequestBody(io.RawIOBase):
+    """ Raw binary file over a WSGI input stream, so it can be wrapped in io.BufferedReader and io.TextIOWrapper
+
+    werkzeug's stream happens to be a file object, but WSGI only promises read and readline (gunicorn's has no
+    readable method, for one)
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _read_ndjson(stream):
+    """ Function yields (title, artist) for each line of an NDJSON stream, None for lines that are not a valid track """
+    for line in stream:
+        if not line.strip():
+            continue  # blank lines, usually the end of the body
+        try:
+            track = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        yield (track.get("title"), track.get("artist")) if isinstance(track, dict) else None
+
+
+def _read_csv(stream):
+    """ Function returns an iterator of (title, artist) for each row of a CSV stream with a title,artist header row
+
+    the header is read straight away, raises ValueError if it does not have both columns
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8", newline=""))
+    if not reader.fieldnames or not {"title", "artist"} <= set(reader.fieldnames):
+        raise ValueError("CSV must have a header row with 'title' and 'artist' columns")
+    return ((row["title"], row["artist"]) for row in reader)
+
+
+def _import_tracks(conn, tracks):
+    """ Function inserts tracks from an iterable of (title, artist), committing every IMPORT_BATCH rows
+
+    rows that are not a pair of non empty strings are counted as invalid and tracks already in the database (or
+    earlier in the same import) are skipped. Returns a report with the counts for each batch and the totals, the
+    batches before a failure stay committed
+    """
+    report = {"rows": 0, "added": 0, "exists": 0, "invalid": 0, "batches": []}
+    batch = []
+    invalid = 0
+    start = time.perf_counter()
+
+    def flush():
+        with QUERY_SECONDS.time("import_batch"), write_transaction(conn):
+            last_id = conn.execute(LAST_TRACK_ID).fetchone()[0] or 0
+            conn.execute(START_IMPORT)
+            added = conn.executemany(IMPORT_TRACK, batch).rowcount  # rows skipped by ON CONFLICT are not counted
+            conn.execute(END_IMPORT)
+            if added:
+                conn.execute(INDEX_TRACKS_AFTER, (last_id,))  # one index update per batch is far cheaper than per row
+                conn.execute(BUMP_REVISION)
+        result = {"batch": len(report["batches"]) + 1, "rows": len(batch) + invalid, "added": added,
+                  "exists": len(batch) - added, "invalid": invalid}
+        report["batches"].append(result)
+        for name in ("rows", "added", "exists", "invalid"):
+            report[name] += result[name]
+
+    for track in tracks:
+        title, artist = track if track is not None else (None, None)
+        if not title or not artist or not isinstance(title, str) or not isinstance(artist, str):
+            invalid += 1
+        else:
+            batch.append(track_row(title, artist))
+        if len(batch) + invalid >= IMPORT_BATCH:
+            flush()
+            batch, invalid = [], 0
+    if batch or invalid:
+        flush()
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
 
 @app.route("/tracks", methods=['GET'])
 def get_tracks():
-    """ Function to output a list of all the tracks currently in the database 
+    """ Function to output a page of the tracks currently in the database, ordered by id 
     
-    Does not take any JSON payload input 
+    Does not take any JSON payload input, optional query parameters:
+    after_id - only tracks with a greater id, pass the id of the last track of the previous page
+    limit - how many tracks to return, default 100 and at most 1000
+    title, artist - only tracks whose title or artist starts with this, ignoring case
+    format=ndjson - stream every matching track as one JSON object per line instead of a single page
 
-    Expected output is 200 and a list of tracks in the database with the title, and id 
+    Expected output is 200 and a list of tracks in the database with the title, artist and id. When the page is full
+    a Link header points at the next page. The ETag changes whenever a track is added or removed, so a request with
+    a matching If-None-Match gets 304 and no body 
     """
+    streaming = request.args.get("format") == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson"
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, title, artist FROM tracks")
-            tracks = cursor.fetchall()  # gather all the tracks from the database 
-            track_list = [{"id": row[0], "title": row[1], "artist": row[2]} for row in tracks]  # loop through tracks 
-        return jsonify(track_list)  # make the track list to a json format and return it 
+        sql, params = _listing_query(request.args)
+        limit = int(request.args.get("limit", -1 if streaming else PAGE_SIZE))  # streams are unlimited by default
+    except ValueError:
+        return jsonify({"error": "'after_id' and 'limit' must be integers"}), 400  # makes sure the paging values are numbers 
+    if not streaming and not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"'limit' must be between 1 and {MAX_PAGE_SIZE}"}), 400  # keeps page memory bounded 
+
+    try:
+        # read before the tracks, so if a write lands in between the ETag is older than the body and the next
+        # conditional request fetches it again rather than being told a stale listing is current
+        with QUERY_SECONDS.time("revision"):
+            etag = f"tracks-{get_db().execute(SELECT_REVISION).fetchone()[0]}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response  # the listing has not changed since the client last fetched it
+
+        if streaming:
+            response = Response(stream_with_context(_stream_tracks(sql, params + [limit])), mimetype="application/x-ndjson")
+        else:
+            with QUERY_SECONDS.time("list"):
+                tracks = get_db().execute(sql, params + [limit]).fetchall()  # at most one page of tracks 
+            response = jsonify([{"id": row[0], "title": row[1], "artist": row[2]} for row in tracks])
+            if len(tracks) == limit:
+                next_args = dict(request.args, after_id=tracks[-1][0], limit=limit)
+                response.headers["Link"] = f'<{request.base_url}?{urlencode(next_args)}>; rel="next"'
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        return jsonify({"error": "Database error"}), 500
+
+
+def find_duplicate(conn, title, artist):
+    """ Function returns the stored track most similar to title and artist if it is at least DEDUP_SIMILARITY alike,
+    otherwise None
+    """
+    text = search_text(title, artist)
+    results, _ = search_tracks(conn, text, 5)
+    best, best_score = None, DEDUP_SIMILARITY
+    for result in results:
+        score = similarity(text, search_text(result["title"], result["artist"]))  # ranked per word, not by the whole text
+        if score >= best_score:
+            best, best_score = {"id": result["id"], "title": result["title"], "artist": result["artist"]}, score
+    return best
+
+
+@app.route("/search", methods=['GET'])
+def search():
+    """ Function searches the tracks by title and artist, tolerating differences in case, punctuation and small typos
+
+    Does not take any JSON payload input, query parameters:
+    q - the text to search for, e.g. "dont look back in anger oasis"
+    limit - how many results to return, default 10 and at most 100
+
+    Expected output is 200 and the best matches first:
+    {"query": "...", "fuzzy": false, "results": [{"id": 1, "title": "...", "artist": "...", "score": 0.9}]}
+    "fuzzy" is true when no track contained every word and the results are the closest matches instead
+    """
+    text = request.args.get("q", "")
+    if not text.strip():
+        return jsonify({"error": "Missing search query 'q'"}), 400  # makes sure there is something to search for 
+    try:
+        limit = int(request.args.get("limit", SEARCH_LIMIT))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        return jsonify({"error": f"'limit' must be between 1 and {MAX_SEARCH_LIMIT}"}), 400
+
+    try:
+        with QUERY_SECONDS.time("search"):
+            results, fuzzy = search_tracks(get_db(), text, limit)
+        return jsonify({"query": text, "fuzzy": fuzzy, "results": results}), 200
     except Exception as e:
         return jsonify({"error": "Database error"}), 500
 
@@ -47,6 +662,9 @@ def add_track():
     expected JSON payload: {"title": "good 4 u", "artist": "Olivia Rodrigo"}
     
     expected output is 200 and 'Track added!'
+
+    with ?dedup=1 a track that is only a near match for one already stored (different punctuation or accents, a
+    small typo) also counts as existing, and the 409 response includes the stored track under "match"
     """
     if not request.is_json:
         return jsonify({"error": "Request must be in JSON format"}), 400  # makes sure the request is in JSON format 
@@ -61,15 +679,20 @@ def add_track():
         return jsonify({"error": "'artist' and 'title' must be strings"}), 400  # makes sure title and artist are strings
     
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM tracks WHERE title = ? AND artist = ?", (title, artist))
-            existing_track = cursor.fetchone() #  check if the track already exists in the database 
-            if existing_track:
-                return jsonify({"error": "Track already exists"}), 409 # return error if track being added is already in database 
-            
-            cursor.execute("INSERT INTO tracks (title, artist) VALUES (?, ?)", (title, artist))
-            conn.commit()
+        if request.args.get("dedup") in ("1", "true"):
+            with write_transaction(get_db()) as conn:  # hold the write lock so a near duplicate cannot be added in between
+                with QUERY_SECONDS.time("find_duplicate"):
+                    match = find_duplicate(conn, title, artist)
+                if match:
+                    return jsonify({"error": "Track already exists", "match": match}), 409  # a near match is already stored 
+                with QUERY_SECONDS.time("insert"):
+                    inserted = conn.execute(INSERT_TRACK, track_row(title, artist)).fetchall()
+        else:
+            # the insert is skipped by the unique index if the track already exists, so nothing is returned
+            with QUERY_SECONDS.time("insert"):
+                inserted = get_db().execute(INSERT_TRACK, track_row(title, artist)).fetchall()
+        if not inserted:
+            return jsonify({"error": "Track already exists"}), 409 # return error if track being added is already in database 
         return jsonify({"message": "Track added!", "track": {"title": title, "artist": artist}}), 200  # return success message with track info 
     except Exception as e:
         return jsonify({"error": "Database error"}), 500  # return error if database operation fails 
@@ -96,21 +719,91 @@ def remove_track():
         return jsonify({"error": "'artist' and 'title' must be strings"}), 400   # makes sure title and artist are strings 
     
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM tracks WHERE title = ? AND artist = ?", (title, artist))
-            track = cursor.fetchone()  # check if the track exists in the database 
-            if not track:
-                return jsonify({"error": "Track not found"}), 404  # return error if track is not found 
-            
-            cursor.execute("DELETE FROM tracks WHERE title = ? AND artist = ?", (title, artist))
-            conn.commit()
+        with QUERY_SECONDS.time("delete"):
+            deleted = get_db().execute(DELETE_TRACK, (normalise_key(title), normalise_key(artist))).fetchall()  # returns the rows it removed 
+        if not deleted:
+            return jsonify({"error": "Track not found"}), 404  # return error if track is not found 
         return jsonify({"message": "Track successfully removed.", "track": {"title": title, "artist": artist}}), 200  # return success message 
     except Exception as e:
         return jsonify({"error": "Error removing track from database"}), 500  # return error if database operation fails 
 
 
+@app.route("/tracks/bulk", methods=['POST'])
+def add_tracks_bulk():
+    """ Function takes a list of tracks and adds them all to the database
+
+    a JSON list is added in a single transaction:
+    expected JSON payload: [{"title": "good 4 u", "artist": "Olivia Rodrigo"}, {"title": "Blinding Lights", "artist": "The Weeknd"}]
+
+    expected output is 200 and a status for each track in the same order, "added", "exists" or "invalid":
+    {"results": [{"title": "good 4 u", "artist": "Olivia Rodrigo", "status": "added"}, ...], "added": 2}
+
+    for large imports the body can instead be an NDJSON stream (Content-Type: application/x-ndjson, one track object
+    per line) or CSV (Content-Type: text/csv, with a title,artist header row). These are read as they arrive and
+    inserted IMPORT_BATCH rows per transaction, expected output is 200 and the counts for each batch:
+    {"rows": 3, "added": 2, "exists": 1, "invalid": 0, "batches": [{"batch": 1, "rows": 3, ...}], "seconds": 0.01}
+    """
+    if request.mimetype in ("application/x-ndjson", "text/csv"):
+        return import_tracks_stream()
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON, NDJSON or CSV"}), 400  # makes sure the request is a format we can read 
+
+    tracks = request.get_json()
+    if not isinstance(tracks, list):
+        return jsonify({"error": "Request must be a list of tracks"}), 400  # makes sure a list of tracks was sent
+
+    results = []
+    try:
+        with QUERY_SECONDS.time("bulk_insert"), write_transaction(get_db()) as conn:  # one transaction and one commit for the whole batch
+            for track in tracks:
+                artist = track.get("artist") if isinstance(track, dict) else None
+                title = track.get("title") if isinstance(track, dict) else None
+                if not artist or not title or not isinstance(artist, str) or not isinstance(title, str):
+                    results.append({"title": title, "artist": artist, "status": "invalid"})  # skip bad tracks instead of failing the batch
+                    continue
+
+                inserted = conn.execute(INSERT_TRACK, track_row(title, artist)).fetchall()
+                results.append({"title": title, "artist": artist, "status": "added" if inserted else "exists"})
+        added = sum(r["status"] == "added" for r in results)
+        return jsonify({"results": results, "added": added}), 200
+    except Exception as e:
+        return jsonify({"error": "Database error"}), 500  # return error if database operation fails 
+
+
+def import_tracks_stream():
+    """ Function imports the NDJSON or CSV body of a /tracks/bulk request, see add_tracks_bulk """
+    body = io.BufferedReader(_RequestBody(request.stream), 1 << 16)  # reading lines from the raw stream is one read call per byte
+    try:
+        if request.mimetype == "text/csv":
+            tracks = _read_csv(body)
+        else:
+            tracks = _read_ndjson(body)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400  # the CSV header is missing a column 
+
+    try:
+        return jsonify(_import_tracks(get_db(), tracks)), 200
+    except (UnicodeDecodeError, csv.Error):
+        return jsonify({"error": "Request body is not valid UTF-8 CSV"}), 400  # only CSV is decoded as a whole stream 
+    except Exception as e:
+        return jsonify({"error": "Database error"}), 500  # return error if database operation fails 
+
+
+@app.route("/tracks/export", methods=['GET'])
+def export_tracks():
+    """ Function streams every track in the database ordered by id, without holding them all in memory
+
+    Does not take any JSON payload input, optional query parameter format=csv for CSV with a header row, the
+    default is NDJSON with one {"id", "title", "artist"} object per line 
+
+    Expected output is 200 and the stream of tracks, in a form /tracks/bulk can import 
+    """
+    if request.args.get("format") == "csv":
+        rows = _stream_tracks(EXPORT_TRACKS, [], _csv_rows, header="id,title,artist\r\n")
+        return Response(stream_with_context(rows), mimetype="text/csv")
+    return Response(stream_with_context(_stream_tracks(EXPORT_TRACKS, [])), mimetype="application/x-ndjson")
+
+
 if __name__ == "__main__":
-    init_db()
-    print("Database initialized with tracks table!")
-    app.run(debug=True)
+    import serve
+    serve.run(app, "DB", port=5000, threads=4, on_exit=pool.close)  # see serve.py, the schema is created by the first request
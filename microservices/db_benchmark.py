@@ -0,0 +1,121 @@
+""" Concurrency benchmark for the database microservice
+
+Runs the db app on a threaded WSGI server and hammers /add_track and /tracks from many client threads, once with a
+new rollback journal connection opened for every request (how the service used to work) and once with the pooled
+WAL connections. Reports throughput, latency and how many requests failed, which under load are the writes that
+could not get the database lock.
+
+usage: python db_benchmark.py [--clients 32] [--requests 100] [--json results.json]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+import db
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass  # thousands of access log lines would slow the benchmark down
+
+
+class ConnectPerRequest:
+    """ How connections were made before pooling: a new one for every request, default rollback journal """
+
+    def acquire(self, path):
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = DELETE")
+        return conn
+
+    def release(self, conn, path):
+        conn.close()
+
+    def close(self):
+        pass
+
+
+def run(mode, clients, requests_per_client, write_ratio):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        original_pool = db.pool
+        if mode == "per_request":
+            db.pool = ConnectPerRequest()
+
+        server = make_server("127.0.0.1", 0, db.app, threaded=True, request_handler=QuietHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        latencies = []
+        errors = {"lock": 0, "other": 0}
+        lock = threading.Lock()
+
+        def client(number):
+            session = requests.Session()
+            for i in range(requests_per_client):
+                start = time.perf_counter()
+                if i % 100 < write_ratio * 100:
+                    response = session.post(base + "/add_track", json={"title": f"song {number}-{i}", "artist": "bench"})
+                else:
+                    response = session.get(base + "/tracks")
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if response.status_code == 500:
+                        errors["lock"] += 1  # the only database errors under this load are lock timeouts
+                    elif response.status_code != 200:
+                        errors["other"] += 1
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        server.shutdown()
+        db.pool.close()
+        db.pool = original_pool
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        "lock_errors": errors["lock"],
+        "other_errors": errors["other"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark concurrent reads and writes against the db service")
+    parser.add_argument("--clients", type=int, default=32, help="client threads sending requests at the same time")
+    parser.add_argument("--requests", type=int, default=100, help="requests sent by each client")
+    parser.add_argument("--write-ratio", type=float, default=0.5, help="fraction of requests that are /add_track")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {mode: run(mode, args.clients, args.requests, args.write_ratio) for mode in ("per_request", "pooled")}
+
+    print(f"{'mode':<12} {'requests':>9} {'rps':>8} {'p50 ms':>8} {'p99 ms':>8} {'lock errors':>12}")
+    for mode, r in results.items():
+        print(f"{mode:<12} {r['requests']:>9} {r['rps']:>8} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['lock_errors']:>12}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
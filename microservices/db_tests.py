@@ -1,5 +1,8 @@
 import pytest
+import json
+import io
 import sqlite3
+import db
 from db import app, DB_PATH
 
 @pytest.fixture
@@ -66,6 +69,320 @@ def test_get_tracks(client):
     assert response.json[0]["title"] == "good 4 u"
     assert response.json[0]["artist"] == "Olivia Rodrigo"
 
+def test_get_tracks_paginated(client):
+    """Test paging through the tracks
+    
+    ensures that the limit query parameter caps the page size, that a full page has a Link header pointing at the
+    next page and that following it returns the remaining tracks 
+
+    asserts the first page has 2 tracks and a next link, and the second page has the last track and no link
+    """
+    client.post("/tracks/bulk", json=[{"title": f"song {i}", "artist": "Olivia Rodrigo"} for i in range(3)])
+    response = client.get("/tracks?limit=2")
+    assert [track["title"] for track in response.json] == ["song 0", "song 1"]
+    assert 'rel="next"' in response.headers["Link"]
+    next_url = response.headers["Link"].split(">")[0].lstrip("<")
+    response = client.get(next_url)
+    assert [track["title"] for track in response.json] == ["song 2"]
+    assert "Link" not in response.headers
+
+def test_get_tracks_prefix_filter(client):
+    """Test filtering tracks by the start of the title or artist
+    
+    ensures that the title and artist query parameters only return tracks starting with them, ignoring case 
+
+    asserts the artist filter returns both Olivia Rodrigo tracks and the title filter returns only 'good 4 u'
+    """
+    client.post("/tracks/bulk", json=[
+        {"title": "good 4 u", "artist": "Olivia Rodrigo"},
+        {"title": "drivers license", "artist": "Olivia Rodrigo"},
+        {"title": "Blinding Lights", "artist": "The Weeknd"},
+    ])
+    assert len(client.get("/tracks?artist=olivia").json) == 2
+    response = client.get("/tracks?title=GOOD&artist=olivia")
+    assert [track["title"] for track in response.json] == ["good 4 u"]
+
+def test_get_tracks_ndjson(client):
+    """Test streaming the tracks as NDJSON
+    
+    ensures that format=ndjson streams every track as one JSON object per line 
+
+    asserts the content type is application/x-ndjson and there is one line per track
+    """
+    client.post("/tracks/bulk", json=[{"title": f"song {i}", "artist": "Olivia Rodrigo"} for i in range(3)])
+    response = client.get("/tracks?format=ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)["title"] for line in lines] == ["song 0", "song 1", "song 2"]
+
+def test_get_tracks_not_modified(client):
+    """Test conditional requests for the track listing
+    
+    ensures that sending back the ETag gets 304 while the tracks are unchanged and a full response once a track has
+    been added 
+
+    asserts code 304 for the unchanged listing and code 200 with a new ETag after adding a track
+    """
+    etag = client.get("/tracks").headers["ETag"]
+    response = client.get("/tracks", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    client.post("/add_track", json={"title": "good 4 u", "artist": "Olivia Rodrigo"})
+    response = client.get("/tracks", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+def test_add_tracks_bulk(client):
+    """Test adding several tracks in one request
+    
+    ensures the bulk endpoint adds new tracks, reports tracks that already exist and skips invalid ones 
+
+    asserts code 200, the status of each track and that the new tracks are in the database
+    """
+    client.post("/add_track", json={"title": "good 4 u", "artist": "Olivia Rodrigo"})
+    response = client.post("/tracks/bulk", json=[
+        {"title": "good 4 u", "artist": "Olivia Rodrigo"},
+        {"title": "Blinding Lights", "artist": "The Weeknd"},
+        {"title": "Blinding Lights"},
+    ])
+    assert response.status_code == 200
+    assert [r["status"] for r in response.json["results"]] == ["exists", "added", "invalid"]
+    assert response.json["added"] == 1
+    assert len(client.get("/tracks").json) == 2
+
+def test_import_tracks_ndjson(client, monkeypatch):
+    """Test importing tracks from an NDJSON stream
+    
+    ensures that NDJSON tracks are inserted in batches, skipping tracks already in the database and counting lines
+    that are not valid tracks 
+
+    asserts the totals, one report per batch of 2 rows, and the new tracks are in the database
+    """
+    monkeypatch.setattr(db, "IMPORT_BATCH", 2)
+    client.post("/add_track", json={"title": "good 4 u", "artist": "Olivia Rodrigo"})
+    body = "\n".join([
+        json.dumps({"title": "GOOD 4 U", "artist": "Olivia Rodrigo"}),
+        json.dumps({"title": "Blinding Lights", "artist": "The Weeknd"}),
+        "not json",
+        json.dumps({"title": "drivers license", "artist": "Olivia Rodrigo"}),
+    ])
+    response = client.post("/tracks/bulk", data=body, content_type="application/x-ndjson")
+    assert response.status_code == 200
+    assert (response.json["rows"], response.json["added"], response.json["exists"], response.json["invalid"]) == (4, 2, 1, 1)
+    assert [batch["rows"] for batch in response.json["batches"]] == [2, 2]
+    assert len(client.get("/tracks").json) == 3
+
+def test_import_tracks_csv(client):
+    """Test importing tracks from a CSV stream
+    
+    ensures that a CSV with a title,artist header is imported, including quoted fields with commas in them 
+
+    asserts code 200, both tracks added and the quoted title stored whole
+    """
+    body = 'artist,title\r\nOlivia Rodrigo,good 4 u\r\n"Tyler, The Creator",EARFQUAKE\r\n'
+    response = client.post("/tracks/bulk", data=body, content_type="text/csv")
+    assert response.status_code == 200
+    assert response.json["added"] == 2
+    assert client.get("/tracks?artist=tyler").json[0]["artist"] == "Tyler, The Creator"
+
+
+def test_import_tracks_plain_wsgi_input(client):
+    """Test importing from a WSGI input that only has read
+    
+    ensures that an import works when the server's input stream is not a full file object, like gunicorn's, which is
+    handed to the app as it is when the server says the body is terminated 
+
+    asserts code 200 and both tracks added
+    """
+    class Body:
+        def __init__(self, data):
+            self.data = io.BytesIO(data)
+
+        def read(self, size=-1):
+            return self.data.read(size)
+
+    body = b'{"title": "good 4 u", "artist": "Olivia Rodrigo"}\n{"title": "Davos", "artist": "Monkey"}\n'
+    response = client.post("/tracks/bulk", content_type="application/x-ndjson",
+                           environ_overrides={"wsgi.input": Body(body), "wsgi.input_terminated": True})
+    assert response.status_code == 200
+    assert response.json["added"] == 2
+
+def test_export_tracks(client):
+    """Test exporting the tracks
+    
+    ensures that the export endpoint streams every track as NDJSON by default and as CSV with a header when asked,
+    and that the CSV export can be imported again 
+
+    asserts one NDJSON line per track, the CSV header and rows, and the re-import finds every track already exists
+    """
+    client.post("/tracks/bulk", json=[{"title": f"song {i}", "artist": "Olivia Rodrigo"} for i in range(3)])
+    lines = client.get("/tracks/export").get_data(as_text=True).splitlines()
+    assert [json.loads(line)["title"] for line in lines] == ["song 0", "song 1", "song 2"]
+
+    response = client.get("/tracks/export?format=csv")
+    assert response.mimetype == "text/csv"
+    rows = response.get_data(as_text=True).splitlines()
+    assert rows[0] == "id,title,artist"
+    assert rows[1].endswith(",song 0,Olivia Rodrigo")
+    response = client.post("/tracks/bulk", data=response.get_data(), content_type="text/csv")
+    assert response.json["exists"] == 3
+
+def test_search(client):
+    """Test searching the tracks
+    
+    ensures that a search finds tracks containing every word of the query in the title or artist, ignoring case,
+    punctuation and word order 
+
+    asserts code 200, an exact (not fuzzy) search and 'Don't Look Back In Anger' as the only result
+    """
+    client.post("/tracks/bulk", json=[
+        {"title": "Don't Look Back In Anger", "artist": "Oasis"},
+        {"title": "Wonderwall", "artist": "Oasis"},
+        {"title": "Blinding Lights", "artist": "The Weeknd"},
+    ])
+    response = client.get("/search?q=oasis dont look back")
+    assert response.status_code == 200
+    assert response.json["fuzzy"] is False
+    assert [r["title"] for r in response.json["results"]] == ["Don't Look Back In Anger"]
+
+def test_search_fuzzy(client):
+    """Test searching with a typo
+    
+    ensures that when no track contains every word the search falls back to the closest matches 
+
+    asserts the search is fuzzy and 'Wonderwall' is the best match for 'wondrwall oasis'
+    """
+    client.post("/tracks/bulk", json=[
+        {"title": "Wonderwall", "artist": "Oasis"},
+        {"title": "Blinding Lights", "artist": "The Weeknd"},
+    ])
+    response = client.get("/search?q=wondrwall oasis")
+    assert response.json["fuzzy"] is True
+    assert response.json["results"][0]["title"] == "Wonderwall"
+
+def test_search_after_remove(client):
+    """Test the search index follows removed tracks
+    
+    ensures that a removed track is no longer returned by search 
+
+    asserts no results after removing the only matching track
+    """
+    client.post("/add_track", json={"title": "Wonderwall", "artist": "Oasis"})
+    client.post("/remove_track", json={"title": "Wonderwall", "artist": "Oasis"})
+    assert client.get("/search?q=wonderwall").json["results"] == []
+
+def test_search_fuzzy_single_field(client):
+    """Test searching with a typo in only the title or only the artist
+
+    ensures that a short search naming one field of a longer track, misspelt, still finds it, which comparing the
+    search with the whole title and artist does not
+
+    asserts each search is fuzzy and its track is the best match
+    """
+    client.post("/tracks/bulk", json=[
+        {"title": "Everybody (Backstreet's Back)", "artist": "Backstreet Boys"},
+        {"title": "Blinding Lights", "artist": "The Weeknd"},
+        {"title": "Don't Look Back In Anger", "artist": "Oasis"},
+        {"title": "Wonderwall", "artist": "Oasis"},
+    ])
+    for query, title in [("backstret boys", "Everybody (Backstreet's Back)"), ("everybdy", "Everybody (Backstreet's Back)"),
+                         ("weekend", "Blinding Lights"), ("angr", "Don't Look Back In Anger")]:
+        response = client.get(f"/search?q={query}")
+        assert response.json["fuzzy"] is True
+        assert response.json["results"][0]["title"] == title
+
+def test_import_tracks_searchable(client, monkeypatch):
+    """Test an import keeps the search index and the ETag of /tracks up to date
+
+    ensures that tracks imported in batches, which skip the per row triggers, are all indexed for search and change
+    the revision the ETag is made from, and that tracks added one at a time afterwards are still indexed
+
+    asserts every imported track is found by search, the ETag changed and a track added after the import is found
+    """
+    monkeypatch.setattr(db, "IMPORT_BATCH", 2)
+    etag = client.get("/tracks").headers["ETag"]
+    client.post("/tracks/bulk", json=[{"title": f"Song {name}", "artist": "Oasis"} for name in ["one", "two", "three"]])
+    assert client.get("/tracks").headers["ETag"] != etag
+    for name in ["one", "two", "three"]:
+        assert [r["title"] for r in client.get(f"/search?q=song {name}").json["results"]] == [f"Song {name}"]
+    client.post("/add_track", json={"title": "Wonderwall", "artist": "Oasis"})
+    assert client.get("/search?q=wonderwall").json["results"][0]["title"] == "Wonderwall"
+
+def test_add_track_dedup(client):
+    """Test adding a track in dedup mode
+    
+    ensures that with dedup a track differing from a stored one only by punctuation or a small typo is refused, and
+    that a different track is still added 
+
+    asserts code 409 with the stored track as the match for near duplicates, and code 200 for a new track
+    """
+    client.post("/add_track", json={"title": "Don't Look Back In Anger", "artist": "Oasis"})
+    for title in ("Dont Look Back in Anger", "Don't Look Back In Angr"):
+        response = client.post("/add_track?dedup=1", json={"title": title, "artist": "OASIS"})
+        assert response.status_code == 409
+        assert response.json["match"]["title"] == "Don't Look Back In Anger"
+    response = client.post("/add_track?dedup=1", json={"title": "Wonderwall", "artist": "Oasis"})
+    assert response.status_code == 200
+    assert len(client.get("/tracks").json) == 2
+
+def test_connection_pooled(client):
+    """Test connections are reused between requests
+    
+    ensures that a request gives its connection back to the pool and the next request uses it again, and that the
+    connection is in WAL mode 
+
+    asserts the same connection is handed out for both requests and the journal mode is 'wal'
+    """
+    client.get("/tracks")
+    _, first = db.pool._idle.queue[-1]
+    client.post("/add_track", json={"title": "good 4 u", "artist": "Olivia Rodrigo"})
+    _, second = db.pool._idle.queue[-1]
+    assert first is second
+    assert first.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+def test_migrate_duplicate_tracks(tmp_path):
+    """Test migrating a database that already has duplicate tracks
+    
+    ensures that running the migrations on an old database fills in the normalised keys, keeps only the first copy
+    of tracks that differ by case or spacing and records the schema version 
+
+    asserts the duplicate row is removed, the original row is kept and user_version matches the number of migrations
+    """
+    path = str(tmp_path / "old.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE tracks (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL, artist TEXT NOT NULL)")
+        conn.executemany("INSERT INTO tracks (title, artist) VALUES (?, ?)",
+                         [("good 4 u", "Olivia Rodrigo"), ("Good 4 U ", "olivia  rodrigo"), ("Blinding Lights", "The Weeknd")])
+    original = db.DB_PATH
+    db.DB_PATH = path
+    try:
+        db.init_db()
+    finally:
+        db.DB_PATH = original
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT id, title, artist_key FROM tracks ORDER BY id").fetchall()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    assert rows == [(1, "good 4 u", "olivia rodrigo"), (3, "Blinding Lights", "the weeknd")]
+    assert version == len(db.MIGRATIONS)
+
+
+def test_metrics(client):
+    """Test the Prometheus metrics endpoint
+    
+    ensures that requests are timed by route and status, the queries they ran are timed by kind and the connection
+    pool is reported
+
+    asserts the request and query histograms count the add and the pool gauges are present
+    """
+    before = db.QUERY_SECONDS.count("insert")
+    client.post("/add_track", json={"title": "good 4 u", "artist": "Olivia Rodrigo"})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert 'db_request_seconds_count{route="/add_track",method="POST",status="200"}' in text
+    assert db.QUERY_SECONDS.count("insert") == before + 1
+    assert "db_pool_idle " in text
+
 # ============================================= UNHAPPY PATHS ===================================================================
 
 def test_add_duplicate_track(client):
@@ -80,6 +397,21 @@ def test_add_duplicate_track(client):
     assert response.status_code == 409
     assert response.json["error"] == "Track already exists"
 
+def test_add_duplicate_track_different_case(client):
+    """Test preventing duplicates that only differ by case or spacing
+    
+    ensures that a track is treated as already added when its title and artist match an existing track apart from
+    capitalisation and extra whitespace, and that it can be removed the same way 
+    
+    asserts code 409 for the duplicate, only one track stored, and code 200 removing it with different case
+    """
+    client.post("/add_track", json={"title": "good 4 u", "artist": "Olivia Rodrigo"})
+    response = client.post("/add_track", json={"title": "Good 4 U ", "artist": "olivia  rodrigo"})
+    assert response.status_code == 409
+    assert len(client.get("/tracks").json) == 1
+    response = client.post("/remove_track", json={"title": "GOOD 4 U", "artist": "OLIVIA RODRIGO"})
+    assert response.status_code == 200
+
 def test_remove_nonexistent_track(client):
     """Test removing a track that does not exist
     
@@ -133,4 +465,52 @@ def test_invalid_input_type_remove(client):
     """
     response = client.post("/remove_track", json={"title": "good 4 u", "artist": 4})
     assert response.status_code == 400
-    assert response.json["error"] == "'artist' and 'title' must be strings"
\ No newline at end of file
+    assert response.json["error"] == "'artist' and 'title' must be strings"
+
+def test_get_tracks_invalid_paging(client):
+    """Test paging with invalid values
+    
+    ensures that a non numeric after_id or a limit outside 1 to 1000 is rejected 
+    
+    asserts code 400 for each
+    """
+    assert client.get("/tracks?after_id=abc").status_code == 400
+    assert client.get("/tracks?limit=0").status_code == 400
+    assert client.get("/tracks?limit=5000").status_code == 400
+
+def test_search_missing_query(client):
+    """Test searching without a query
+    
+    asserts 400 for bad request and message 'Missing search query 'q''
+    """
+    response = client.get("/search")
+    assert response.status_code == 400
+    assert response.json["error"] == "Missing search query 'q'"
+
+def test_add_tracks_bulk_not_list(client):
+    """Test bulk adding with a payload that is not a list
+    
+    asserts 400 for bad request and message 'Request must be a list of tracks'
+    """
+    response = client.post("/tracks/bulk", json={"title": "good 4 u", "artist": "Olivia Rodrigo"})
+    assert response.status_code == 400
+    assert response.json["error"] == "Request must be a list of tracks"
+
+def test_import_tracks_csv_missing_column(client):
+    """Test importing a CSV without an artist column
+    
+    asserts 400 for bad request and that nothing was added
+    """
+    response = client.post("/tracks/bulk", data="title\r\ngood 4 u\r\n", content_type="text/csv")
+    assert response.status_code == 400
+    assert response.json["error"] == "CSV must have a header row with 'title' and 'artist' columns"
+    assert client.get("/tracks").json == []
+
+def test_add_tracks_bulk_unsupported_type(client):
+    """Test bulk adding with a body that is not JSON, NDJSON or CSV
+    
+    asserts 400 for bad request and message 'Request must be JSON, NDJSON or CSV'
+    """
+    response = client.post("/tracks/bulk", data="good 4 u", content_type="text/plain")
+    assert response.status_code == 400
+    assert response.json["error"] == "Request must be JSON, NDJSON or CSV"
@@ -0,0 +1,186 @@
+import os
+import time
+
+import numpy as np
+
+import audio
+
+# Fingerprint parameters, tuned for short (5-15 second) snippets of music
+SAMPLE_RATE = 8000  # audio is resampled to this rate before hashing
+WINDOW_SIZE = 1024  # samples per FFT frame
+HOP_SIZE = 256  # samples between FFT frames (32 ms at 8 kHz)
+MIN_BIN = 5  # bins below this (~40 Hz) are ignored, they are mostly rumble and DC offset
+PEAK_FRAMES = 15  # a peak must be the loudest point in a neighbourhood this many frames wide
+PEAK_BINS = 31  # and this many frequency bins tall
+FAN_OUT = 10  # number of later peaks each anchor peak is paired with
+MAX_DELTA = 63  # maximum frame distance between the two peaks of a pair
+MIN_MATCHES = 20  # minimum number of time-aligned hashes for a confident match
+
+
+def load_wav(file_path):
+    """ Function reads a WAV file and returns mono float samples in the range -1..1 and the sample rate
+
+    raises ValueError if the file is not a WAV format that can be decoded
+    """
+    with open(file_path, 'rb') as file:
+        return audio.read_stream(file)
+
+
+def resample(samples, rate, target_rate=SAMPLE_RATE):
+    """ Function resamples audio to the target rate, averaging blocks first so higher frequencies do not alias """
+    if rate == target_rate:
+        return samples
+    factor = rate // target_rate
+    if factor > 1:
+        usable = len(samples) - len(samples) % factor
+        samples = samples[:usable].reshape(-1, factor).mean(axis=1)  # cheap low pass and decimate
+        rate = rate / factor
+    if rate == target_rate:
+        return samples
+    positions = np.arange(0, len(samples), rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def spectrogram(samples):
+    """ Function returns the log magnitude spectrogram of the samples as a (frames, bins) array """
+    if len(samples) < WINDOW_SIZE:
+        return np.zeros((0, WINDOW_SIZE // 2 + 1), dtype=np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, WINDOW_SIZE)[::HOP_SIZE]
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(WINDOW_SIZE), axis=1))
+    return np.log(spectrum + 1e-6)
+
+
+def find_peaks(spec):
+    """ Function finds the constellation of spectrogram peaks, points that are the loudest in their neighbourhood
+    and louder than the spectrogram average
+
+    returns an array of (frame, bin) pairs sorted by frame
+    """
+    if len(spec) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    padded = np.pad(spec, ((PEAK_FRAMES // 2,), (PEAK_BINS // 2,)), constant_values=-np.inf)
+    # the 2D maximum filter is separable, so run it along time then along frequency
+    local_max = np.lib.stride_tricks.sliding_window_view(padded, PEAK_FRAMES, axis=0).max(axis=-1)
+    local_max = np.lib.stride_tricks.sliding_window_view(local_max, PEAK_BINS, axis=1).max(axis=-1)
+    peaks = (spec == local_max) & (spec > spec.mean())
+    peaks[:, :MIN_BIN] = False
+    return np.argwhere(peaks)  # argwhere returns row major order, so peaks are already sorted by frame
+
+
+def hash_peaks(peaks):
+    """ Function pairs each anchor peak with the next peaks in time and packs every pair into one integer hash
+
+    returns two arrays: the hashes and the frame of each anchor peak
+    """
+    hashes = []
+    times = []
+    for offset in range(1, FAN_OUT + 1):
+        anchor = peaks[:-offset]
+        target = peaks[offset:]
+        delta = target[:, 0] - anchor[:, 0]
+        keep = (delta > 0) & (delta <= MAX_DELTA)
+        hashes.append((anchor[keep, 1] << 16) | (target[keep, 1] << 6) | delta[keep])
+        times.append(anchor[keep, 0])
+    return np.concatenate(hashes).astype(np.int64), np.concatenate(times).astype(np.int64)
+
+
+def fingerprint(samples, rate):
+    """ Function turns audio samples into constellation hashes, returns (hashes, anchor frames) """
+    samples = resample(samples, rate)
+    return hash_peaks(find_peaks(spectrogram(samples)))
+
+
+def fingerprint_file(file_path):
+    """ Function fingerprints a WAV file on disk, raises ValueError if the file cannot be decoded """
+    samples, rate = load_wav(file_path)
+    return fingerprint(samples, rate)
+
+
+class FingerprintIndex:
+    """ In memory hash index over a set of reference tracks
+
+    hashes are kept in one sorted array so a snippet is matched with a binary search per hash instead of
+    a dictionary of python lists
+    """
+
+    def __init__(self):
+        self.tracks = []  # track metadata, position in the list is the track id
+        self._hashes = np.zeros(0, dtype=np.int64)
+        self._track_ids = np.zeros(0, dtype=np.int64)
+        self._times = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add(self, track, hashes, times):
+        """ Function adds the fingerprint of one reference track to the index """
+        track_id = len(self.tracks)
+        self.tracks.append(track)
+        hashes = np.concatenate([self._hashes, hashes])
+        track_ids = np.concatenate([self._track_ids, np.full(len(times), track_id, dtype=np.int64)])
+        times = np.concatenate([self._times, times])
+        order = np.argsort(hashes, kind='stable')
+        self._hashes, self._track_ids, self._times = hashes[order], track_ids[order], times[order]
+
+    def match(self, hashes, times):
+        """ Function finds the reference track whose hashes line up best with the snippet's hashes
+
+        returns (track, score) where score is the number of time aligned hashes, or (None, score) if no
+        track reaches MIN_MATCHES
+        """
+        if len(hashes) == 0 or len(self._hashes) == 0:
+            return None, 0
+
+        starts = np.searchsorted(self._hashes, hashes, side='left')
+        ends = np.searchsorted(self._hashes, hashes, side='right')
+        counts = ends - starts
+        if counts.sum() == 0:
+            return None, 0
+
+        # expand every snippet hash into all of the reference positions that share it
+        query = np.repeat(np.arange(len(hashes)), counts)
+        positions = np.repeat(ends - counts.cumsum(), counts) + np.arange(counts.sum())
+        offsets = self._times[positions] - times[query]
+        track_ids = self._track_ids[positions]
+
+        # a true match has many hashes sharing the same track and the same time offset
+        keys = track_ids * (1 << 32) + (offsets - offsets.min())
+        unique, votes = np.unique(keys, return_counts=True)
+        best = votes.argmax()
+        score = int(votes[best])
+        if score < MIN_MATCHES:
+            return None, score
+        return self.tracks[int(unique[best] >> 32)], score
+
+
+def build_index(references, audio_dir):
+    """ Function builds a FingerprintIndex from a mapping of reference filename to track metadata
+
+    files that cannot be decoded are skipped, raises FileNotFoundError if a file is missing, as an index quietly
+    built without it would just stop recognising that track
+    """
+    index = FingerprintIndex()
+    for filename, track in references.items():
+        file_path = os.path.join(audio_dir, filename)
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"reference track {filename!r} is not in {audio_dir}")
+        try:
+            hashes, times = fingerprint_file(file_path)
+        except ValueError:
+            continue
+        index.add(track, hashes, times)
+    return index
+
+
+def identify_file(index, file_path):
+    """ Function matches a snippet on disk against the index
+
+    returns (track, score, seconds taken), track is None when the snippet is not recognised locally
+    """
+    start = time.perf_counter()
+    try:
+        hashes, times = fingerprint_file(file_path)
+    except ValueError:
+        return None, 0, time.perf_counter() - start
+    track, score = index.match(hashes, times)
+    return track, score, time.perf_counter() - start
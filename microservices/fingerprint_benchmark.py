@@ -0,0 +1,67 @@
+""" Benchmark for the local fingerprint engine
+
+Matches every bundled snippet (the _*.wav files) against the index of reference tracks and reports how many were
+identified correctly and how long matching took.
+
+usage: python fingerprint_benchmark.py [--repeat 20]
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+
+import fingerprint
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def run(repeat):
+    with open(os.path.join(BASE_DIR, "references.json")) as f:
+        references = json.load(f)
+
+    start = time.perf_counter()
+    index = fingerprint.build_index(references, BASE_DIR)
+    build_time = time.perf_counter() - start
+
+    results = []
+    for file_path in sorted(glob.glob(os.path.join(BASE_DIR, "_*.wav"))):
+        snippet = os.path.basename(file_path)
+        expected = references.get(snippet[1:])  # snippet "_x.wav" comes from reference "x.wav" if we have it
+        timings = []
+        for _ in range(repeat):
+            track, score, seconds = fingerprint.identify_file(index, file_path)
+            timings.append(seconds * 1000)
+        results.append({
+            "snippet": snippet,
+            "expected": expected["title"] if expected else None,
+            "matched": track["title"] if track else None,
+            "score": score,
+            "correct": track == expected,
+            "mean_ms": round(statistics.mean(timings), 2),
+            "max_ms": round(max(timings), 2),
+        })
+    return build_time, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark local fingerprint matching over the bundled snippets")
+    parser.add_argument("--repeat", type=int, default=20, help="number of times each snippet is matched")
+    args = parser.parse_args()
+
+    build_time, results = run(args.repeat)
+    print(f"index built in {build_time * 1000:.1f} ms")
+    print(f"{'snippet':<50} {'expected':<45} {'matched':<45} {'score':>6} {'mean ms':>8} {'max ms':>8}")
+    for r in results:
+        print(f"{r['snippet']:<50} {str(r['expected']):<45} {str(r['matched']):<45} "
+              f"{r['score']:>6} {r['mean_ms']:>8} {r['max_ms']:>8}")
+
+    correct = sum(r["correct"] for r in results)
+    local_hits = sum(r["matched"] is not None for r in results)
+    print(f"accuracy: {correct}/{len(results)} correct, {local_hits} matched locally, "
+          f"{len(results) - local_hits} would fall back to the audd API")
+
+
+if __name__ == "__main__":
+    main()
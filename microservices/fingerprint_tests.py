@@ -0,0 +1,93 @@
+import pytest
+import os
+import numpy as np
+import fingerprint
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+REFERENCES = {
+    "Blinding Lights.wav": {"title": "Blinding Lights", "artist": "The Weeknd"},
+    "good 4 u.wav": {"title": "good 4 u", "artist": "Olivia Rodrigo"},
+}
+
+
+@pytest.fixture(scope="module")
+def index():
+    """Fingerprint index built over two of the bundled reference tracks."""
+    return fingerprint.build_index(REFERENCES, BASE_DIR)
+
+
+# ================================================ HAPPY PATH =========================================================================
+
+def test_build_index(index):
+    """Test building the index
+    
+    ensures that every reference track that exists on disk is fingerprinted and added to the index 
+
+    asserts the index holds both reference tracks
+    """
+    assert len(index) == 2
+
+
+def test_match_snippet(index):
+    """Test matching a recorded snippet
+    
+    ensures that the bundled snippet of Blinding Lights is matched to its reference track locally 
+
+    asserts the matched track is 'Blinding Lights' by 'The Weeknd'
+    """
+    track, score, _ = fingerprint.identify_file(index, os.path.join(BASE_DIR, "_Blinding Lights.wav"))
+    assert track == {"title": "Blinding Lights", "artist": "The Weeknd"}
+    assert score >= fingerprint.MIN_MATCHES
+
+
+def test_match_offset_excerpt(index):
+    """Test matching an excerpt cut at an arbitrary sample offset
+    
+    ensures matching does not depend on the snippet lining up with the reference's FFT frames 
+
+    asserts a 5 second excerpt from the middle of 'good 4 u' is matched to it
+    """
+    samples, rate = fingerprint.load_wav(os.path.join(BASE_DIR, "good 4 u.wav"))
+    excerpt = samples[rate * 3 + 1234: rate * 8]
+    track, score = index.match(*fingerprint.fingerprint(excerpt, rate))
+    assert track["title"] == "good 4 u"
+
+
+# ================================================ UNHAPPY PATHS =========================================================================
+
+def test_no_match_for_unknown_audio(index):
+    """Test matching audio that is not in the index
+    
+    ensures that noise is not matched to any reference track so the service falls back to the audd API 
+
+    asserts no track is returned
+    """
+    noise = np.random.default_rng(0).uniform(-1, 1, 48000 * 5).astype(np.float32)
+    track, score = index.match(*fingerprint.fingerprint(noise, 48000))
+    assert track is None
+
+
+def test_undecodable_file(index, tmp_path):
+    """Test matching a file that is not a WAV file
+    
+    ensures that a file that cannot be decoded is treated as a local miss instead of raising an error 
+
+    asserts no track is returned
+    """
+    file_path = tmp_path / "not_audio.wav"
+    file_path.write_bytes(os.urandom(10))
+    track, score, _ = fingerprint.identify_file(index, str(file_path))
+    assert track is None
+    assert score == 0
+
+
+def test_build_index_missing_reference(tmp_path):
+    """Test building the index when a listed reference track is not on disk
+    
+    ensures that a missing reference is reported instead of the index quietly being built without it 
+
+    asserts FileNotFoundError naming the missing file
+    """
+    with pytest.raises(FileNotFoundError, match="Blinding Lights.wav"):
+        fingerprint.build_index(REFERENCES, str(tmp_path))
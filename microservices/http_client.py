@@ -0,0 +1,161 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """ Raised instead of making a request while a service's circuit breaker is open """
+
+
+class CircuitBreaker:
+    """ Stops requests to a service that keeps failing so callers fail fast instead of waiting on timeouts
+
+    after failure_threshold failures in a row the circuit opens and every request is refused for reset_timeout
+    seconds, then one trial request is let through (half open): if it succeeds the circuit closes again, if it fails
+    the circuit opens for another reset_timeout
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        """ Function returns True if a request may be made now """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True  # only one trial request at a time
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+                self.opened_at = time.monotonic()  # a failed trial request reopens the circuit
+
+
+class CountingRetry(Retry):
+    """ urllib3 Retry that calls on_retry every time a request is retried """
+
+    def __init__(self, *args, on_retry=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_retry = on_retry
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)  # urllib3 makes a new Retry object for every attempt
+        retry.on_retry = self.on_retry
+        return retry
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)  # raises once the retries are used up, so that is not counted
+        if self.on_retry is not None:
+            self.on_retry()
+        return retry
+
+
+class ServiceClient:
+    """ HTTP client for one upstream service, keeping connections open between requests
+
+    requests go through a requests.Session with a connection pool of pool_size, connection errors and 5xx responses
+    are retried with exponential backoff, and an optional CircuitBreaker refuses requests while the service is down
+    """
+
+    def __init__(self, name, pool_size=10, retries=3, backoff=0.2, timeout=30, breaker=None):
+        self.name = name
+        self.timeout = timeout
+        self.breaker = breaker
+        self._lock = threading.Lock()
+        self._counts = {"requests": 0, "retries": 0, "errors": 0, "rejected": 0}
+
+        retry = CountingRetry(
+            total=retries,
+            connect=retries,
+            read=0,  # a read error means the service may already have acted on the request
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({"GET", "POST"}),
+            raise_on_status=False,  # return the last 5xx response instead of raising once retries run out
+            on_retry=lambda: self._count("retries"),
+        )
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def post(self, url, **kwargs):
+        """ Function sends a POST request through the pool, same arguments as requests.post
+
+        raises CircuitOpenError without sending anything if the circuit breaker is open
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            self._count("rejected")
+            raise CircuitOpenError(f"{self.name} service is unavailable, circuit breaker is open")
+
+        kwargs.setdefault("timeout", self.timeout)
+        self._count("requests")
+        try:
+            response = self.session.post(url, **kwargs)
+        except requests.RequestException:
+            self._count("errors")
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+
+        if self.breaker is not None:
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        return response
+
+    def stats(self):
+        """ Function returns the request, retry and connection reuse counters """
+        connections = 0
+        pooled_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+        with self._lock:
+            counts = dict(self._counts)
+        counts["connections_opened"] = connections
+        counts["connections_reused"] = max(pooled_requests - connections, 0)  # requests that did not need a new connection
+        if self.breaker is not None:
+            counts["circuit"] = self.breaker.state
+            counts["circuit_trips"] = self.breaker.trips
+        return counts
@@ -0,0 +1,131 @@
+import pytest
+import threading
+import time
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from http_client import ServiceClient, CircuitBreaker, CircuitOpenError
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers every POST with the next status code in the server's list, 200 once the list is used up."""
+    protocol_version = "HTTP/1.1"  # keep-alive, so connections can be reused
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    """Local HTTP server running on a background thread."""
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.statuses = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+# ============================================= HAPPY PATHS ======================================================================
+
+def test_connection_reuse(server):
+    """Test requests share one kept-alive connection
+    
+    ensures that several requests in a row to the same service only open one connection 
+
+    asserts one connection opened and the other two requests reused it
+    """
+    client = ServiceClient("test")
+    for _ in range(3):
+        assert client.post(url(server), json={}).status_code == 200
+    stats = client.stats()
+    assert stats["connections_opened"] == 1
+    assert stats["connections_reused"] == 2
+
+
+def test_retry_on_server_error(server):
+    """Test 5xx responses are retried
+    
+    ensures that a request that gets a 503 then a 200 is retried and succeeds 
+
+    asserts code 200 and one retry counted
+    """
+    server.statuses = [503]
+    client = ServiceClient("test", backoff=0)
+    assert client.post(url(server), json={}).status_code == 200
+    assert client.stats()["retries"] == 1
+
+
+def test_circuit_closes_after_reset(server):
+    """Test the circuit breaker lets a trial request through after the reset timeout
+    
+    asserts the circuit is closed again after a successful trial request
+    """
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    client = ServiceClient("test", retries=0, breaker=breaker)
+    server.statuses = [500]
+    client.post(url(server), json={})
+    assert breaker.state == "open"
+    time.sleep(0.15)
+    assert client.post(url(server), json={}).status_code == 200
+    assert breaker.state == "closed"
+
+
+# ============================================= UNHAPPY PATHS ===================================================================
+
+def test_retries_used_up(server):
+    """Test a service that keeps failing
+    
+    ensures the last 5xx response is returned once the retries run out rather than raising 
+
+    asserts code 500 and two retries counted
+    """
+    server.statuses = [500, 500, 500]
+    client = ServiceClient("test", retries=2, backoff=0)
+    assert client.post(url(server), json={}).status_code == 500
+    assert client.stats()["retries"] == 2
+
+
+def test_circuit_opens(server):
+    """Test the circuit breaker stops requests to a failing service
+    
+    ensures that after the failure threshold is reached requests fail straight away without being sent 
+
+    asserts CircuitOpenError is raised and the request is counted as rejected
+    """
+    client = ServiceClient("test", retries=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    server.statuses = [500, 500]
+    client.post(url(server), json={})
+    client.post(url(server), json={})
+    with pytest.raises(CircuitOpenError):
+        client.post(url(server), json={})
+    stats = client.stats()
+    assert stats["circuit"] == "open"
+    assert stats["rejected"] == 1
+    assert stats["requests"] == 2
+
+
+def test_connection_refused():
+    """Test a service that is not running
+    
+    ensures that connection errors are raised as requests exceptions and count towards opening the circuit 
+
+    asserts requests.ConnectionError is raised and the circuit opens
+    """
+    breaker = CircuitBreaker(failure_threshold=1)
+    client = ServiceClient("test", retries=1, backoff=0, breaker=breaker)
+    with pytest.raises(requests.ConnectionError):
+        client.post("http://127.0.0.1:1/", json={})
+    assert breaker.state == "open"
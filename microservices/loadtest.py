@@ -0,0 +1,162 @@
+""" Load test comparing the synchronous (Flask) and asynchronous (ASGI) serving modes of the audd microservice
+
+Starts the local stub of the audd API and database (audd_stub.py), then starts each serving mode in turn pointed at
+the stub and fires identify requests at it with a fixed number in flight. Every request uses a different file so the
+result cache and the local fingerprint index miss and each one goes upstream.
+
+usage: python loadtest.py [--requests 500] [--concurrency 100] [--latency 0.1] [--json results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import aiohttp
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+MODES = {
+    "sync": [sys.executable, "-m", "flask", "--app", "audd:audd_app", "run", "--with-threads", "--port"],
+    "async": [sys.executable, "-m", "uvicorn", "audd_async:audd_async_app", "--log-level", "warning", "--port"],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(command, port, cwd, env, ready_path):
+    """ Function starts a server process and waits until ready_path answers, the port is put in place of {port}
+    in the command or added to the end of it if there is no {port}
+    """
+    if any("{port}" in part for part in command):
+        command = [part.format(port=port) for part in command]
+    else:
+        command = command + [str(port)]
+    process = subprocess.Popen(command, cwd=cwd, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}{ready_path}", timeout=1)
+            return process
+        except urllib.error.HTTPError:
+            return process  # the server answered, even if with an error status
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"server did not start: {' '.join(command)}")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def drive(port, filenames, concurrency):
+    """ Function sends one identify request per filename with at most concurrency in flight, returns the stats """
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(f"http://127.0.0.1:{port}", connector=connector) as session:
+        async def one(filename):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.post("/identify", json={"filename": filename}) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(filename) for filename in filenames))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(filenames),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(filenames) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def run_mode(mode, stub_port, args):
+    with tempfile.TemporaryDirectory() as audio_dir:
+        filenames = []
+        for i in range(args.requests):
+            filename = f"clip_{i}.wav"
+            with open(os.path.join(audio_dir, filename), "wb") as f:
+                f.write(os.urandom(1024))  # unique content, so every request misses the cache
+            filenames.append(filename)
+
+        env = dict(os.environ,
+                   PYTHONPATH=BASE_DIR,
+                   API_KEY=os.environ.get("API_KEY", "loadtest"),
+                   AUDD_URL=f"http://127.0.0.1:{stub_port}/",
+                   DB_URL=f"http://127.0.0.1:{stub_port}",
+                   IDENTIFY_CACHE_PATH=os.path.join(audio_dir, "cache.db"),
+                   TRACK_SPOOL_PATH=os.path.join(audio_dir, "spool.db"))
+        port = free_port()
+        server = start_server(MODES[mode], port, audio_dir, env, "/stats")  # the service reads files from its cwd
+        try:
+            asyncio.run(drive(port, filenames[:args.concurrency], args.concurrency))  # warm up connections and threads
+            return asyncio.run(drive(port, filenames[args.concurrency:], args.concurrency))
+        finally:
+            stop_server(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sync and async serving modes of the audd service")
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per mode")
+    parser.add_argument("--concurrency", type=int, default=100, help="requests kept in flight")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds the stub audd API takes per request")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+    args.requests += args.concurrency  # the first batch of files is used for warm up
+
+    stub_port = free_port()
+    stub_env = dict(os.environ, STUB_LATENCY=str(args.latency))
+    stub = start_server([sys.executable, "-m", "uvicorn", "audd_stub:stub_app", "--log-level", "warning", "--port"],
+                        stub_port, BASE_DIR, stub_env, "/")
+    try:
+        results = {mode: run_mode(mode, stub_port, args) for mode in args.modes}
+    finally:
+        stop_server(stub)
+
+    print(f"{'mode':<8} {'requests':>9} {'errors':>7} {'rps':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for mode, r in results.items():
+        print(f"{mode:<8} {r['requests']:>9} {r['errors']:>7} {r['rps']:>8} {r['p50_ms']:>8} {r['p99_ms']:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"latency": args.latency, "concurrency": args.concurrency, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
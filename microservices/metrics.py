@@ -0,0 +1,299 @@
+""" Request metrics in the Prometheus text format, and an opt-in profiler for slow requests
+
+each service keeps a Registry of counters, gauges and histograms, and instrument() hooks a Flask app so every
+request is timed by route, counted by status and tracked while in flight, with the registry served at /metrics.
+Recording a value is a dictionary lookup and an addition under a lock, so it stays on in production
+
+the values are kept in memory, so under gunicorn each worker process has its own and /metrics shows those of the
+worker that answered. serve.py calls label_by_worker(), which labels every sample with worker="<pid>" so a scraper
+can tell the workers apart: sum counters and histograms over the worker label to get the service's totals. Gauges
+read from something shared, like the spool's depth, are the same in every worker and want max instead
+
+slow request tracing is off unless PROFILE_SLOW_MS is set. When it is, the stage timings of every request slower
+than that are written as JSON to PROFILE_DIR, and a PROFILE_SAMPLE fraction of requests also run under cProfile,
+whose stats are written next to the trace if the request turns out slow
+"""
+import bisect
+import contextvars
+import cProfile
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import flask
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", 0))  # 0 turns slow request tracing off
+PROFILE_SAMPLE = float(os.environ.get("PROFILE_SAMPLE", 0.01))  # fraction of requests run under cProfile
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "shamzam_profiles"))
+
+_trace = contextvars.ContextVar("trace", default=None)  # stage timings of the request being handled
+_worker_label = False  # whether samples are labelled with the process id, see label_by_worker()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def label_by_worker():
+    """ Function labels every sample rendered from now on with worker="<pid>", for services run as several worker
+    processes that each keep their own metrics. Called before the workers are forked, each renders its own pid
+    """
+    global _worker_label
+    _worker_label = True
+
+
+class Registry:
+    """ The metrics of one service, rendered together for /metrics
+
+    callbacks registered with add_callback are run at scrape time and return extra samples as
+    (name, type, help, [(labels dict, value), ...]), for counters that are already kept elsewhere
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._callbacks = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def render(self):
+        """ Function returns every metric in the Prometheus text exposition format """
+        extra = [("worker", os.getpid())] if _worker_label else []
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(extra))
+        for callback in self._callbacks:
+            for name, kind, help_text, samples in callback():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(labels.keys(), labels.values(), extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.register(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """ A count that only goes up, e.g. requests served """
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def render(self, extra=()):
+        with self._lock:
+            values = dict(self._values)
+        return self._header() + [f"{self.name}{_labels(self.labelnames, key, extra)} {value}"
+                                 for key, value in values.items()]
+
+
+class Gauge(Counter):
+    """ A value that goes up and down, e.g. requests in flight """
+    kind = "gauge"
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+class Histogram(_Metric):
+    """ Distribution of durations in seconds, counted into buckets so percentiles can be worked out when scraped """
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)  # the first bucket the value fits in, counted cumulatively later
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            if counts is None:
+                counts = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """ Function times the block and observes the seconds it took, also adding it to the slow request trace of
+        the current request when tracing is on
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(elapsed, *labelvalues)
+            trace = _trace.get()
+            if trace is not None:
+                trace.append((":".join(map(str, labelvalues)) or self.name, round(elapsed * 1000, 3)))
+
+    def count(self, *labelvalues):
+        with self._lock:
+            counts = self._values.get(labelvalues)
+            return sum(counts[0]) if counts else 0
+
+    def render(self, extra=()):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = self._header()
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [*extra, ('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key, extra)} {round(total, 6)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key, extra)} {cumulative}")
+        return lines
+
+
+def stats_gauges(prefix, sources):
+    """ Function returns a Registry callback that exposes the stats() dictionaries a service already keeps as gauges
+
+    sources maps a name to a function returning a stats dict, each number in it becomes {prefix}_{name}_{key},
+    a dict of numbers becomes one gauge labelled by its keys and a string (like a circuit state) a gauge of 1
+    labelled with the value
+    """
+    def collect():
+        samples = []
+        for source, stats in sources.items():
+            for key, value in stats().items():
+                if isinstance(value, dict):
+                    values = [({"name": name}, number) for name, number in value.items()]
+                elif isinstance(value, str):
+                    values = [({"state": value}, 1)]
+                else:
+                    values = [({}, int(value) if isinstance(value, bool) else value)]
+                samples.append((f"{prefix}_{source}_{key}", "gauge", f"{key} from the {source} stats", values))
+        return samples
+    return collect
+
+
+def _dump_slow_request(route, elapsed_ms, trace, profile):
+    """ Function writes the stage timings (and cProfile stats if the request was profiled) of a slow request """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}_{re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'}_{int(elapsed_ms)}ms"
+    path = os.path.join(PROFILE_DIR, name)
+    with open(path + ".json", "w") as f:
+        json.dump({"route": route, "ms": round(elapsed_ms, 3), "stages_ms": trace}, f, indent=2)
+    if profile is not None:
+        profile.dump_stats(path + ".prof")  # open with python -m pstats or snakeviz
+
+
+def instrument(app, registry, prefix, g=flask.g, request=flask.request, asynchronous=False):
+    """ Function adds request metrics and a /metrics endpoint to a Flask app, or to a Quart app when given Quart's g
+    and request with asynchronous=True
+
+    records {prefix}_request_seconds by route, method and status, {prefix}_requests_in_flight,
+    {prefix}_request_errors_total for 5xx responses and unhandled exceptions, and {prefix}_slow_requests_total.
+    Returns the request duration histogram
+    """
+    def hook(function):
+        if not asynchronous:
+            return function
+
+        async def run(*args):
+            return function(*args)  # the hooks never block, so they run on the event loop rather than a thread
+        run.__name__ = function.__name__
+        return run
+
+    duration = Histogram(registry, f"{prefix}_request_seconds", "Time spent handling requests",
+                         ("route", "method", "status"))
+    in_flight = Gauge(registry, f"{prefix}_requests_in_flight", "Requests being handled right now")
+    errors = Counter(registry, f"{prefix}_request_errors_total", "Requests that failed with a 5xx status",
+                     ("route", "method"))
+    slow = Counter(registry, f"{prefix}_slow_requests_total", "Requests slower than PROFILE_SLOW_MS", ("route",))
+
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        in_flight.inc()
+        if PROFILE_SLOW_MS:
+            g.metrics_trace = _trace.set([])
+            if not asynchronous and random.random() < PROFILE_SAMPLE:  # cProfile cannot tell interleaved tasks apart
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                    g.metrics_profile = profile
+                except ValueError:
+                    pass  # another profiler is already running on this interpreter
+
+    def finish(status):
+        """ Function records the request once it has a status, returns False if it was already recorded """
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return False
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else "unmatched"  # the rule, so ids in paths do not add labels
+        duration.observe(elapsed, route, request.method, status)
+        if status >= 500:
+            errors.inc(route, request.method)
+
+        profile = g.pop("metrics_profile", None)
+        if profile is not None:
+            profile.disable()
+        token = g.pop("metrics_trace", None)
+        if token is not None:
+            trace = _trace.get()
+            _trace.reset(token)
+            if elapsed * 1000 >= PROFILE_SLOW_MS:
+                slow.inc(route)
+                _dump_slow_request(route, elapsed * 1000, trace, profile)
+        return True
+
+    def record_request(response):
+        finish(response.status_code)
+        return response
+
+    def end_request(exception):
+        finish(500)  # only records anything when the view raised, as after_request does not run then
+        in_flight.dec()
+
+    def metrics():
+        """ Function outputs the service's metrics in the Prometheus text format """
+        return registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+    app.before_request(hook(start_timer))
+    app.after_request(hook(record_request))
+    app.teardown_request(hook(end_request))
+    app.add_url_rule("/metrics", "metrics", hook(metrics), methods=['GET'])
+
+    return duration
@@ -0,0 +1,170 @@
+import pytest
+import json
+import os
+from flask import Flask
+import metrics
+
+
+@pytest.fixture
+def app():
+    """Small Flask app instrumented with a fresh registry."""
+    app = Flask(__name__)
+    registry = metrics.Registry()
+    metrics.instrument(app, registry, "test")
+    stage = metrics.Histogram(registry, "test_stage_seconds", "Time in each stage", ("stage",))
+
+    @app.route("/tracks/<int:track_id>")
+    def track(track_id):
+        with stage.time("query"):
+            pass
+        return {"id": track_id}
+
+    @app.route("/broken")
+    def broken():
+        raise RuntimeError("database gone")
+
+    app.config["TESTING"] = False  # so the exception becomes a 500 response
+    return app
+
+# ============================================= HAPPY PATHS ======================================================================
+
+def test_counter_and_gauge():
+    """Test counters and gauges render in the Prometheus text format
+
+    asserts the HELP and TYPE lines and one sample per label value
+    """
+    registry = metrics.Registry()
+    counter = metrics.Counter(registry, "requests_total", "Requests served", ("route",))
+    gauge = metrics.Gauge(registry, "in_flight", "Requests in flight")
+    counter.inc("/identify")
+    counter.inc("/identify", amount=2)
+    gauge.inc()
+    gauge.dec()
+    text = registry.render()
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{route="/identify"} 3' in text
+    assert "in_flight 0" in text
+
+
+def test_histogram_buckets():
+    """Test histogram buckets are cumulative
+
+    ensures that each bucket counts every observation at or below its bound, ending with +Inf, sum and count
+
+    asserts the bucket, sum and count lines for three observations
+    """
+    registry = metrics.Registry()
+    histogram = metrics.Histogram(registry, "latency_seconds", "Latency", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 5):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{le="1"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert "latency_seconds_sum 5.15" in lines
+    assert "latency_seconds_count 3" in lines
+
+
+def test_stats_gauges():
+    """Test stats dictionaries are exposed as gauges
+
+    asserts numbers, nested dicts and strings each become gauges
+    """
+    registry = metrics.Registry()
+    registry.add_callback(metrics.stats_gauges("audd", {"http": lambda: {
+        "retries": 2, "circuit": "open", "stages_ms": {"decode": 1.5}}}))
+    text = registry.render()
+    assert "audd_http_retries 2" in text
+    assert 'audd_http_circuit{state="open"} 1' in text
+    assert 'audd_http_stages_ms{name="decode"} 1.5' in text
+
+
+def test_worker_label(monkeypatch):
+    """Test samples are labelled with the worker process when serving with several workers
+
+    ensures that after label_by_worker() counters, histogram buckets and stats gauges all carry the process id, so
+    the metrics of gunicorn's workers can be told apart
+
+    asserts the worker label on each kind of sample
+    """
+    monkeypatch.setattr(metrics, "_worker_label", False)
+    registry = metrics.Registry()
+    counter = metrics.Counter(registry, "requests_total", "Requests served", ("route",))
+    histogram = metrics.Histogram(registry, "latency_seconds", "Latency", buckets=(1,))
+    registry.add_callback(metrics.stats_gauges("audd", {"spool": lambda: {"depth": 3}}))
+    counter.inc("/identify")
+    histogram.observe(0.5)
+    metrics.label_by_worker()
+    worker = os.getpid()
+    lines = registry.render().splitlines()
+    assert f'requests_total{{route="/identify",worker="{worker}"}} 1' in lines
+    assert f'latency_seconds_bucket{{worker="{worker}",le="1"}} 1' in lines
+    assert f'latency_seconds_count{{worker="{worker}"}} 1' in lines
+    assert f'audd_spool_depth{{worker="{worker}"}} 3' in lines
+
+
+def test_instrument_requests(app):
+    """Test requests are recorded by route
+
+    ensures that requests are labelled with the route rule rather than the path, so ids do not add labels, and that
+    nothing is left in flight
+
+    asserts the request count for the rule and the in flight gauge
+    """
+    client = app.test_client()
+    client.get("/tracks/1")
+    client.get("/tracks/2")
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'test_request_seconds_count{route="/tracks/<int:track_id>",method="GET",status="200"} 2' in text
+    assert "test_requests_in_flight 1" in text  # the /metrics request itself
+    assert 'test_stage_seconds_count{stage="query"} 2' in text
+
+
+def test_slow_request_profile(app, tmp_path, monkeypatch):
+    """Test slow requests are written out with their stage timings and profile
+
+    ensures that with PROFILE_SLOW_MS set a request slower than it is counted and its trace, and cProfile stats when
+    sampled, are written to PROFILE_DIR
+
+    asserts the slow request counter, the JSON trace with the stage and the .prof file
+    """
+    monkeypatch.setattr(metrics, "PROFILE_SLOW_MS", 1e-6)  # every request counts as slow
+    monkeypatch.setattr(metrics, "PROFILE_SAMPLE", 1)
+    monkeypatch.setattr(metrics, "PROFILE_DIR", str(tmp_path))
+    client = app.test_client()
+    client.get("/tracks/1")
+
+    assert 'test_slow_requests_total{route="/tracks/<int:track_id>"} 1' in client.get("/metrics").get_data(as_text=True)
+    traces = list(tmp_path.glob("*tracks*.json"))
+    with open(traces[0]) as f:
+        trace = json.load(f)
+    assert trace["route"] == "/tracks/<int:track_id>"
+    assert trace["stages_ms"][0][0] == "query"
+    assert list(tmp_path.glob("*tracks*.prof"))
+
+# ============================================= UNHAPPY PATHS ===================================================================
+
+def test_request_error_counted(app):
+    """Test a view that raises is recorded as a 500
+
+    asserts the error counter and the request histogram both count it and nothing is left in flight
+    """
+    client = app.test_client()
+    assert client.get("/broken").status_code == 500
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'test_request_errors_total{route="/broken",method="GET"} 1' in text
+    assert 'test_request_seconds_count{route="/broken",method="GET",status="500"} 1' in text
+    assert "test_requests_in_flight 1" in text
+
+
+def test_profile_off_by_default(app, tmp_path, monkeypatch):
+    """Test nothing is traced or written while PROFILE_SLOW_MS is 0
+
+    asserts no files are written and the slow counter has no samples
+    """
+    monkeypatch.setattr(metrics, "PROFILE_SLOW_MS", 0)
+    monkeypatch.setattr(metrics, "PROFILE_DIR", str(tmp_path))
+    client = app.test_client()
+    client.get("/tracks/1")
+    assert os.listdir(tmp_path) == []
+    assert "test_slow_requests_total{" not in client.get("/metrics").get_data(as_text=True)
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import numpy as np
+
+import audio
+
+SILENCE_DB = -45  # frames quieter than this (dB relative to full scale) count as silence
+FRAME_SECONDS = 0.02  # length of the frames loudness is measured over when trimming silence
+PAD_SECONDS = 0.1  # audio kept either side of the non silent part so note onsets are not cut
+MAX_LEADING_SILENCE = 5  # extra seconds read past the duration cap so leading silence does not eat into the clip
+
+
+class Clip:
+    """ Audio that has been through the pre-processing pipeline
+
+    samples and rate are the processed mono audio, payload is the same audio encoded as a 16 bit PCM WAV ready to
+    upload, and stats holds the byte counts and the milliseconds spent in each stage
+    """
+
+    def __init__(self, samples, rate, payload, stats):
+        self.samples = samples
+        self.rate = rate
+        self.payload = payload
+        self.stats = stats
+
+
+class _CountingReader:
+    """ Wraps a stream and counts the bytes read through it """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def trim_silence(samples, rate, threshold_db=SILENCE_DB):
+    """ Function removes leading and trailing silence, measuring loudness over short frames
+
+    returns the samples unchanged if the whole clip is silent, so there is still something to identify
+    """
+    frame = max(int(rate * FRAME_SECONDS), 1)
+    frames = len(samples) // frame
+    if frames == 0:
+        return samples
+    rms = np.sqrt(np.mean(samples[:frames * frame].reshape(frames, frame) ** 2, axis=1))
+    loud = np.nonzero(20 * np.log10(rms + 1e-10) > threshold_db)[0]
+    if len(loud) == 0:
+        return samples
+    pad = int(rate * PAD_SECONDS)
+    start = max(loud[0] * frame - pad, 0)
+    end = min((loud[-1] + 1) * frame + pad, len(samples))
+    return samples[start:end]
+
+
+def preprocess(stream, target_rate, max_seconds):
+    """ Function runs the pre-processing pipeline on a WAV stream: decode and downmix, resample to target_rate, trim
+    silence, cap at max_seconds and encode as a 16 bit mono WAV
+
+    returns a Clip, raises ValueError if the stream is not a WAV that can be decoded
+    """
+    reader = _CountingReader(stream)
+    timings = {}
+    samples, rate = audio.read_stream(reader, target_rate, max_seconds + MAX_LEADING_SILENCE, timings=timings)
+    decoded_seconds = len(samples) / rate
+
+    start = time.perf_counter()
+    samples = trim_silence(samples, rate)[:int(rate * max_seconds)]
+    timings["trim"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    payload = audio.encode_wav(samples, rate)
+    timings["encode"] = time.perf_counter() - start
+
+    stats = {
+        "input_bytes": reader.bytes_read,
+        "output_bytes": len(payload),
+        "bytes_saved": max(reader.bytes_read - len(payload), 0),
+        "decoded_seconds": round(decoded_seconds, 3),
+        "output_seconds": round(len(samples) / rate, 3),
+        "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()},
+    }
+    return Clip(samples, rate, payload, stats)
+
+
+def preprocess_file(file_path, target_rate, max_seconds):
+    """ Function runs the pre-processing pipeline on a WAV file on disk, see preprocess """
+    with open(file_path, 'rb') as file:
+        return preprocess(file, target_rate, max_seconds)
+
+
+class PreprocessStats:
+    """ Running totals of the pre-processing pipeline across requests """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {"clips": 0, "input_bytes": 0, "output_bytes": 0, "bytes_saved": 0}
+        self._stage_ms = {}
+
+    def record(self, stats):
+        """ Function adds one clip's stats to the totals """
+        with self._lock:
+            self._totals["clips"] += 1
+            for name in ("input_bytes", "output_bytes", "bytes_saved"):
+                self._totals[name] += stats[name]
+            for stage, ms in stats["stages_ms"].items():
+                self._stage_ms[stage] = self._stage_ms.get(stage, 0.0) + ms
+
+    def snapshot(self):
+        """ Function returns the totals and the total milliseconds spent in each stage """
+        with self._lock:
+            totals = dict(self._totals)
+            totals["stages_ms"] = {stage: round(ms, 3) for stage, ms in self._stage_ms.items()}
+        return totals
@@ -0,0 +1,95 @@
+import pytest
+import io
+import os
+import numpy as np
+import audio
+import preprocess
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+
+def tone(seconds, rate=48000, amplitude=0.5):
+    """A 440 Hz sine wave."""
+    t = np.arange(int(seconds * rate)) / rate
+    return (amplitude * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+
+
+def wav_stream(samples, rate=48000):
+    return io.BytesIO(audio.encode_wav(samples, rate))
+
+
+# ============================================= HAPPY PATHS ======================================================================
+
+def test_trim_silence():
+    """Test leading and trailing silence is removed
+    
+    ensures 2 seconds of silence either side of a 1 second tone is cut down to the tone plus a little padding 
+
+    asserts the output length
+    """
+    rate = 16000
+    samples = np.concatenate([np.zeros(2 * rate), tone(1, rate), np.zeros(2 * rate)]).astype(np.float32)
+    trimmed = preprocess.trim_silence(samples, rate)
+    assert len(trimmed) == pytest.approx(rate * (1 + 2 * preprocess.PAD_SECONDS), abs=rate * preprocess.FRAME_SECONDS)
+
+
+def test_preprocess_pipeline():
+    """Test the whole pipeline on a 48 kHz clip with leading silence
+    
+    ensures the clip is resampled, trimmed, capped and that the stats add up 
+
+    asserts the output rate and length, the bytes saved and that every stage was timed
+    """
+    samples = np.concatenate([np.zeros(48000), tone(20)])  # 1 second of silence then 20 seconds of tone
+    clip = preprocess.preprocess(wav_stream(samples), 16000, 12)
+    assert clip.rate == 16000
+    assert len(clip.samples) == 16000 * 12
+    assert clip.stats["output_bytes"] == len(clip.payload)
+    assert clip.stats["bytes_saved"] == clip.stats["input_bytes"] - clip.stats["output_bytes"]
+    assert set(clip.stats["stages_ms"]) == {"decode", "resample", "trim", "encode"}
+
+
+def test_preprocess_extensible_wav():
+    """Test pre-processing the Davos snippet, which is a WAVE_FORMAT_EXTENSIBLE file
+    
+    asserts the clip is decoded and smaller than the original file
+    """
+    clip = preprocess.preprocess_file(os.path.join(BASE_DIR, "_Davos.wav"), 16000, 12)
+    assert clip.stats["output_seconds"] > 3
+    assert clip.stats["output_bytes"] < clip.stats["input_bytes"] / 2
+
+
+def test_stats_totals():
+    """Test the running totals across clips
+    
+    asserts clips, bytes saved and stage times are summed
+    """
+    totals = preprocess.PreprocessStats()
+    for _ in range(2):
+        totals.record({"input_bytes": 100, "output_bytes": 40, "bytes_saved": 60, "stages_ms": {"decode": 1.5}})
+    snapshot = totals.snapshot()
+    assert snapshot["clips"] == 2
+    assert snapshot["bytes_saved"] == 120
+    assert snapshot["stages_ms"] == {"decode": 3.0}
+
+
+# ============================================= UNHAPPY PATHS ===================================================================
+
+def test_trim_all_silence():
+    """Test a clip that is silent all the way through
+    
+    ensures it is left as it is rather than trimmed to nothing 
+
+    asserts the samples are unchanged
+    """
+    samples = np.zeros(16000, dtype=np.float32)
+    assert len(preprocess.trim_silence(samples, 16000)) == 16000
+
+
+def test_preprocess_not_a_wav():
+    """Test pre-processing something that is not a WAV
+    
+    asserts ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        preprocess.preprocess(io.BytesIO(os.urandom(100)), 16000, 12)
@@ -0,0 +1,75 @@
+""" Production serving of the microservices under gunicorn
+
+Each service is run by a pre-forked set of worker processes, each handling requests on a pool of threads (gunicorn's
+gthread worker), in place of the single process Werkzeug development server. The app is imported once in the
+master before it forks, so workers start quickly and share its memory. Nothing that is imported keeps a connection
+open or starts a thread: the identification cache and the spool create their SQLite files at import with a
+connection that is closed straight away, and the database schema, the connection pool, the fingerprint index, the
+spool's flusher and the audd API key are all set up on first use inside each worker.
+
+Each worker keeps its own metrics, so /metrics is labelled with the worker's pid (see metrics.py) and a scrape only
+sees the worker that answered it.
+
+On SIGTERM the workers stop accepting connections and finish the requests they are handling, for up to
+GRACEFUL_TIMEOUT seconds, then on_exit runs in each of them (the audd service sends what is left in its spool, the
+db service closes its connections). SIGINT (Ctrl-C) stops them straight away, on_exit still runs.
+
+run with: python db.py and python audd.py, configured by the environment:
+{PREFIX}_HOST, {PREFIX}_PORT - where the service listens, PREFIX is DB or AUDD (default 127.0.0.1 and 5000 / 8080)
+{PREFIX}_WORKERS - worker processes (default the number of CPUs)
+{PREFIX}_THREADS - threads per worker (default 4 for the db service, 16 for the audd service which mostly waits)
+WORKER_TIMEOUT - seconds a request can run before its worker is restarted (default 120)
+GRACEFUL_TIMEOUT - seconds workers are given to finish their requests when stopping (default 30)
+KEEPALIVE - seconds an idle keep-alive connection is held open (default 5)
+
+for development with the reloader and debugger use: flask --app db run --debug
+"""
+import os
+
+from gunicorn.app.base import BaseApplication
+
+import metrics
+
+
+class Server(BaseApplication):
+    """ Runs an already imported WSGI app under gunicorn with options given as a dictionary """
+
+    def __init__(self, app, options):
+        self.app = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            if name in self.cfg.settings:  # settings added in newer gunicorn versions are skipped on older ones
+                self.cfg.set(name, value)
+
+    def load(self):
+        return self.app
+
+
+def options(prefix, port, threads, on_exit=None):
+    """ Function returns the gunicorn settings of a service from the environment, see the module docstring """
+    def env(name, default):
+        return os.environ.get(f"{prefix}_{name}", default)
+
+    settings = {
+        "bind": f"{env('HOST', '127.0.0.1')}:{int(env('PORT', port))}",
+        "workers": int(env("WORKERS", os.cpu_count() or 1)),
+        "worker_class": "gthread",
+        "threads": int(env("THREADS", threads)),
+        "timeout": int(os.environ.get("WORKER_TIMEOUT", 120)),  # longer than an upstream call with its retries
+        "graceful_timeout": int(os.environ.get("GRACEFUL_TIMEOUT", 30)),
+        "keepalive": int(os.environ.get("KEEPALIVE", 5)),
+        "proc_name": prefix.lower(),
+        "control_socket_disable": True,  # both services would otherwise share gunicorn's default control socket path
+    }
+    if on_exit is not None:
+        settings["worker_exit"] = lambda server, worker: on_exit()  # after the worker's last request has finished
+    return settings
+
+
+def run(app, prefix, port, threads, on_exit=None):
+    """ Function serves app under gunicorn until it is stopped """
+    metrics.label_by_worker()  # before the fork, so every worker labels its samples with its own pid
+    Server(app, options(prefix, port, threads, on_exit)).run()
@@ -0,0 +1,49 @@
+import serve
+
+
+# ============================================= HAPPY PATHS ======================================================================
+
+def test_options_defaults(monkeypatch):
+    """Test the gunicorn settings of a service without any configuration
+
+    ensures that a service listens on localhost at its own port with one threaded worker per CPU
+
+    asserts the bind address, worker class, worker count and threads
+    """
+    for name in ("DB_HOST", "DB_PORT", "DB_WORKERS", "DB_THREADS"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(serve.os, "cpu_count", lambda: 3)
+    options = serve.options("DB", port=5000, threads=4)
+    assert options["bind"] == "127.0.0.1:5000"
+    assert (options["worker_class"], options["workers"], options["threads"]) == ("gthread", 3, 4)
+    assert "worker_exit" not in options
+
+
+def test_options_from_environment(monkeypatch):
+    """Test the gunicorn settings are read from the service's environment variables
+
+    ensures that the variables of one service do not change the other's settings
+
+    asserts the configured address, workers, threads and timeouts, and the other service's default port
+    """
+    monkeypatch.setenv("AUDD_HOST", "0.0.0.0")
+    monkeypatch.setenv("AUDD_PORT", "9090")
+    monkeypatch.setenv("AUDD_WORKERS", "5")
+    monkeypatch.setenv("AUDD_THREADS", "32")
+    monkeypatch.setenv("GRACEFUL_TIMEOUT", "10")
+    options = serve.options("AUDD", port=8080, threads=16)
+    assert options["bind"] == "0.0.0.0:9090"
+    assert (options["workers"], options["threads"], options["graceful_timeout"]) == (5, 32, 10)
+    assert serve.options("DB", port=5000, threads=4)["bind"].endswith(":5000")
+
+
+def test_on_exit_hook():
+    """Test on_exit is run by gunicorn's worker_exit hook
+
+    asserts the hook calls on_exit and the settings are accepted by gunicorn
+    """
+    calls = []
+    server = serve.Server(object(), serve.options("DB", port=5000, threads=4, on_exit=lambda: calls.append(1)))
+    server.cfg.worker_exit(None, None)
+    assert calls == [1]
+    assert server.cfg.worker_class_str == "gthread"
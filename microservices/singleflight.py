@@ -0,0 +1,90 @@
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls for the same key into one
+
+    the first caller for a key (the leader) runs the function, callers that arrive for the same key while it is
+    running wait for it and are given its result, or its exception, instead of running the function again. Once the
+    leader finishes the key is forgotten, so later calls run the function again
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counts = {"leaders": 0, "coalesced": 0}
+
+    def do(self, key, fn, *args):
+        """ Function returns (fn(*args), shared), shared is True when the result came from another caller's call """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            self._counts["leaders" if leader else "coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args)
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """ Function returns how many calls ran the function, how many shared another call's result and how many
+        keys are in flight right now
+        """
+        with self._lock:
+            return {**self._counts, "in_flight": len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """ SingleFlight for coroutines running on one event loop, see SingleFlight """
+
+    def __init__(self):
+        self._calls = {}
+        self._counts = {"leaders": 0, "coalesced": 0}
+
+    async def do(self, key, fn, *args):
+        """ Function returns (await fn(*args), shared), shared is True when the result came from another caller """
+        future = self._calls.get(key)
+        if future is not None:
+            self._counts["coalesced"] += 1
+            return await asyncio.shield(future), True  # a cancelled follower must not cancel the leader's call
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())  # no warning if nobody else was waiting
+        self._counts["leaders"] += 1
+        try:
+            result = await fn(*args)
+            future.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            future.cancel()  # the leader's request went away, the followers get the cancellation too
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._calls[key]
+
+    def stats(self):
+        return {**self._counts, "in_flight": len(self._calls)}
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import time
+from singleflight import SingleFlight, AsyncSingleFlight
+
+
+def run_concurrently(count, target):
+    """Start count threads on target at the same moment and wait for all of them, returning their results."""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def worker(i):
+        barrier.wait()
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+# ============================================= HAPPY PATHS ======================================================================
+
+def test_concurrent_calls_coalesced():
+    """Test concurrent calls for the same key share one call
+
+    ensures that while one call for a key is running, other calls for that key wait for it and get its result
+
+    asserts the function ran once, every caller got its result and the leader/coalesced counters
+    """
+    flights = SingleFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return "good 4 u"
+
+    results = run_concurrently(8, lambda: flights.do("key", slow))
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False] + [True] * 7
+    assert all(result == "good 4 u" for result, _ in results)
+    assert flights.stats() == {"leaders": 1, "coalesced": 7, "in_flight": 0}
+
+
+def test_different_keys_not_coalesced():
+    """Test calls for different keys run separately
+
+    asserts the function ran once per key
+    """
+    flights = SingleFlight()
+    results = run_concurrently(4, lambda: flights.do(threading.get_ident(), lambda: time.sleep(0.05)))
+    assert [shared for _, shared in results] == [False] * 4
+
+
+def test_later_call_runs_again():
+    """Test a key is forgotten once its call finishes
+
+    asserts a call after the first has finished runs the function again
+    """
+    flights = SingleFlight()
+    assert flights.do("key", lambda: 1) == (1, False)
+    assert flights.do("key", lambda: 2) == (2, False)
+
+
+def test_async_concurrent_calls_coalesced():
+    """Test concurrent coroutines for the same key share one call
+
+    asserts the coroutine function ran once and every caller got its result
+    """
+    flights = AsyncSingleFlight()
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "good 4 u"
+
+    async def main():
+        return await asyncio.gather(*(flights.do("key", slow) for _ in range(8)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert [result for result, _ in results] == ["good 4 u"] * 8
+    assert flights.stats() == {"leaders": 1, "coalesced": 7, "in_flight": 0}
+
+# ============================================= UNHAPPY PATHS ===================================================================
+
+def test_error_shared():
+    """Test an exception from the shared call reaches every caller
+
+    asserts every caller gets the exception and the key is forgotten afterwards
+    """
+    flights = SingleFlight()
+
+    def failing():
+        time.sleep(0.1)
+        raise ConnectionError("audd API unreachable")
+
+    results = run_concurrently(4, lambda: flights.do("key", failing))
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert flights.stats()["in_flight"] == 0
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class TrackSpool:
+    """ Durable write-behind queue of identified tracks waiting to be added to the database
+
+    tracks are written to a SQLite file straight away, so they survive a restart or the database service being down,
+    and a background thread sends them on in batches with send(tracks), which returns True once the batch has been
+    stored. A flush runs every interval seconds, or as soon as batch_size tracks are waiting, so a burst of
+    identifications becomes a few bulk requests. Failed flushes are retried with exponential backoff up to
+    max_backoff seconds. Each content hash is only queued once, repeats while it is waiting are coalesced
+
+    several processes (gunicorn workers) can share one spool file: a flush claims its batch in a write transaction
+    before sending it, so no two flushes send the same tracks. A claim not settled within claim_timeout seconds, left
+    by a process that died mid send, lapses and the tracks are sent again
+
+    each thread keeps its own connection, opened on first use, so queueing a track is one insert on an open
+    connection. The flusher is woken early by the tracks this process has queued since its last flush, other
+    processes' tracks are picked up at the next interval
+    """
+
+    def __init__(self, path, send, batch_size=500, interval=0.5, max_backoff=30, claim_timeout=300,
+                 busy_timeout=5.0):
+        self.path = path
+        self.send = send
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.claim_timeout = claim_timeout
+        self.busy_timeout = busy_timeout
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._queued = 0  # tracks this process has queued that its flushes have not sent yet
+        self._flush_lock = threading.Lock()  # one flush at a time in this process, claims keep processes apart
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._failures = 0  # failed flushes in a row, for the backoff
+        self._counts = {"enqueued": 0, "coalesced": 0, "flushed": 0, "batches": 0, "flush_failures": 0}
+        self._last = {"batch_size": 0, "lag_seconds": 0.0}
+        self._max_lag = 0.0
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+        with conn:
+            conn.execute("PRAGMA journal_mode = WAL")  # request threads append while the flusher reads and deletes
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS pending (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL UNIQUE,
+                    artist TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    enqueued REAL NOT NULL
+                )
+            """)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(pending)")]
+            if "claimed" not in columns:  # spool files from before tracks were claimed
+                conn.execute("ALTER TABLE pending ADD COLUMN claimed REAL")  # when a flush took the track, or NULL
+        conn.close()  # serve.py imports the spool before forking its workers, which must not share a connection
+
+    def _connection(self):
+        """ Function returns this thread's connection, opening it on first use and again in a forked process """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            conn.execute("PRAGMA synchronous = NORMAL")  # safe with WAL, queueing a track does not wait for the disk
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def put(self, key, artist, title):
+        """ Function queues a track for the database, returns False if the same content hash is already queued """
+        with self._connection() as conn:
+            added = conn.execute(
+                "INSERT INTO pending (key, artist, title, enqueued) VALUES (?, ?, ?, ?) ON CONFLICT (key) DO NOTHING",
+                (key, artist, title, time.time())).rowcount
+        with self._lock:
+            self._counts["enqueued" if added else "coalesced"] += 1
+            self._queued += added
+            full = self._queued >= self.batch_size
+        if full:
+            self._wake.set()  # a full batch is waiting, do not wait for the interval
+        return bool(added)
+
+    def flush(self):
+        """ Function sends the oldest batch_size waiting tracks, returns how many were sent
+
+        raises nothing, a failed send leaves the tracks queued and is counted in flush_failures
+        """
+        with self._flush_lock:
+            claimed = time.time()
+            rows = self._claim(claimed)
+            if not rows:
+                return 0
+
+            try:
+                sent = self.send([{"artist": artist, "title": title} for _, artist, title, _ in rows])
+            except Exception:
+                sent = False  # the flusher thread must keep running whatever the send fails with
+            with self._connection() as conn:
+                if sent:
+                    conn.executemany("DELETE FROM pending WHERE id = ? AND claimed = ?",
+                                     [(row[0], claimed) for row in rows])
+                else:
+                    conn.executemany("UPDATE pending SET claimed = NULL WHERE id = ? AND claimed = ?",
+                                     [(row[0], claimed) for row in rows])  # any flush can retry them
+            if not sent:
+                self._count("flush_failures")
+                self._failures += 1
+                return 0
+
+            self._failures = 0
+            lag = time.time() - rows[0][3]  # how long the oldest track in the batch waited
+            with self._lock:
+                self._queued = max(self._queued - len(rows), 0)
+                self._counts["flushed"] += len(rows)
+                self._counts["batches"] += 1
+                self._last = {"batch_size": len(rows), "lag_seconds": round(lag, 3)}
+                self._max_lag = max(self._max_lag, lag)
+            return len(rows)
+
+    def _claim(self, claimed):
+        """ Function marks the oldest batch_size tracks no other flush holds as claimed at time claimed, returns them
+        as (id, artist, title, enqueued) in the order they were queued
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")  # take the write lock before reading, so another process cannot claim too
+            rows = conn.execute("""
+                UPDATE pending SET claimed = ? WHERE id IN (
+                    SELECT id FROM pending WHERE claimed IS NULL OR claimed < ? ORDER BY id LIMIT ?
+                ) RETURNING id, artist, title, enqueued
+            """, (claimed, claimed - self.claim_timeout, self.batch_size)).fetchall()
+        return sorted(rows)  # RETURNING does not keep the order of the subquery
+
+    def _run(self):
+        while not self._stopping.is_set():
+            sent = self.flush()
+            if sent == self.batch_size:
+                continue  # more may be waiting, keep going until the backlog is cleared
+            delay = self.interval if not self._failures else min(self.interval * 2 ** self._failures, self.max_backoff)
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def start(self):
+        """ Function starts the background flusher if it is not already running, tracks left over from a previous
+        run are sent first
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="track-spool-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5, flush=True):
+        """ Function stops the background flusher, letting a flush in progress finish, and unless flush is False
+        makes one last attempt to send what is waiting. Anything still queued stays on disk for the next start
+        """
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if flush and self._failures == 0:
+            self.flush()
+
+    def stats(self):
+        """ Function returns the queue depth, how long the oldest waiting track has waited and the flush counters """
+        with self._connection() as conn:
+            depth, oldest = conn.execute("SELECT COUNT(*), MIN(enqueued) FROM pending").fetchone()
+        with self._lock:
+            counts = dict(self._counts)
+            counts["last_batch_size"] = self._last["batch_size"]
+            counts["last_lag_seconds"] = self._last["lag_seconds"]
+            counts["max_lag_seconds"] = round(self._max_lag, 3)
+        counts["depth"] = depth
+        counts["oldest_seconds"] = round(time.time() - oldest, 3) if oldest is not None else 0.0
+        counts["avg_batch_size"] = round(counts["flushed"] / counts["batches"], 1) if counts["batches"] else 0.0
+        return counts
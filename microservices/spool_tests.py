@@ -0,0 +1,177 @@
+import pytest
+import time
+from spool import TrackSpool
+
+
+class FakeDatabase:
+    """Stands in for the database's bulk endpoint, recording every batch and failing while down is set."""
+
+    def __init__(self):
+        self.batches = []
+        self.down = False
+
+    def send(self, tracks):
+        if self.down:
+            return False
+        self.batches.append(tracks)
+        return True
+
+
+@pytest.fixture
+def database():
+    return FakeDatabase()
+
+
+@pytest.fixture
+def spool(tmp_path, database):
+    """Spool backed by a temporary SQLite file, flushing only when the test asks it to."""
+    spool = TrackSpool(str(tmp_path / "spool.db"), database.send, batch_size=2, interval=3600, max_backoff=3600)
+    yield spool
+    spool.stop(flush=False)
+
+
+# ============================================= HAPPY PATHS ======================================================================
+
+def test_flush_in_batches(spool, database):
+    """Test queued tracks are sent in batches
+
+    ensures that three queued tracks are sent oldest first in batches of at most batch_size, and removed once sent
+
+    asserts two batches of 2 and 1 tracks, an empty queue and the batch counters
+    """
+    for i in range(3):
+        spool.put(f"key{i}", "Olivia Rodrigo", f"song {i}")
+    assert spool.stats()["depth"] == 3
+
+    assert spool.flush() == 2
+    assert spool.flush() == 1
+    assert [[t["title"] for t in batch] for batch in database.batches] == [["song 0", "song 1"], ["song 2"]]
+    stats = spool.stats()
+    assert (stats["depth"], stats["flushed"], stats["batches"], stats["last_batch_size"]) == (0, 3, 2, 1)
+
+
+def test_coalesce_same_key(spool, database):
+    """Test the same audio queued twice is only sent once
+
+    ensures that a track is not queued again while the same content hash is waiting
+
+    asserts the second put returns False, one track is sent and the repeat is counted as coalesced
+    """
+    assert spool.put("key", "Olivia Rodrigo", "good 4 u") is True
+    assert spool.put("key", "Olivia Rodrigo", "good 4 u") is False
+    spool.flush()
+    assert len(database.batches[0]) == 1
+    assert spool.stats()["coalesced"] == 1
+
+
+def test_durable(tmp_path, spool, database):
+    """Test queued tracks survive a restart
+
+    ensures that a track queued before a restart is sent by a new spool using the same file
+
+    asserts the new spool sends the track
+    """
+    spool.put("key", "Olivia Rodrigo", "good 4 u")
+    restarted = TrackSpool(spool.path, database.send, batch_size=2, interval=3600)
+    assert restarted.flush() == 1
+    assert database.batches[0][0]["title"] == "good 4 u"
+
+
+def test_background_flush(spool, database):
+    """Test the background flusher sends a full batch straight away
+
+    ensures that once batch_size tracks are waiting the flusher thread sends them without waiting for the interval
+
+    asserts the batch is sent within a second although the interval is an hour
+    """
+    spool.start()
+    spool.put("key1", "Olivia Rodrigo", "good 4 u")
+    spool.put("key2", "The Weeknd", "Blinding Lights")
+    deadline = time.time() + 1
+    while not database.batches and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(database.batches) == 1
+    assert spool.stats()["depth"] == 0
+
+def test_shared_spool_file(spool, database):
+    """Test two spools on one file never send the same track
+
+    ensures that when another process's spool flushes while a batch is being sent, as gunicorn workers sharing the
+    spool file do, it takes the next tracks instead of sending the same ones again
+
+    asserts every track is sent exactly once across the two spools and the queue is empty
+    """
+    other = TrackSpool(spool.path, database.send, batch_size=2, interval=3600)
+    for i in range(4):
+        spool.put(f"key{i}", "Olivia Rodrigo", f"song {i}")
+
+    def send_while_other_flushes(tracks):
+        other.flush()  # runs while this batch is claimed but not yet sent
+        return database.send(tracks)
+    spool.send = send_while_other_flushes
+
+    assert spool.flush() == 2
+    assert sorted(t["title"] for batch in database.batches for t in batch) == [f"song {i}" for i in range(4)]
+    assert spool.stats()["depth"] == 0
+
+def test_connection_reused(spool):
+    """Test queueing tracks reuses the thread's connection
+
+    ensures that each put is an insert on an open connection in WAL mode that does not wait for the disk, rather than
+    opening the file again
+
+    asserts the same connection for every call on the thread, WAL and synchronous NORMAL (1)
+    """
+    spool.put("key1", "Olivia Rodrigo", "good 4 u")
+    conn = spool._connection()
+    spool.put("key2", "The Weeknd", "Blinding Lights")
+    assert spool._connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+
+# ============================================= UNHAPPY PATHS ===================================================================
+
+def test_database_down(spool, database):
+    """Test tracks stay queued while the database is down
+
+    ensures that a failed flush keeps the tracks, counts the failure and that they are sent once the database is back
+
+    asserts nothing is removed while down, the failure counter, and the track sent after recovery
+    """
+    database.down = True
+    spool.put("key", "Olivia Rodrigo", "good 4 u")
+    assert spool.flush() == 0
+    stats = spool.stats()
+    assert (stats["depth"], stats["flush_failures"]) == (1, 1)
+
+    database.down = False
+    assert spool.flush() == 1
+    assert spool.stats()["depth"] == 0
+
+
+def test_send_raises(spool):
+    """Test a send that raises is treated as a failed flush
+
+    asserts flush returns 0 and the track is still queued
+    """
+    def broken(tracks):
+        raise ConnectionError("database unreachable")
+    spool.send = broken
+    spool.put("key", "Olivia Rodrigo", "good 4 u")
+    assert spool.flush() == 0
+    assert spool.stats()["depth"] == 1
+
+
+def test_lapsed_claim(spool, database):
+    """Test tracks claimed by a flush that never finished are sent again
+
+    ensures that a claim older than claim_timeout, as left by a worker killed mid send, does not strand its tracks
+
+    asserts a spool with no claim timeout sends the claimed track
+    """
+    spool.put("key", "Olivia Rodrigo", "good 4 u")
+    assert len(spool._claim(time.time())) == 1  # claimed, then the process dies before sending
+    assert spool.flush() == 0
+    spool.claim_timeout = 0
+    assert spool.flush() == 1
+    assert database.batches[0][0]["title"] == "good 4 u"